@@ -0,0 +1,95 @@
+"""Перенос выполненных задач в архив: задачи в статусе Done, статус которых не менялся дольше archive_after_days
+дней, переносятся из таблицы задач в таблицу {table}_archive из миграции archive.
+Кэш задач работающих приложений перенос не сбрасывает, поэтому GET /api/v1/tasks/<id> может отдавать перенесенную
+задачу без include_archived еще task_cache_ttl секунд.
+Запуск из корня репозитория: python -m app.archive [--older-than ДНИ] [--batch-size N] [--dry-run]"""
+import argparse
+import sys
+from datetime import date, timedelta
+from time import perf_counter
+from typing import Callable, Optional, Tuple
+from app.connectdb import connect_db, connect_db_in_transaction, close_connection_pool
+from app.task import Statuses
+from config import Config
+
+table = Config.tasks_table_name
+
+
+@connect_db_in_transaction
+def archive_batch(before: date, after_id: int = 0, batch_size: int = Config.archive_batch_size,
+                  cursor=None) -> Tuple[int, Optional[int]]:
+    """Переносит в архив до batch_size выполненных задач с id > after_id, статус которых менялся раньше before.
+    Возвращает количество перенесенных задач и наибольший id среди них.
+    Задачи удаляются и вставляются в архив одним запросом в одной транзакции. Задачи, которые сейчас меняют другие
+    транзакции, пропускаются, а не ждут блокировку, их перенесет следующий запуск"""
+    # Триггер журнала изменений запишет удаление этих задач как archive, а не delete
+    cursor.execute("SELECT set_config(%s, 'on', true);", (f'{table}.archiving',))
+    # Пачка выбирается в MATERIALIZED CTE, который выполняется ровно один раз. Подзапрос в DELETE ... WHERE id IN
+    # планировщик может выполнить заново для каждой строки, и тогда SKIP LOCKED пропустил бы уже удаленные этим же
+    # запросом задачи, а LIMIT каждый раз выбирал бы следующие, пока не удалит все подходящие задачи
+    cursor.execute(f"""WITH batch AS MATERIALIZED (
+                           SELECT id FROM {table}
+                           WHERE current_status = %(status)s AND last_change_status_date < %(before)s
+                               AND id > %(after_id)s
+                           ORDER BY id LIMIT %(batch_size)s FOR UPDATE SKIP LOCKED),
+                       moved AS (DELETE FROM {table} USING batch WHERE {table}.id = batch.id RETURNING {table}.*),
+                       archived AS (INSERT INTO {table}_archive SELECT * FROM moved RETURNING id)
+                       SELECT count(*), max(id) FROM archived;""",
+                   {'status': Statuses.final.value, 'before': before, 'after_id': after_id, 'batch_size': batch_size})
+    return cursor.fetchone()
+
+
+@connect_db
+def count_archivable(before: date, cursor=None) -> int:
+    """Возвращает количество выполненных задач, статус которых менялся раньше before"""
+    cursor.execute(f"SELECT count(*) FROM {table} WHERE current_status = %s AND last_change_status_date < %s;",
+                   (Statuses.final.value, before))
+    return cursor.fetchone()[0]
+
+
+def archive_tasks(older_than_days: int = Config.archive_after_days, batch_size: int = Config.archive_batch_size,
+                  progress: Optional[Callable[[int, float], None]] = None) -> int:
+    """Пачками по batch_size переносит в архив выполненные задачи, статус которых не менялся older_than_days дней,
+    и возвращает количество перенесенных задач. После каждой пачки вызывает progress(перенесено всего, секунд прошло).
+    Каждая пачка коммитится отдельно, поэтому прерванный перенос можно просто запустить заново"""
+    before = date.today() - timedelta(days=older_than_days)
+    archived = 0
+    after_id = 0
+    started_at = perf_counter()
+    while True:
+        count, last_id = archive_batch(before, after_id, batch_size)
+        if not count:
+            return archived
+        archived += count
+        after_id = last_id
+        if progress is not None:
+            progress(archived, perf_counter() - started_at)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Move finished tasks into the archive table')
+    parser.add_argument('--older-than', type=int, default=Config.archive_after_days, metavar='DAYS',
+                        help='archive Done tasks whose status has not changed for this many days')
+    parser.add_argument('--batch-size', type=int, default=Config.archive_batch_size,
+                        help='tasks moved per transaction')
+    parser.add_argument('--dry-run', action='store_true', help='only count tasks that would be archived')
+    args = parser.parse_args()
+
+    def print_progress(archived: int, seconds: float) -> None:
+        print(f'Archived {archived} tasks, {archived / seconds if seconds else 0:.0f} tasks/s', flush=True)
+
+    try:
+        if args.dry_run:
+            before = date.today() - timedelta(days=args.older_than)
+            print(f'{count_archivable(before)} tasks of {table} would be archived')
+            return 0
+        started_at = perf_counter()
+        archived = archive_tasks(args.older_than, args.batch_size, print_progress)
+    finally:
+        close_connection_pool()
+    print(f'Archived {archived} tasks of {table} in {perf_counter() - started_at:.1f} s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
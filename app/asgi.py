@@ -0,0 +1,264 @@
+# Без этих 2-ух строчек не видно config.py
+import sys
+sys.path.append('../')
+import asyncio
+from contextlib import asynccontextmanager
+from hashlib import md5
+from typing import Optional
+from pydantic import ValidationError
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import Response, RedirectResponse, StreamingResponse
+from starlette.routing import Route
+from werkzeug.http import parse_etags, quote_etag
+from app import async_task, metrics
+from app.queries import statements_samples
+from app.serializers import dumps, JSON_MIMETYPE, NDJSON_MIMETYPE
+from app.task import UpdateTaskRequestBody, CreateTaskRequestBody, CreateTasksBulkRequestBody, \
+    GetTasksQueryParams, BulkTasksRequestBody, BulkUpdateTasksRequestBody, GetChangesQueryParams, VersionConflict, \
+    StatusEventsRequestBody, SearchTasksQueryParams, IncludeArchivedQueryParams, Task, tasks_cache
+
+# Асинхронный вариант app.sca: те же маршруты, модели запросов и ответы, но на ASGI и асинхронном пуле asyncpg.
+# Запуск из папки app: python asgi.py или uvicorn app.asgi:app из корня репозитория
+
+metrics.register_collector('Connection pool usage, wait time in seconds',
+                           metrics.gauges('tasks_db_pool', async_task.get_pool_stats))
+metrics.register_collector('Task cache usage', metrics.gauges('tasks_cache', tasks_cache.stats))
+metrics.register_collector('Prepared SQL statements executions, time in seconds', statements_samples)
+metrics.register_collector('Status events queue, flush time in seconds',
+                           metrics.gauges('tasks_status_queue', async_task.status_queue.stats))
+
+
+def json_response(obj, status: int = 200, etag: Optional[str] = None) -> Response:
+    headers = {'ETag': quote_etag(etag)} if etag is not None else None
+    return Response(dumps(obj), status_code=status, media_type=JSON_MIMETYPE, headers=headers)
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """Если клиент прислал в If-None-Match такой же etag, то вернет ответ 304 Not Modified, иначе None"""
+    if parse_etags(request.headers.get('if-none-match')).contains_weak(etag):
+        return Response(status_code=304, headers={'ETag': quote_etag(etag)})
+    return None
+
+
+async def read_json(request: Request):
+    """Возвращает json из тела запроса или None, если тело пустое или это не json"""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def root(request: Request):
+    return RedirectResponse('/api/v1/tasks')
+
+
+async def get_metrics(request: Request):
+    """То же самое, что app.sca.get_metrics"""
+    return Response(metrics.render(), status_code=200, media_type='text/plain; version=0.0.4')
+
+
+async def get_all_tasks(request: Request):
+    """То же самое, что app.sca.get_all_tasks"""
+    try:
+        query_params = GetTasksQueryParams(**request.query_params)
+    except ValidationError as e:
+        return Response(status_code=400, content=e.json())
+    etag = f'{await async_task.get_change_counter()}-{md5(request.url.query.encode()).hexdigest()[:16]}'
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    tasks, next_after_id = await async_task.get_tasks_page(query_params.limit, query_params.after_id,
+                                                           query_params.fields, query_params.filters,
+                                                           query_params.include_archived)
+    response = json_response(tasks, etag=etag)
+    if next_after_id is not None:
+        response.headers['X-Next-Cursor'] = str(next_after_id)
+    return response
+
+
+async def get_tasks_stats(request: Request):
+    """То же самое, что app.sca.get_tasks_stats"""
+    etag = str(await async_task.get_change_counter())
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    return json_response(await async_task.get_status_counts(), etag=etag)
+
+
+async def get_tasks_changes(request: Request):
+    """То же самое, что app.sca.get_tasks_changes"""
+    try:
+        query_params = GetChangesQueryParams(**request.query_params)
+    except ValidationError as e:
+        return Response(status_code=400, content=e.json())
+    changes, next_since = await async_task.get_changes(query_params.since, query_params.limit)
+    return json_response({'changes': changes, 'next_since': next_since})
+
+
+async def search_tasks(request: Request):
+    """То же самое, что app.sca.search_tasks"""
+    try:
+        query_params = SearchTasksQueryParams(**request.query_params)
+    except ValidationError as e:
+        return Response(status_code=400, content=e.json())
+    tasks, next_offset, truncated = await async_task.search(query_params.q, query_params.limit, query_params.offset)
+    return json_response({'tasks': tasks, 'next_offset': next_offset, 'truncated': truncated})
+
+
+async def export_all_tasks(request: Request):
+    """То же самое, что app.sca.export_all_tasks"""
+    try:
+        include_archived = IncludeArchivedQueryParams(**request.query_params).include_archived
+    except ValidationError as e:
+        return Response(status_code=400, content=e.json())
+
+    async def generate_lines():
+        async for task in async_task.iter_all_tasks(include_archived=include_archived):
+            yield dumps(task) + b'\n'
+    return StreamingResponse(generate_lines(), status_code=200, media_type=NDJSON_MIMETYPE)
+
+
+async def create_task(request: Request):
+    """То же самое, что app.sca.create_task"""
+    try:
+        content = CreateTaskRequestBody(**await request.form()).content
+    except ValidationError:
+        return Response(status_code=400, content="The request body should contain only 1 parameter - content")
+    task = await async_task.create_task(content)
+    return json_response(task.task_id, status=201)
+
+
+async def create_tasks_bulk(request: Request):
+    """То же самое, что app.sca.create_tasks_bulk"""
+    try:
+        contents = CreateTasksBulkRequestBody.parse_obj(await read_json(request)).contents
+    except ValidationError as e:
+        return Response(status_code=400, content=e.json())
+    return json_response(await async_task.create_many(contents), status=201)
+
+
+async def get_task(request: Request):
+    """То же самое, что app.sca.get_task"""
+    try:
+        include_archived = IncludeArchivedQueryParams(**request.query_params).include_archived
+    except ValidationError as e:
+        return Response(status_code=400, content=e.json())
+    task_id = request.path_params['task_id']
+    if request.headers.get('if-none-match'):
+        etag = await async_task.get_task_etag(task_id, include_archived)
+        if etag is None:
+            return Response(status_code=404, content=f"Task with id {task_id} NOT FOUND")
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+    task = await async_task.get_task(task_id, include_archived)
+    if task is None:
+        return Response(status_code=404, content=f"Task with id {task_id} NOT FOUND")
+    return json_response(task.dict(), etag=task.etag)
+
+
+async def delete_task(request: Request):
+    """То же самое, что app.sca.delete_task"""
+    task_id = request.path_params['task_id']
+    if not await async_task.delete_by_id(task_id):
+        return Response(status_code=404, content=f'Task with id {task_id} NOT FOUND')
+    return Response(status_code=200, content=f"Task with id {task_id} DELETED")
+
+
+def bulk_result(task_ids: list, affected_ids: list) -> dict:
+    affected = set(affected_ids)
+    return {'affected': affected_ids, 'missing': [task_id for task_id in task_ids if task_id not in affected]}
+
+
+async def update_tasks_bulk(request: Request):
+    """То же самое, что app.sca.update_tasks_bulk"""
+    try:
+        request_body = BulkUpdateTasksRequestBody.parse_obj(await read_json(request) or {})
+    except ValidationError as e:
+        return Response(status_code=400, content=e.json())
+    task_ids = request_body.task_ids
+    affected_ids = await async_task.update_many(task_ids, content=request_body.content,
+                                                current_status=request_body.status)
+    return json_response(bulk_result(task_ids, affected_ids))
+
+
+async def delete_tasks_bulk(request: Request):
+    """То же самое, что app.sca.delete_tasks_bulk"""
+    try:
+        request_body = BulkTasksRequestBody.parse_obj(await read_json(request) or {})
+    except ValidationError as e:
+        return Response(status_code=400, content=e.json())
+    task_ids = request_body.task_ids
+    return json_response(bulk_result(task_ids, await async_task.delete_many(task_ids)))
+
+
+async def enqueue_status_events(request: Request):
+    """То же самое, что app.sca.enqueue_status_events"""
+    try:
+        events = StatusEventsRequestBody.parse_obj(await read_json(request)).events
+    except ValidationError as e:
+        return Response(status_code=400, content=e.json())
+    return json_response({'accepted': len(events), 'queue_depth': async_task.status_queue.put(events)}, status=202)
+
+
+async def update_task(request: Request):
+    """То же самое, что app.sca.update_task"""
+    try:
+        request_body = dict(UpdateTaskRequestBody(**await request.form()))
+    except ValidationError as e:
+        return Response(status_code=400, content=e.json())
+    task_id = request_body.get('task_id')
+    if_match = parse_etags(request.headers.get('if-match'))
+    versions = Task.versions_from_etags(task_id, if_match.as_set()) if if_match and not if_match.star_tag else None
+    try:
+        task = await async_task.update_task(task_id, content=request_body.get('content'),
+                                            current_status=request_body.get('status'), versions=versions)
+    except VersionConflict as e:
+        return Response(status_code=409, content=f'Task with id {task_id} was modified, current ETag is "{e.etag}"',
+                        headers={'ETag': quote_etag(e.etag)})
+    if task is None:
+        return Response(status_code=404, content=f'Task with id {task_id} NOT FOUND')
+    return Response(status_code=200, headers={'ETag': quote_etag(task.etag)})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await async_task.init_pool()
+    await async_task.apply_migrations()
+    await async_task.load_column_names()
+    column_names_refresher = asyncio.create_task(async_task.refresh_column_names())
+    yield
+    column_names_refresher.cancel()
+    # Сначала запишем очередь статусов, потом закроем пул
+    await async_task.status_queue.stop_async()
+    await async_task.close_pool()
+
+
+routes = [
+    Route('/', root),
+    Route('/metrics', get_metrics),
+    Route('/api/v1/tasks', get_all_tasks, methods=['GET']),
+    Route('/api/v1/tasks', create_task, methods=['POST']),
+    # Flask перенаправляет PUT /api/v1/tasks на /api/v1/tasks/, здесь сразу обработаем оба адреса
+    Route('/api/v1/tasks', update_task, methods=['PUT']),
+    Route('/api/v1/tasks/', update_task, methods=['PUT']),
+    Route('/api/v1/tasks/stats', get_tasks_stats, methods=['GET']),
+    Route('/api/v1/tasks/changes', get_tasks_changes, methods=['GET']),
+    Route('/api/v1/tasks/status-events', enqueue_status_events, methods=['POST']),
+    Route('/api/v1/tasks/search', search_tasks, methods=['GET']),
+    Route('/api/v1/tasks/export', export_all_tasks, methods=['GET']),
+    Route('/api/v1/tasks/bulk', create_tasks_bulk, methods=['POST']),
+    Route('/api/v1/tasks/bulk', update_tasks_bulk, methods=['PATCH']),
+    Route('/api/v1/tasks/bulk', delete_tasks_bulk, methods=['DELETE']),
+    Route('/api/v1/tasks/{task_id:int}', get_task, methods=['GET']),
+    Route('/api/v1/tasks/{task_id:int}', delete_task, methods=['DELETE']),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan, middleware=[Middleware(metrics.ASGIMiddleware)])
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='127.0.0.1', port=5000)
@@ -0,0 +1,325 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from time import perf_counter
+from typing import AsyncIterator, List, Optional, Tuple
+import asyncpg
+from app import queries
+from app import migrations
+from app.connectdb import PoolStats
+from app.metrics import record_timing
+from app.schema import tasks_schema
+from app.status_queue import StatusQueue
+from app.task import Task, Statuses, VersionConflict, tasks_cache
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Асинхронный пул подключений, создается при старте ASGI приложения через init_pool()
+pool: Optional[asyncpg.Pool] = None
+pool_stats = PoolStats()
+
+
+async def init_pool() -> None:
+    global pool
+    pool = await asyncpg.create_pool(database=Config.dbname,
+                                     host=Config.host,
+                                     user=Config.user,
+                                     password=Config.password,
+                                     min_size=Config.db_pool_minconn,
+                                     max_size=Config.db_pool_maxconn,
+                                     server_settings={'search_path': Config.db_schema} if Config.db_schema else None)
+
+
+async def close_pool() -> None:
+    if pool is not None:
+        await pool.close()
+
+
+def get_pool_stats() -> dict:
+    """То же самое, что app.connectdb.get_pool_stats, для пула asyncpg"""
+    return dict(pool_stats.as_dict(), idle=pool.get_idle_size() if pool is not None else 0)
+
+
+@asynccontextmanager
+async def acquire() -> AsyncIterator[asyncpg.Connection]:
+    """Берет подключение из пула и учитывает ожидание в статистике пула и времени запроса, как app.connectdb"""
+    started_at = perf_counter()
+    async with pool.acquire() as conn:
+        wait_time = perf_counter() - started_at
+        pool_stats.on_checkout(wait_time)
+        record_timing('pool', wait_time)
+        try:
+            yield conn
+        finally:
+            pool_stats.on_return()
+
+
+async def apply_migrations() -> int:
+    """То же самое, что app.migrations.apply_migrations: если схема уже актуальна, то только читает таблицу миграций,
+    поэтому каждый процесс ASGI приложения может вызывать ее при старте"""
+    async with acquire() as conn:
+        if await conn.fetchval(migrations.MIGRATIONS_TABLE_EXISTS):
+            applied = [record['name'] for record in await conn.fetch(migrations.SELECT_APPLIED_MIGRATIONS)]
+            if not migrations.pending_migrations(applied):
+                return 0
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1));", migrations.MIGRATIONS_LOCK)
+            await conn.execute(migrations.CREATE_MIGRATIONS_TABLE)
+            applied = [record['name'] for record in await conn.fetch(migrations.SELECT_APPLIED_MIGRATIONS)]
+            pending = migrations.pending_migrations(applied)
+            for name, statements in pending:
+                for statement in statements:
+                    await conn.execute(statement)
+                await conn.execute(f"INSERT INTO {Config.tasks_table_name}_migrations (name) VALUES ($1);", name)
+            return len(pending)
+
+
+async def load_column_names() -> None:
+    """Загружает имена колонок таблицы задач через asyncpg в общий реестр tasks_schema"""
+    records = await run('fetch', queries.SELECT_COLUMN_NAMES, table_name=tasks_schema.table_name)
+    tasks_schema.set_column_names(record['attname'] for record in records)
+
+
+async def refresh_column_names() -> None:
+    """Перечитывает имена колонок вдвое чаще, чем истекает их ttl. Тогда закэшированные имена не устаревают,
+    и валидация параметров запроса (GetTasksQueryParams.fields) не загружает их сама синхронным пулом psycopg2,
+    который заблокировал бы цикл событий"""
+    while True:
+        await asyncio.sleep(tasks_schema.ttl / 2)
+        try:
+            await load_column_names()
+        except Exception:
+            logger.exception('Failed to refresh column names of %s', tasks_schema.table_name)
+
+
+async def run(method: str, statement: queries.Statement, conn: Optional[asyncpg.Connection] = None, **params):
+    """Выполняет запрос из app.queries методом asyncpg (fetch, fetchrow или fetchval) на подключении conn или пуле
+    и учитывает его в статистике запроса. Подготавливает и кэширует запросы на каждом подключении сам asyncpg"""
+    if conn is None:
+        async with acquire() as conn:
+            return await run(method, statement, conn, **params)
+    started_at = perf_counter()
+    result = await getattr(conn, method)(statement.query, *statement.args(params))
+    statement.record(perf_counter() - started_at)
+    return result
+
+
+async def get_change_counter() -> int:
+    return await run('fetchval', queries.SELECT_CHANGE_COUNTER)
+
+
+async def get_tasks_page(limit: int, after_id: int = 0, fields: Optional[Tuple[str, ...]] = None,
+                         filters: Optional[dict] = None, include_archived: bool = False) -> Tuple[dict, Optional[int]]:
+    """То же самое, что Task.get_tasks_page"""
+    filters = filters or {}
+    records = await run('fetch', queries.select_tasks_page(fields, filters, include_archived), after_id=after_id,
+                        limit=limit + 1, **filters)
+    has_next_page = len(records) > limit
+    records = records[:limit]
+    next_after_id = records[-1]['id'] if has_next_page else None
+    return {record['id']: dict(record) for record in records}, next_after_id
+
+
+async def get_changes(since: str = '0-0', limit: int = Config.default_page_size) -> Tuple[List[dict], str]:
+    """То же самое, что Task.get_changes"""
+    since_xid, since_seq = since.split('-')
+    records = await run('fetch', queries.SELECT_CHANGES, since_xid=since_xid, since_seq=int(since_seq), limit=limit)
+    column_names = list(records[0].keys()) if records else []
+    return Task.changes_page(column_names, [tuple(record) for record in records], since)
+
+
+async def search(q: str, limit: int = Config.default_page_size,
+                 offset: int = 0) -> Tuple[List[dict], Optional[int], bool]:
+    """То же самое, что Task.search"""
+    records = await run('fetch', queries.SEARCH_TASKS, q=q, limit=limit + 1, offset=offset,
+                        max_matches=Config.search_max_matches)
+    column_names = list(records[0].keys()) if records else []
+    return Task.search_page(column_names, [tuple(record) for record in records], limit, offset)
+
+
+async def get_status_counts() -> dict:
+    """То же самое, что Task.get_status_counts"""
+    return Task.status_counts_to_dict(await run('fetch', queries.SELECT_STATUS_COUNTS))
+
+
+async def iter_all_tasks(itersize: int = Config.export_itersize, include_archived: bool = False) -> AsyncIterator[dict]:
+    """То же самое, что Task.iter_all_tasks: читает задачи серверным курсором пачками по itersize штук"""
+    async with acquire() as conn:
+        # Курсоры asyncpg работают только внутри транзакции
+        async with conn.transaction(readonly=True):
+            async for record in conn.cursor(f"SELECT * FROM {queries.tasks_source(include_archived)} ORDER BY id;",
+                                            prefetch=itersize):
+                yield dict(record)
+
+
+async def get_task(task_id: int, include_archived: bool = False) -> Optional[Task]:
+    """То же самое, что Task.get: читает задачу через общий с синхронным приложением кэш задач"""
+    if include_archived:
+        record = await run('fetchrow', queries.SELECT_TASK, task_id=task_id)
+        return await get_archived_task(task_id) if record is None else Task._from_dict(dict(record))
+    task_dict = tasks_cache.get(task_id)
+    if task_dict is None:
+        generation = tasks_cache.generation
+        record = await run('fetchrow', queries.SELECT_TASK, task_id=task_id)
+        if record is None:
+            return None
+        task_dict = dict(record)
+        tasks_cache.fill(task_id, task_dict, generation, task_dict['version'])
+    return Task._from_dict(task_dict)
+
+
+async def get_task_etag(task_id: int, include_archived: bool = False) -> Optional[str]:
+    """То же самое, что Task.get_etag"""
+    task_dict = None if include_archived else tasks_cache.get(task_id)
+    if task_dict is None:
+        statement = queries.SELECT_ANY_TASK_VERSION if include_archived else queries.SELECT_TASK_VERSION
+        version = await run('fetchval', statement, task_id=task_id)
+    else:
+        version = task_dict['version']
+    return None if version is None else f'{task_id}-{version}'
+
+
+async def get_archived_task(task_id: int) -> Optional[Task]:
+    """То же самое, что Task.get_archived"""
+    record = await run('fetchrow', queries.SELECT_ARCHIVED_TASK, task_id=task_id)
+    return None if record is None else Task._from_dict(dict(record))
+
+
+async def create_task(content: str) -> Task:
+    """То же самое, что Task.create"""
+    record = await run('fetchrow', queries.INSERT_TASK, content=content, date_of_creation=datetime.now(),
+                       current_status=Statuses.new.value)
+    task_dict = dict(record)
+    tasks_cache.set(task_dict['id'], task_dict)
+    return Task._from_dict(task_dict)
+
+
+async def create_many(contents: List[str]) -> List[int]:
+    """То же самое, что Task.create_many"""
+    date_of_creation = datetime.now()
+    created_ids = []
+    async with acquire() as conn:
+        async with conn.transaction():
+            for contents_chunk in queries.chunks(contents, Config.bulk_page_size):
+                records = await run('fetch', queries.INSERT_TASKS, conn, contents=contents_chunk,
+                                    date_of_creation=date_of_creation, current_status=Statuses.new.value)
+                created_ids += [record['id'] for record in records]
+    return created_ids
+
+
+async def update_task(task_id: int, content: Optional[str] = None, current_status: Optional[str] = None,
+                      versions: Optional[List[int]] = None) -> Optional[Task]:
+    """То же самое, что Task.update"""
+    changes = Task._collect_changes(content, current_status)
+    record = await run('fetchrow', queries.update_task(changes, versions is not None), task_id=task_id,
+                       today=date.today(), versions=versions, **changes)
+    if record is None:
+        record = await run('fetchrow', queries.SELECT_TASK, task_id=task_id)
+        if record is None:
+            tasks_cache.invalidate(task_id)
+            return None
+        if versions is not None and record['version'] not in versions:
+            raise VersionConflict(task_id, record['version'])
+    task_dict = dict(record)
+    tasks_cache.set_if_newer(task_id, task_dict, task_dict['version'])
+    return Task._from_dict(task_dict)
+
+
+async def update_many(task_ids: List[int], content: Optional[str] = None,
+                      current_status: Optional[str] = None) -> List[int]:
+    """То же самое, что Task.update_many"""
+    changes = Task._collect_changes(content, current_status)
+    records = await run('fetch', queries.update_tasks(changes), task_ids=task_ids, today=date.today(), **changes)
+    tasks_cache.invalidate_many(task_ids)
+    return sorted(record['id'] for record in records)
+
+
+async def delete_by_id(task_id: int) -> bool:
+    """То же самое, что Task.delete_by_id"""
+    deleted_id = await run('fetchval', queries.DELETE_TASK, task_id=task_id)
+    tasks_cache.invalidate(task_id)
+    return deleted_id is not None
+
+
+async def delete_many(task_ids: List[int]) -> List[int]:
+    """То же самое, что Task.delete_many"""
+    records = await run('fetch', queries.DELETE_TASKS, task_ids=task_ids)
+    tasks_cache.invalidate_many(task_ids)
+    return sorted(record['id'] for record in records)
+
+
+class AsyncStatusQueue(StatusQueue):
+    """То же самое, что app.status_queue.StatusQueue, но пачки записывает задача asyncio на пуле asyncpg.
+    Методы put и stats общие, put вызывается только из цикла событий"""
+
+    def _start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._thread = asyncio.get_running_loop().create_task(self._run_async())
+
+    def put(self, events) -> int:
+        depth = super().put(events)
+        # Первое событие запускает отсчет interval, заполненная пачка записывается сразу
+        self._wakeup.set()
+        return depth
+
+    async def _run_async(self) -> None:
+        while True:
+            # Если запись не удалась, то события вернулись в очередь, и, как в StatusQueue._run, их снова запишем
+            # через interval, не дожидаясь новых событий
+            if not self._pending:
+                await self._wakeup.wait()
+            self._wakeup.clear()
+            if len(self._pending) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wait_full(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            await self.flush_async()
+
+    async def _wait_full(self) -> None:
+        while len(self._pending) < self.batch_size:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+    async def flush_async(self) -> int:
+        """То же самое, что StatusQueue.flush"""
+        batch = self._take()
+        if not batch:
+            return 0
+        started_at = perf_counter()
+        try:
+            updated = 0
+            async with acquire() as conn:
+                async with conn.transaction():
+                    for task_ids, statuses in zip(queries.chunks(list(batch), self.batch_size),
+                                                  queries.chunks(list(batch.values()), self.batch_size)):
+                        records = await run('fetch', queries.UPDATE_STATUSES, conn, task_ids=task_ids,
+                                            statuses=statuses, today=date.today())
+                        updated += len(records)
+        except asyncio.CancelledError:
+            # Транзакция откатилась, stop_async запишет пачку еще раз
+            self._requeue(batch)
+            raise
+        except Exception:
+            self._requeue(batch)
+            return 0
+        self._record(batch, updated, perf_counter() - started_at)
+        return updated
+
+    async def stop_async(self) -> None:
+        """То же самое, что StatusQueue.stop: останавливает задачу и записывает в бд все, что осталось в очереди"""
+        with self._changed:
+            self._stopping = True
+        if self._thread is not None:
+            self._thread.cancel()
+            try:
+                await self._thread
+            except asyncio.CancelledError:
+                pass
+        await self.flush_async()
+
+
+# Очередь событий смены статуса ASGI приложения
+status_queue = AsyncStatusQueue()
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Hashable, Iterable, Optional
+
+
+class LRUCache:
+    """Потокобезопасный кэш в памяти процесса. Хранит не больше maxsize записей, при переполнении вытесняет
+    давно не использованные. Запись живет ttl секунд. Считает попадания и промахи.
+    Вместе со значением можно хранить его версию, тогда set_if_newer не заменит его более старым"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Номер поколения увеличивается при каждой записи и инвалидации, см. fill()
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Возвращает значение по ключу или default, если его нет в кэше или оно устарело"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def _put(self, key: Hashable, value: Any, version: Optional[int] = None) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (value, monotonic() + self.ttl, version)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Записывает в кэш свежее значение, например после записи в бд"""
+        with self._lock:
+            self.generation += 1
+            self._put(key, value)
+
+    def set_if_newer(self, key: Hashable, value: Any, version: int) -> None:
+        """То же самое, что set, но не заменяет в кэше значение с той же или более новой версией.
+        Параллельные записи в бд коммитятся в одном порядке, а до кэша могут дойти в другом,
+        и тогда более старая версия не вытеснит новую"""
+        with self._lock:
+            self.generation += 1
+            item = self._data.get(key)
+            if item is not None and item[1] >= monotonic() and item[2] is not None and item[2] >= version:
+                return
+            self._put(key, value, version)
+
+    def fill(self, key: Hashable, value: Any, generation: int, version: Optional[int] = None) -> None:
+        """Записывает в кэш значение, прочитанное из бд, только если с момента начала чтения (generation)
+        кэш не менялся. Иначе значение могло устареть из-за параллельной записи, и его лучше перечитать"""
+        with self._lock:
+            if self.generation == generation:
+                self._put(key, value, version)
+
+    def invalidate(self, key: Hashable) -> None:
+        self.invalidate_many((key,))
+
+    def invalidate_many(self, keys: Iterable[Hashable]) -> None:
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests_count = self.hits + self.misses
+            return {'size': len(self._data),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / requests_count if requests_count else 0.0}
@@ -1,35 +1,165 @@
+import os
 from contextlib import contextmanager
+from functools import wraps
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+from typing import List, Optional
 from psycopg2 import pool
+from app.metrics import record_timing
+from app.queries import PreparingConnection
 from config import Config
 
-connection_pool = pool.SimpleConnectionPool(minconn=1,
-                                            maxconn=20,
-                                            dbname=Config.dbname,
-                                            host=Config.host,
-                                            user=Config.user,
-                                            password=Config.password)
+# Пул подключений процесса и id процесса, который его создал. Пул создается при первом обращении через get_pool(),
+# а не при импорте, чтобы каждый воркер, запущенный через fork (app.server), открывал свои подключения
+# с размером пула, который для него посчитал app.server
+_connection_pool: Optional[pool.ThreadedConnectionPool] = None
+_pool_pid: Optional[int] = None
+# Если все подключения заняты, ThreadedConnectionPool сразу выбрасывает PoolError.
+# Семафор заставит поток подождать, пока какое-нибудь подключение не вернется в пул
+_free_connections: Optional[BoundedSemaphore] = None
+_pool_lock = Lock()
+# Пулы, которые процесс унаследовал от родителя при fork. Их подключения принадлежат родителю: закрытие, в том числе
+# сборщиком мусора, отправило бы серверу Terminate по общему с родителем сокету и оборвало подключения родителя,
+# поэтому на них просто держатся ссылки
+_inherited_pools: List[pool.ThreadedConnectionPool] = []
+
+
+def _create_pool() -> pool.ThreadedConnectionPool:
+    # ThreadedConnectionPool можно безопасно использовать из нескольких потоков одновременно
+    return pool.ThreadedConnectionPool(minconn=min(Config.db_pool_minconn, Config.db_pool_maxconn),
+                                       maxconn=Config.db_pool_maxconn,
+                                       dbname=Config.dbname,
+                                       host=Config.host,
+                                       user=Config.user,
+                                       password=Config.password,
+                                       options=Config.db_options(),
+                                       # Подключения помнят, какие запросы на них уже подготовлены
+                                       connection_factory=PreparingConnection)
+
+
+def get_pool() -> pool.ThreadedConnectionPool:
+    """Возвращает пул подключений текущего процесса, при первом обращении в процессе создает его"""
+    global _connection_pool, _pool_pid, _free_connections
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                if _connection_pool is not None:
+                    _inherited_pools.append(_connection_pool)
+                _connection_pool = _create_pool()
+                _free_connections = BoundedSemaphore(Config.db_pool_maxconn)
+                _pool_pid = os.getpid()
+    return _connection_pool
+
+
+class PoolStats:
+    """Статистика использования пула подключений"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.checked_out = 0
+        self.checkouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def on_checkout(self, wait_time: float) -> None:
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def on_return(self) -> None:
+        with self._lock:
+            self.checked_out -= 1
+
+    def as_dict(self) -> dict:
+        """Возвращает статистику в виде словаря, время ожидания подключения в секундах"""
+        with self._lock:
+            return {'checked_out': self.checked_out,
+                    # _pool - список свободных подключений, которые уже открыты. Пока пула в процессе нет, их нет
+                    'idle': len(_connection_pool._pool) if _pool_pid == os.getpid() else 0,
+                    'max_connections': Config.db_pool_maxconn,
+                    'checkouts': self.checkouts,
+                    'total_wait_time': self.total_wait_time,
+                    'avg_wait_time': self.total_wait_time / self.checkouts if self.checkouts else 0.0,
+                    'max_wait_time': self.max_wait_time}
+
+
+pool_stats = PoolStats()
+
+
+def get_pool_stats() -> dict:
+    return pool_stats.as_dict()
 
 
 def close_connection_pool():
-    connection_pool.closeall()
+    """Закрывает подключения пула текущего процесса. Если после этого снова понадобится подключение,
+    то будет создан новый пул"""
+    global _connection_pool, _pool_pid
+    with _pool_lock:
+        if _connection_pool is not None:
+            if _pool_pid == os.getpid():
+                _connection_pool.closeall()
+            else:
+                _inherited_pools.append(_connection_pool)
+        _connection_pool = None
+        _pool_pid = None
 
 
 @contextmanager
 def get_connection():
     # Контекстный менеджер для получения подключения из пула подключений
-    connection = connection_pool.getconn()
+    started_at = perf_counter()
+    connection_pool = get_pool()
+    free_connections = _free_connections
+    if not free_connections.acquire(timeout=Config.db_pool_timeout):
+        raise pool.PoolError(f'No free connection in the pool for {Config.db_pool_timeout} seconds')
+    try:
+        connection = connection_pool.getconn()
+    except Exception:
+        free_connections.release()
+        raise
+    wait_time = perf_counter() - started_at
+    pool_stats.on_checkout(wait_time)
+    record_timing('pool', wait_time)
     try:
         yield connection
     # После выполнения запроса вернем подключение в пул подключений
     finally:
         connection_pool.putconn(connection)
+        pool_stats.on_return()
+        free_connections.release()
+
+
+@contextmanager
+def get_cursor(autocommit: bool = True):
+    """Контекстный менеджер, который держит подключение из пула до тех пор, пока не закончится работа с курсором.
+    Курсор закрывается при выходе из контекста. Если autocommit=False, то все запросы выполняются в одной транзакции,
+    которая коммитится при успешном выходе из контекста и откатывается при исключении"""
+    with get_connection() as conn:
+        conn.autocommit = autocommit
+        if autocommit:
+            with conn.cursor() as cursor:
+                yield cursor
+        else:
+            with conn, conn.cursor() as cursor:
+                yield cursor
 
 
 def connect_db(func):
-    """Подключаетс к базе данных c помощью декоратора, декорируемой функции обязательно нужно принять cursor"""
+    """Подключаетс к базе данных c помощью декоратора, декорируемой функции обязательно нужно принять cursor.
+    Подключение возвращается в пул только после того, как декорируемая функция отработает"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with get_cursor() as cursor:
+            return func(*args, **kwargs, cursor=cursor)
+    return wrapper
+
+
+def connect_db_in_transaction(func):
+    """То же самое, что connect_db, но все запросы декорируемой функции выполняются в одной транзакции"""
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        with get_connection() as conn:
-            conn.autocommit = True
-            cursor = conn.cursor()
-        return func(*args, **kwargs, cursor=cursor)
+        with get_cursor(autocommit=False) as cursor:
+            return func(*args, **kwargs, cursor=cursor)
     return wrapper
@@ -0,0 +1,187 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from config import Config
+
+# Границы корзин гистограмм времени в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Время по этапам обработки текущего запроса {этап: секунды}, None - если запрос не измеряется
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('request_timings', default=None)
+
+# Сэмпл метрики: имя, метки и значение
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus: отдельные счетчики корзин для каждого набора значений меток"""
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...], buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # {значения меток: [счетчики корзин..., сумма, количество]}
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = Lock()
+
+    def observe(self, seconds: float, *label_values: str) -> None:
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series_items = [(label_values, list(series)) for label_values, series in self._series.items()]
+        for label_values, series in series_items:
+            labels = dict(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(_sample_line(f'{self.name}_bucket', dict(labels, le=str(bound)), cumulative))
+            lines.append(_sample_line(f'{self.name}_bucket', dict(labels, le='+Inf'), series[-1]))
+            lines.append(_sample_line(f'{self.name}_sum', labels, series[-2]))
+            lines.append(_sample_line(f'{self.name}_count', labels, series[-1]))
+        return lines
+
+
+def _sample_line(name: str, labels: Dict[str, str], value: float) -> str:
+    if labels:
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for value in labels.values())
+        label_pairs = ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped))
+        return f'{name}{{{label_pairs}}} {value}'
+    return f'{name} {value}'
+
+
+request_latency = Histogram('tasks_http_request_duration_seconds', 'HTTP request latency by route',
+                            ('method', 'route', 'status'))
+phase_latency = Histogram('tasks_request_phase_duration_seconds',
+                          'Time spent per request waiting for a pool connection, in SQL, schema lookup and serialization',
+                          ('phase',))
+
+# Функции, которые при отдаче метрик возвращают сэмплы из других модулей: пула подключений, кэша и т.д.
+_collectors: List[Tuple[str, Callable[[], Iterable[Sample]]]] = []
+
+
+def register_collector(description: str, collector: Callable[[], Iterable[Sample]]) -> None:
+    _collectors.append((description, collector))
+
+
+def gauges(prefix: str, stats: Callable[[], dict]) -> Callable[[], Iterable[Sample]]:
+    """Превращает функцию, которая возвращает словарь числовой статистики, в сборщик сэмплов prefix_ключ"""
+    def collect():
+        return [(f'{prefix}_{key}', {}, value) for key, value in stats().items()]
+    return collect
+
+
+def record_timing(phase: str, seconds: float) -> None:
+    """Добавляет время этапа к текущему запросу. Вне измеряемого запроса ничего не делает"""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase: str):
+    """Контекстный менеджер, который записывает время выполнения своего блока как этап phase текущего запроса"""
+    started_at = perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(phase, perf_counter() - started_at)
+
+
+def start_request() -> None:
+    _request_timings.set({})
+
+
+def finish_request(method: str, route: str, status: int, seconds: float) -> str:
+    """Записывает время запроса и его этапов в гистограммы, возвращает значение заголовка Server-Timing"""
+    timings = _request_timings.get() or {}
+    _request_timings.set(None)
+    request_latency.observe(seconds, method, route, str(status))
+    server_timing = []
+    for phase, phase_seconds in timings.items():
+        phase_latency.observe(phase_seconds, phase)
+        server_timing.append(f'{phase};dur={phase_seconds * 1000:.2f}')
+    server_timing.append(f'total;dur={seconds * 1000:.2f}')
+    return ', '.join(server_timing)
+
+
+def render() -> str:
+    """Возвращает все метрики в текстовом формате Prometheus"""
+    lines = request_latency.render() + phase_latency.render()
+    for description, collector in _collectors:
+        samples = list(collector())
+        for name in dict.fromkeys(name for name, _, _ in samples):
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} gauge']
+            lines += [_sample_line(sample_name, labels, value) for sample_name, labels, value in samples
+                      if sample_name == name]
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app) -> None:
+    """Подключает к Flask приложению измерение времени запросов и заголовок Server-Timing.
+    Если Config.metrics_enabled выключен, то ничего не делает"""
+    if not Config.metrics_enabled:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started_at = perf_counter()
+        start_request()
+
+    @app.after_request
+    def observe_request(response):
+        started_at = g.pop('metrics_started_at', None)
+        if started_at is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            response.headers['Server-Timing'] = finish_request(request.method, route, response.status_code,
+                                                               perf_counter() - started_at)
+        return response
+
+
+class ASGIMiddleware:
+    """То же самое, что init_app, для ASGI приложения Starlette: измеряет время запросов и добавляет заголовок
+    Server-Timing. Подключается через Starlette(middleware=[Middleware(ASGIMiddleware)]).
+    Если Config.metrics_enabled выключен, то просто передает запросы приложению"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not Config.metrics_enabled:
+            await self.app(scope, receive, send)
+            return
+        started_at = perf_counter()
+        start_request()
+
+        async def send_with_server_timing(message):
+            if message['type'] == 'http.response.start':
+                server_timing = finish_request(scope['method'], _asgi_route(scope), message['status'],
+                                               perf_counter() - started_at)
+                message = dict(message, headers=[*message.get('headers', []),
+                                                 (b'server-timing', server_timing.encode('latin-1'))])
+            await send(message)
+
+        await self.app(scope, receive, send_with_server_timing)
+
+
+def _asgi_route(scope) -> str:
+    """Шаблон пути маршрута Starlette, который обработал запрос, как request.url_rule.rule во Flask"""
+    from starlette.routing import Match
+    for route in scope['app'].routes:
+        if route.matches(scope)[0] == Match.FULL:
+            return route.path
+    return 'unmatched'
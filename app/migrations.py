@@ -0,0 +1,331 @@
+# Без этих 2-ух строчек не видно config.py при запуске python migrations.py из папки app
+import sys
+sys.path.append('../')
+from typing import Iterable, List, Tuple
+from app.connectdb import connect_db, connect_db_in_transaction
+from config import Config
+
+table = Config.tasks_table_name
+search_config = Config.search_config
+
+# Список миграций (название, SQL запросы) для таблицы с задачами. Примененные миграции записываются по названию
+# в таблицу {table}_migrations, и при запуске выполняются только новые, поэтому название уже выпущенной миграции
+# менять нельзя, а новые миграции добавляются в конец списка. Запросы все равно можно безопасно выполнять повторно:
+# в бд, созданной до появления {table}_migrations, все миграции один раз выполнятся заново и запишутся
+MIGRATIONS = [
+    ('create tasks table', [
+        f"""CREATE TABLE IF NOT EXISTS {table} (
+                id serial PRIMARY KEY,
+                content text,
+                date_of_creation date,
+                current_status varchar(255),
+                previous_status varchar(255),
+                last_change_status_date date
+            );""",
+    ]),
+    # Версия строки увеличивается при каждом UPDATE, по ней строится ETag задачи
+    ('task row version', [
+        f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1;",
+        f"""CREATE OR REPLACE FUNCTION {table}_bump_version() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                NEW.version := OLD.version + 1;
+                RETURN NEW;
+            END $$;""",
+        f"DROP TRIGGER IF EXISTS {table}_bump_version ON {table};",
+        f"""CREATE TRIGGER {table}_bump_version BEFORE UPDATE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {table}_bump_version();""",
+    ]),
+    # Счетчик изменений всей таблицы увеличивается каждым запросом, который меняет таблицу, по нему строится
+    # ETag списка задач. Счетчик меняется в той же транзакции, что и задачи, поэтому не обгоняет данные.
+    # Как и счетчики статусов, это сумма строк, которые только дописываются, чтобы параллельные транзакции
+    # не ждали друг друга на блокировке одной строки. Примерно раз в 100 запросов строки сворачиваются в одну
+    ('table change counter', [
+        f"""CREATE TABLE IF NOT EXISTS {table}_change_counter (
+                value bigint NOT NULL
+            );""",
+        f"ALTER TABLE {table}_change_counter DROP COLUMN IF EXISTS id;",
+        f"INSERT INTO {table}_change_counter (value) SELECT 0 WHERE NOT EXISTS (SELECT FROM {table}_change_counter);",
+        f"""CREATE OR REPLACE FUNCTION {table}_bump_change_counter() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                INSERT INTO {table}_change_counter (value) VALUES (1);
+                IF random() < 0.01 AND pg_try_advisory_xact_lock(hashtext('{table}_change_counter')) THEN
+                    WITH moved AS (DELETE FROM {table}_change_counter RETURNING value)
+                    INSERT INTO {table}_change_counter (value) SELECT sum(value) FROM moved HAVING count(*) > 0;
+                END IF;
+                RETURN NULL;
+            END $$;""",
+        f"DROP TRIGGER IF EXISTS {table}_bump_change_counter ON {table};",
+        f"""CREATE TRIGGER {table}_bump_change_counter AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_bump_change_counter();""",
+    ]),
+    # Индексы для фильтров GET /api/v1/tasks. Составной индекс по статусу и id отдает страницу задач в статусе сразу
+    # в порядке id, без сортировки, и подходит для подсчета задач по статусам
+    ('filter indexes', [
+        f"CREATE INDEX IF NOT EXISTS {table}_current_status_id_idx ON {table} (current_status, id);",
+        f"CREATE INDEX IF NOT EXISTS {table}_date_of_creation_idx ON {table} (date_of_creation);",
+        f"CREATE INDEX IF NOT EXISTS {table}_last_change_status_date_idx ON {table} (last_change_status_date);",
+    ]),
+    # Количество задач в каждом статусе. Триггеры на уровне запроса в той же транзакции, что и задачи, дописывают
+    # изменения количества (дельты) по таблицам переходов, одну строку на статус за запрос. Дельты только вставляются,
+    # поэтому параллельные транзакции не ждут друг друга на блокировке строки счетчика. Количество в статусе - сумма
+    # его дельт. Примерно раз в 100 запросов триггер сворачивает дельты в одну строку на статус, если этим уже
+    # не занята другая транзакция. Задачи без статуса считаются под ключом ''.
+    # Проверка и починка счетчиков: python -m app.status_counts
+    ('status counters', [
+        f"""CREATE TABLE IF NOT EXISTS {table}_status_counts (
+                status varchar(255) NOT NULL,
+                count bigint NOT NULL
+            );""",
+        f"ALTER TABLE {table}_status_counts DROP CONSTRAINT IF EXISTS {table}_status_counts_pkey;",
+        # Сворачивание удаляет только те дельты, которые видит, и вставляет их сумму, поэтому дельты незакоммиченных
+        # транзакций не теряются, а читатели видят либо старые дельты, либо их сумму
+        f"""CREATE OR REPLACE FUNCTION {table}_compact_status_counts() RETURNS void LANGUAGE sql AS $$
+                WITH moved AS (DELETE FROM {table}_status_counts RETURNING status, count)
+                INSERT INTO {table}_status_counts (status, count)
+                SELECT status, sum(count) FROM moved GROUP BY status HAVING sum(count) <> 0;
+            $$;""",
+        f"""CREATE OR REPLACE FUNCTION {table}_count_statuses() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    INSERT INTO {table}_status_counts (status, count)
+                    SELECT coalesce(current_status, ''), count(*) FROM new_rows GROUP BY 1;
+                ELSIF TG_OP = 'DELETE' THEN
+                    INSERT INTO {table}_status_counts (status, count)
+                    SELECT coalesce(current_status, ''), -count(*) FROM old_rows GROUP BY 1;
+                ELSE
+                    -- UPDATE без смены статуса дает нулевую разницу и не добавляет дельт
+                    INSERT INTO {table}_status_counts (status, count)
+                    SELECT status, sum(delta) FROM (
+                        SELECT coalesce(current_status, '') AS status, -1 AS delta FROM old_rows
+                        UNION ALL
+                        SELECT coalesce(current_status, ''), 1 FROM new_rows
+                    ) AS changes GROUP BY status HAVING sum(delta) <> 0;
+                END IF;
+                IF random() < 0.01 AND pg_try_advisory_xact_lock(hashtext('{table}_status_counts')) THEN
+                    PERFORM {table}_compact_status_counts();
+                END IF;
+                RETURN NULL;
+            END $$;""",
+        f"""CREATE OR REPLACE FUNCTION {table}_reset_status_counts() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                DELETE FROM {table}_status_counts;
+                RETURN NULL;
+            END $$;""",
+        f"DROP TRIGGER IF EXISTS {table}_count_inserted_statuses ON {table};",
+        f"""CREATE TRIGGER {table}_count_inserted_statuses AFTER INSERT ON {table} REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_count_statuses();""",
+        f"DROP TRIGGER IF EXISTS {table}_count_updated_statuses ON {table};",
+        f"""CREATE TRIGGER {table}_count_updated_statuses AFTER UPDATE ON {table}
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_count_statuses();""",
+        f"DROP TRIGGER IF EXISTS {table}_count_deleted_statuses ON {table};",
+        f"""CREATE TRIGGER {table}_count_deleted_statuses AFTER DELETE ON {table} REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_count_statuses();""",
+        f"DROP TRIGGER IF EXISTS {table}_reset_status_counts ON {table};",
+        f"""CREATE TRIGGER {table}_reset_status_counts AFTER TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_reset_status_counts();""",
+        # Первое заполнение счетчиков по уже существующим задачам. Блокировка не даст другим транзакциям
+        # изменить задачи, пока счетчики считаются
+        f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE;",
+        f"""INSERT INTO {table}_status_counts (status, count)
+            SELECT coalesce(current_status, ''), count(*) FROM {table}
+            WHERE NOT EXISTS (SELECT FROM {table}_status_counts) GROUP BY 1;""",
+    ]),
+    # Журнал изменений задач для GET /api/v1/tasks/changes. seq выдается до коммита, поэтому транзакции могут
+    # закоммитить записи не по порядку seq. Вместе с seq запоминается id транзакции (xid), журнал читается в порядке
+    # (xid, seq) и только до самой старой еще не завершенной транзакции, после которой новых записей появиться не может
+    ('change log', [
+        f"""CREATE TABLE IF NOT EXISTS {table}_changes (
+                seq bigserial PRIMARY KEY,
+                xid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+                task_id integer,
+                operation varchar(8) NOT NULL,
+                changed_at timestamptz NOT NULL DEFAULT now()
+            );""",
+        f"CREATE INDEX IF NOT EXISTS {table}_changes_xid_seq_idx ON {table}_changes (xid, seq);",
+        f"""CREATE OR REPLACE FUNCTION {table}_log_changes() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    INSERT INTO {table}_changes (task_id, operation) SELECT id, 'insert' FROM new_rows ORDER BY id;
+                ELSIF TG_OP = 'UPDATE' THEN
+                    INSERT INTO {table}_changes (task_id, operation) SELECT id, 'update' FROM new_rows ORDER BY id;
+                ELSIF TG_OP = 'DELETE' THEN
+                    -- Задачи, которые app.archive переносит в архив, тоже удаляются из таблицы
+                    INSERT INTO {table}_changes (task_id, operation)
+                    SELECT id, CASE WHEN current_setting('{table}.archiving', true) = 'on' THEN 'archive'
+                                    ELSE 'delete' END
+                    FROM old_rows ORDER BY id;
+                ELSE
+                    -- После TRUNCATE потребителям нужно заново выгрузить все задачи
+                    INSERT INTO {table}_changes (task_id, operation) VALUES (NULL, 'truncate');
+                END IF;
+                RETURN NULL;
+            END $$;""",
+        f"DROP TRIGGER IF EXISTS {table}_log_inserts ON {table};",
+        f"""CREATE TRIGGER {table}_log_inserts AFTER INSERT ON {table} REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_log_changes();""",
+        f"DROP TRIGGER IF EXISTS {table}_log_updates ON {table};",
+        f"""CREATE TRIGGER {table}_log_updates AFTER UPDATE ON {table} REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_log_changes();""",
+        f"DROP TRIGGER IF EXISTS {table}_log_deletes ON {table};",
+        f"""CREATE TRIGGER {table}_log_deletes AFTER DELETE ON {table} REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_log_changes();""",
+        f"DROP TRIGGER IF EXISTS {table}_log_truncate ON {table};",
+        f"""CREATE TRIGGER {table}_log_truncate AFTER TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_log_changes();""",
+    ]),
+    # Полнотекстовый поиск по content для GET /api/v1/tasks/search. tsvector хранится в отдельной таблице с GIN
+    # индексом, а не колонкой задач, чтобы не раздувать строки, которые читают все остальные запросы, и не менять
+    # SELECT * в ответах API. Триггеры на уровне запроса пересчитывают tsvector в той же транзакции, что и задачи,
+    # UPDATE без смены content его не трогает
+    ('full-text search', [
+        f"""CREATE TABLE IF NOT EXISTS {table}_search (
+                id integer PRIMARY KEY,
+                content_tsv tsvector NOT NULL
+            );""",
+        f"CREATE INDEX IF NOT EXISTS {table}_search_content_tsv_idx ON {table}_search USING gin (content_tsv);",
+        f"""CREATE OR REPLACE FUNCTION {table}_index_content() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    INSERT INTO {table}_search (id, content_tsv)
+                    SELECT id, to_tsvector('{search_config}', coalesce(content, '')) FROM new_rows;
+                ELSIF TG_OP = 'UPDATE' THEN
+                    UPDATE {table}_search AS search
+                    SET content_tsv = to_tsvector('{search_config}', coalesce(new_rows.content, ''))
+                    FROM new_rows JOIN old_rows ON old_rows.id = new_rows.id
+                    WHERE search.id = new_rows.id AND new_rows.content IS DISTINCT FROM old_rows.content;
+                ELSIF TG_OP = 'DELETE' THEN
+                    DELETE FROM {table}_search WHERE id IN (SELECT id FROM old_rows);
+                ELSE
+                    TRUNCATE {table}_search;
+                END IF;
+                RETURN NULL;
+            END $$;""",
+        f"DROP TRIGGER IF EXISTS {table}_index_inserted_content ON {table};",
+        f"""CREATE TRIGGER {table}_index_inserted_content AFTER INSERT ON {table} REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_index_content();""",
+        f"DROP TRIGGER IF EXISTS {table}_index_updated_content ON {table};",
+        f"""CREATE TRIGGER {table}_index_updated_content AFTER UPDATE ON {table}
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_index_content();""",
+        f"DROP TRIGGER IF EXISTS {table}_index_deleted_content ON {table};",
+        f"""CREATE TRIGGER {table}_index_deleted_content AFTER DELETE ON {table} REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_index_content();""",
+        f"DROP TRIGGER IF EXISTS {table}_index_truncate ON {table};",
+        f"""CREATE TRIGGER {table}_index_truncate AFTER TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_index_content();""",
+        # Первое заполнение индекса по уже существующим задачам, так же как первое заполнение счетчиков статусов
+        f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE;",
+        f"""INSERT INTO {table}_search (id, content_tsv)
+            SELECT id, to_tsvector('{search_config}', coalesce(content, '')) FROM {table}
+            WHERE NOT EXISTS (SELECT FROM {table}_search);""",
+    ]),
+    # Архив выполненных задач, в который их переносит python -m app.archive. Колонки те же, что у задач, и в том же
+    # порядке, поэтому новые колонки задач нужно добавлять и в архив. Из индексов только уникальный по id: архив
+    # читается редко, только с include_archived, а лишние индексы замедлили бы перенос
+    ('archive', [
+        f"CREATE TABLE IF NOT EXISTS {table}_archive (LIKE {table});",
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_archive_id_idx ON {table}_archive (id);",
+    ]),
+    # Самые новые совпадения поиска для queries.SEARCH_TASKS. Запрос внутри функции выполняется через EXECUTE
+    # и поэтому планируется заново при каждом вызове по настоящему поисковому запросу: для частого слова быстрее идти
+    # по первичному ключу с конца, пока не наберется max_matches совпадений, для редкого - по GIN индексу. Общий план
+    # подготовленного запроса не знает, насколько часто встречается слово, и для одного из случаев читал бы всю таблицу
+    ('search matches by recency', [
+        f"""CREATE OR REPLACE FUNCTION {table}_search_matches(query tsquery, max_matches integer)
+            RETURNS TABLE (id integer, content_tsv tsvector) LANGUAGE plpgsql STABLE AS $$
+            BEGIN
+                RETURN QUERY EXECUTE 'SELECT id, content_tsv FROM {table}_search WHERE content_tsv @@ $1
+                                      ORDER BY id DESC LIMIT $2'
+                    USING query, max_matches;
+            END $$;""",
+    ]),
+    # Запрос, который не изменил ни одной строки (например UPDATE тех же значений в Task.update), не должен менять
+    # счетчик изменений и ETag списка задач. Триггеры на каждую операцию отдельно, чтобы видеть измененные строки
+    ('count only changed rows', [
+        f"""CREATE OR REPLACE FUNCTION {table}_bump_change_counter() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                -- У TRUNCATE нет changed_rows, а условия IF plpgsql вычисляет целиком, поэтому проверки вложены
+                IF TG_OP <> 'TRUNCATE' THEN
+                    IF NOT EXISTS (SELECT FROM changed_rows) THEN
+                        RETURN NULL;
+                    END IF;
+                END IF;
+                INSERT INTO {table}_change_counter (value) VALUES (1);
+                IF random() < 0.01 AND pg_try_advisory_xact_lock(hashtext('{table}_change_counter')) THEN
+                    WITH moved AS (DELETE FROM {table}_change_counter RETURNING value)
+                    INSERT INTO {table}_change_counter (value) SELECT sum(value) FROM moved HAVING count(*) > 0;
+                END IF;
+                RETURN NULL;
+            END $$;""",
+        f"DROP TRIGGER IF EXISTS {table}_bump_change_counter ON {table};",
+        f"DROP TRIGGER IF EXISTS {table}_count_inserts ON {table};",
+        f"""CREATE TRIGGER {table}_count_inserts AFTER INSERT ON {table} REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_bump_change_counter();""",
+        f"DROP TRIGGER IF EXISTS {table}_count_updates ON {table};",
+        f"""CREATE TRIGGER {table}_count_updates AFTER UPDATE ON {table} REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_bump_change_counter();""",
+        f"DROP TRIGGER IF EXISTS {table}_count_deletes ON {table};",
+        f"""CREATE TRIGGER {table}_count_deletes AFTER DELETE ON {table} REFERENCING OLD TABLE AS changed_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_bump_change_counter();""",
+        f"DROP TRIGGER IF EXISTS {table}_count_truncate ON {table};",
+        f"""CREATE TRIGGER {table}_count_truncate AFTER TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_bump_change_counter();""",
+    ]),
+]
+
+
+# Таблица примененных миграций и запросы к ней, общие для app.migrations и app.async_task
+CREATE_MIGRATIONS_TABLE = f"""CREATE TABLE IF NOT EXISTS {table}_migrations (
+                                  name text PRIMARY KEY,
+                                  applied_at timestamptz NOT NULL DEFAULT now()
+                              );"""
+MIGRATIONS_TABLE_EXISTS = f"SELECT to_regclass('{table}_migrations') IS NOT NULL;"
+SELECT_APPLIED_MIGRATIONS = f"SELECT name FROM {table}_migrations;"
+INSERT_APPLIED_MIGRATION = f"INSERT INTO {table}_migrations (name) VALUES (%s);"
+MIGRATIONS_LOCK = f'{table}_migrations'
+
+
+def pending_migrations(applied: Iterable[str]) -> List[Tuple[str, List[str]]]:
+    """Возвращает миграции из MIGRATIONS, названий которых нет среди applied, в порядке списка"""
+    applied = set(applied)
+    return [(name, statements) for name, statements in MIGRATIONS if name not in applied]
+
+
+@connect_db
+def get_pending_migrations(cursor=None) -> List[Tuple[str, List[str]]]:
+    """Возвращает еще не примененные миграции. Только читает таблицу миграций и не берет никаких блокировок"""
+    cursor.execute(MIGRATIONS_TABLE_EXISTS)
+    if not cursor.fetchone()[0]:
+        return list(MIGRATIONS)
+    cursor.execute(SELECT_APPLIED_MIGRATIONS)
+    return pending_migrations(name for name, in cursor.fetchall())
+
+
+def apply_migrations() -> int:
+    """Применяет новые миграции в одной транзакции и возвращает их количество.
+    Если схема уже актуальна, то выполняет только чтение таблицы миграций: DDL и LOCK TABLE из миграций берут
+    на таблице задач блокировки, которые ждали бы, например, долгую выгрузку задач, а все запросы к задачам ждали бы
+    уже эти блокировки"""
+    if not get_pending_migrations():
+        return 0
+    return _apply_pending_migrations()
+
+
+@connect_db_in_transaction
+def _apply_pending_migrations(cursor=None) -> int:
+    # Блокировка не даст нескольким процессам приложения применять миграции одновременно. Пока ждали ее,
+    # миграции мог уже применить другой процесс, поэтому список новых миграций перечитывается под блокировкой
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (MIGRATIONS_LOCK,))
+    cursor.execute(CREATE_MIGRATIONS_TABLE)
+    cursor.execute(SELECT_APPLIED_MIGRATIONS)
+    pending = pending_migrations(name for name, in cursor.fetchall())
+    for name, statements in pending:
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.execute(INSERT_APPLIED_MIGRATION, (name,))
+    return len(pending)
+
+
+if __name__ == '__main__':
+    print(f'Applied {apply_migrations()} new migrations to {table}')
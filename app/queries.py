@@ -0,0 +1,250 @@
+import re
+from hashlib import md5
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Iterable, List, Optional, Tuple
+from psycopg2.errors import FeatureNotSupported, InvalidSqlStatementName
+from psycopg2.extensions import connection as pg_connection
+from app.metrics import record_timing
+from config import Config
+
+table = Config.tasks_table_name
+
+
+class PreparingConnection(pg_connection):
+    """Подключение psycopg2, которое помнит, какие запросы уже подготовлены (PREPARE) в его сессии"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        # Подготовленные запросы, план которых устарел после изменения таблицы. Их нужно удалить (DEALLOCATE)
+        # перед тем, как подготовить заново
+        self.stale_statements = set()
+
+
+def to_positional(query: str) -> Tuple[str, Tuple[str, ...]]:
+    """Переводит запрос с именованными параметрами вида %(name)s в запрос с позиционными параметрами вида $1,
+    как того требуют PREPARE и asyncpg. Возвращает запрос и имена параметров в порядке их номеров"""
+    names = []
+
+    def replace(match):
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return f'${names.index(name) + 1}'
+
+    return re.sub(r'%\((\w+)\)s', replace, query), tuple(names)
+
+
+class Statement:
+    """Запрос к таблице с задачами, который один раз подготавливается (PREPARE) на каждом подключении из пула,
+    а затем выполняется через EXECUTE со связанными параметрами. Считает количество и время выполнений"""
+
+    def __init__(self, name: str, query: str):
+        self.name = name
+        # query - текст запроса с параметрами вида $1, param_names - имена параметров в порядке их номеров
+        self.query, self.param_names = to_positional(query)
+        placeholders = ', '.join(['%s'] * len(self.param_names))
+        self._execute_query = f"EXECUTE {name} ({placeholders});" if self.param_names else f"EXECUTE {name};"
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._lock = Lock()
+
+    def args(self, params: dict) -> list:
+        """Возвращает значения параметров запроса по порядку их номеров"""
+        return [params[name] for name in self.param_names]
+
+    def record(self, seconds: float) -> None:
+        """Учитывает в статистике одно выполнение запроса, которое заняло seconds секунд"""
+        with self._lock:
+            self.calls += 1
+            self.total_time += seconds
+            self.max_time = max(self.max_time, seconds)
+        record_timing('sql', seconds)
+
+    def execute(self, cursor, **params) -> None:
+        """Выполняет запрос с параметрами params, если нужно, сначала подготовит его на подключении курсора.
+        Если таблица изменилась (миграция добавила или удалила колонку) и подготовленный запрос вернул бы другие
+        колонки, то бд отказывается его выполнять. Тогда в режиме autocommit запрос подготавливается заново
+        и выполняется еще раз, а в транзакции ошибка пробрасывается, и запрос подготовится заново в следующий раз"""
+        try:
+            self._execute(cursor, params)
+        except (FeatureNotSupported, InvalidSqlStatementName) as error:
+            connection = cursor.connection
+            connection.prepared_statements.discard(self.name)
+            if isinstance(error, FeatureNotSupported):
+                connection.stale_statements.add(self.name)
+            if not connection.autocommit:
+                raise
+            self._execute(cursor, params)
+
+    def _execute(self, cursor, params: dict) -> None:
+        connection = cursor.connection
+        if self.name not in connection.prepared_statements:
+            if self.name in connection.stale_statements:
+                cursor.execute(f"DEALLOCATE {self.name}")
+                connection.stale_statements.discard(self.name)
+            cursor.execute(f"PREPARE {self.name} AS {self.query}")
+            connection.prepared_statements.add(self.name)
+        started_at = perf_counter()
+        cursor.execute(self._execute_query, self.args(params))
+        self.record(perf_counter() - started_at)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'query': self.query,
+                    'calls': self.calls,
+                    'total_time': self.total_time,
+                    'avg_time': self.total_time / self.calls if self.calls else 0.0,
+                    'max_time': self.max_time}
+
+
+_statements: Dict[str, Statement] = {}
+_statements_lock = Lock()
+
+
+def statement(label: str, query: str) -> Statement:
+    """Возвращает Statement для запроса, при первом обращении создает его. Имя подготовленного запроса строится
+    из label и хэша текста, поэтому у каждого варианта динамического запроса свое имя"""
+    prepared = _statements.get(query)
+    if prepared is None:
+        with _statements_lock:
+            prepared = _statements.get(query)
+            if prepared is None:
+                prepared = _statements[query] = Statement(f'{label}_{md5(query.encode()).hexdigest()[:8]}', query)
+    return prepared
+
+
+def get_statements_stats() -> Dict[str, dict]:
+    """Возвращает статистику выполнений всех запросов {имя подготовленного запроса: статистика}"""
+    return {prepared.name: prepared.stats() for prepared in list(_statements.values())}
+
+
+def statements_samples():
+    """Статистика выполнений подготовленных запросов в виде сэмплов метрик с меткой statement"""
+    for name, stats in get_statements_stats().items():
+        for key in ('calls', 'total_time', 'max_time'):
+            yield f'tasks_sql_statement_{key}', {'statement': name}, stats[key]
+
+
+def update_assignments(fields: Iterable[str], new_status: str = '%(current_status)s') -> str:
+    """Собирает SET часть запроса UPDATE для измененных атрибутов задачи.
+    Все выражения в SET вычисляются по старой версии строки, поэтому при смене статуса в previous_status
+    попадет статус, который был в бд на момент обновления, а не тот, что хранится в инстансе.
+    new_status - выражение с новым статусом, по умолчанию параметр current_status"""
+    assignments = []
+    if 'content' in fields:
+        assignments.append("content = %(content)s")
+    if 'current_status' in fields:
+        status_changed = f"current_status IS DISTINCT FROM {new_status}"
+        assignments += [f"previous_status = CASE WHEN {status_changed} THEN current_status ELSE previous_status END",
+                        f"last_change_status_date = CASE WHEN {status_changed} THEN %(today)s "
+                        f"ELSE last_change_status_date END",
+                        f"current_status = {new_status}"]
+    return ', '.join(assignments)
+
+
+def update_task(fields: Iterable[str], check_version: bool = False) -> Statement:
+    """Строка обновится, только если хотя бы одно из значений fields отличается от того, что в бд: запись тех же
+    значений не должна менять версию задачи и попадать в журнал изменений.
+    Если check_version, то строка обновится, только если ее версия одна из %(versions)s"""
+    changed = ' OR '.join(f"{field} IS DISTINCT FROM %({field})s" for field in fields)
+    condition = f" AND ({changed})" + (' AND version = ANY(%(versions)s)' if check_version else '')
+    return statement('update_task', f"UPDATE {table} SET {update_assignments(fields)} "
+                                    f"WHERE id = %(task_id)s{condition} RETURNING *;")
+
+
+def update_tasks(fields: Iterable[str]) -> Statement:
+    return statement('update_tasks', f"UPDATE {table} SET {update_assignments(fields)} "
+                                     f"WHERE id = ANY(%(task_ids)s) RETURNING id;")
+
+
+# Меняет статусы сразу у многих задач одним запросом, у каждой задачи свой новый статус:
+# по задаче на каждую пару элементов массивов task_ids и statuses
+UPDATE_STATUSES = statement('update_statuses',
+                            f"UPDATE {table} SET {update_assignments(['current_status'], 'events.status')} "
+                            f"FROM unnest(%(task_ids)s::int[], %(statuses)s::text[]) AS events (id, status) "
+                            f"WHERE {table}.id = events.id RETURNING {table}.id;")
+
+
+# Условия WHERE для фильтров страницы задач {имя фильтра: условие}, имя фильтра совпадает с именем параметра
+TASK_FILTERS = {'status': 'current_status = %(status)s',
+                'created_from': 'date_of_creation >= %(created_from)s',
+                'created_to': 'date_of_creation <= %(created_to)s',
+                'changed_since': 'last_change_status_date >= %(changed_since)s'}
+
+
+def tasks_source(include_archived: bool = False) -> str:
+    """Таблица задач для FROM: только активные задачи или активные вместе с архивом.
+    ORDER BY id по объединению читается слиянием двух индексов по id, без сортировки"""
+    if include_archived:
+        return f"(SELECT * FROM {table} UNION ALL SELECT * FROM {table}_archive) AS tasks"
+    return table
+
+
+def select_tasks_page(fields: Optional[Tuple[str, ...]] = None, filters: Iterable[str] = (),
+                      include_archived: bool = False) -> Statement:
+    """fields - имена колонок, должны быть провалидированы через GetTasksQueryParams, filters - имена фильтров из
+    TASK_FILTERS. Условия добавляются в порядке TASK_FILTERS, чтобы одинаковый набор фильтров давал один запрос"""
+    columns = ', '.join(fields) if fields else '*'
+    conditions = ''.join(f' AND {condition}' for name, condition in TASK_FILTERS.items() if name in filters)
+    return statement('select_tasks_page', f"SELECT {columns} FROM {tasks_source(include_archived)} "
+                                          f"WHERE id > %(after_id)s{conditions} ORDER BY id LIMIT %(limit)s;")
+
+
+SELECT_TASK = statement('select_task', f"SELECT * FROM {table} WHERE id = %(task_id)s;")
+SELECT_ARCHIVED_TASK = statement('select_archived_task', f"SELECT * FROM {table}_archive WHERE id = %(task_id)s;")
+SELECT_TASK_VERSION = statement('select_task_version', f"SELECT version FROM {table} WHERE id = %(task_id)s;")
+SELECT_ANY_TASK_VERSION = statement('select_any_task_version', f"SELECT version FROM {tasks_source(True)} "
+                                                               f"WHERE id = %(task_id)s;")
+INSERT_TASK = statement('insert_task', f"INSERT INTO {table} (content, date_of_creation, current_status) "
+                                       f"VALUES (%(content)s, %(date_of_creation)s, %(current_status)s) RETURNING *;")
+# Вставляет сразу много задач одним запросом: по задаче на каждый элемент массива contents
+INSERT_TASKS = statement('insert_tasks', f"INSERT INTO {table} (content, date_of_creation, current_status) "
+                                         f"SELECT content, %(date_of_creation)s, %(current_status)s "
+                                         f"FROM unnest(%(contents)s::text[]) AS content RETURNING id;")
+DELETE_TASK = statement('delete_task', f"DELETE FROM {table} WHERE id = %(task_id)s RETURNING id;")
+DELETE_TASKS = statement('delete_tasks', f"DELETE FROM {table} WHERE id = ANY(%(task_ids)s) RETURNING id;")
+# Количество задач по статусам - суммы дельт, которые дописывают триггеры из миграции status counters
+SELECT_STATUS_COUNTS = statement('select_status_counts', f"SELECT status, sum(count)::bigint "
+                                                         f"FROM {table}_status_counts GROUP BY status "
+                                                         f"HAVING sum(count) <> 0;")
+# Страница журнала изменений после позиции (since_xid, since_seq) вместе с текущим состоянием задач.
+# Записи транзакций, которые начались не раньше самой старой незавершенной, не отдаются, пока она не завершится
+SELECT_CHANGES = statement('select_changes', f"SELECT changes.seq, changes.xid::text AS xid, changes.task_id, "
+                                             f"changes.operation, changes.changed_at, tasks.* "
+                                             f"FROM {table}_changes AS changes "
+                                             f"LEFT JOIN {table} AS tasks ON tasks.id = changes.task_id "
+                                             f"WHERE (changes.xid, changes.seq) > (%(since_xid)s::text::xid8, "
+                                             f"%(since_seq)s::bigint) "
+                                             f"AND changes.xid < pg_snapshot_xmin(pg_current_snapshot()) "
+                                             f"ORDER BY changes.xid, changes.seq LIMIT %(limit)s;")
+# Страница результатов полнотекстового поиска по content, самые релевантные задачи первыми. Поисковый запрос
+# в синтаксисе websearch: слова, "фразы в кавычках", or и -исключения. Ранжируются не больше %(max_matches)s самых
+# новых (с наибольшими id) совпадений, которые находит функция {table}_search_matches из миграции search matches by
+# recency. Набор ранжируемых совпадений одинаковый от запроса к запросу, поэтому страницы по offset не повторяются
+# и не пропускают задачи. Лишнее совпадение в matches нужно только для колонки truncated: совпадений больше,
+# чем ранжировано. Сами задачи читаются только для строк страницы
+SEARCH_TASKS = statement('search_tasks',
+                         f"WITH query AS (SELECT websearch_to_tsquery('{Config.search_config}', %(q)s) AS query), "
+                         f"matches AS MATERIALIZED (SELECT matches.* FROM query, "
+                         f"{table}_search_matches(query.query, %(max_matches)s + 1) AS matches), "
+                         f"page AS (SELECT ranked.id, ts_rank(ranked.content_tsv, query.query) AS rank "
+                         f"FROM (SELECT id, content_tsv FROM matches "
+                         f"ORDER BY id DESC LIMIT %(max_matches)s) AS ranked, query "
+                         f"ORDER BY rank DESC, ranked.id LIMIT %(limit)s OFFSET %(offset)s) "
+                         f"SELECT tasks.*, page.rank, (SELECT count(*) > %(max_matches)s FROM matches) AS truncated "
+                         f"FROM page JOIN {table} AS tasks ON tasks.id = page.id "
+                         f"ORDER BY page.rank DESC, page.id;")
+# Имена колонок таблицы в порядке их расположения, для реестра app.schema.TableSchema
+SELECT_COLUMN_NAMES = statement('select_column_names', "SELECT attname FROM pg_attribute "
+                                                       "WHERE attrelid = %(table_name)s::regclass AND attnum > 0 "
+                                                       "AND NOT attisdropped ORDER BY attnum;")
+SELECT_CHANGE_COUNTER = statement('select_change_counter', f"SELECT sum(value)::bigint FROM {table}_change_counter;")
+
+
+def chunks(items: List, size: int) -> Iterable[List]:
+    """Делит список на части не больше size элементов"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -1,13 +1,40 @@
 # Без этих 2-ух строчек не видно config.py
 import sys
 sys.path.append('../')
-from flask import Flask, request, Response, redirect
-from app.task import Task, UpdateTaskRequestBody, CreateTaskRequestBody
+from flask import Flask, request, Response, redirect, stream_with_context
+from app.task import Task, UpdateTaskRequestBody, CreateTaskRequestBody, CreateTasksBulkRequestBody, \
+    GetTasksQueryParams, BulkTasksRequestBody, BulkUpdateTasksRequestBody, GetChangesQueryParams, VersionConflict, \
+    StatusEventsRequestBody, SearchTasksQueryParams, IncludeArchivedQueryParams, tasks_cache
 from pydantic import ValidationError
-from connectdb import close_connection_pool
+from app.connectdb import close_connection_pool, get_pool_stats
+from app.migrations import apply_migrations
+from app.queries import statements_samples
+from app.status_queue import status_queue
+from app import metrics
+from app.serializers import json_response, iter_ndjson, NDJSON_MIMETYPE
+from hashlib import md5
+from typing import List, Optional
 import atexit
 
 app = Flask(__name__)
+metrics.init_app(app)
+
+
+metrics.register_collector('Connection pool usage, wait time in seconds',
+                           metrics.gauges('tasks_db_pool', get_pool_stats))
+metrics.register_collector('Task cache usage', metrics.gauges('tasks_cache', tasks_cache.stats))
+metrics.register_collector('Prepared SQL statements executions, time in seconds', statements_samples)
+metrics.register_collector('Status events queue, flush time in seconds',
+                           metrics.gauges('tasks_status_queue', status_queue.stats))
+
+
+def not_modified(etag: str) -> Optional[Response]:
+    """Если клиент прислал в If-None-Match такой же etag, то вернет ответ 304 Not Modified, иначе None"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
 
 
 @app.route('/')
@@ -15,10 +42,91 @@ def root():
     return redirect('/api/v1/tasks')
 
 
+@app.route('/metrics')
+def get_metrics():
+    """Метрики приложения в текстовом формате Prometheus: время запросов по маршрутам и этапам,
+    использование пула подключений, кэша задач и статистика выполнения SQL запросов"""
+    return Response(metrics.render(), status=200, mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/v1/tasks', methods=['GET'])
 def get_all_tasks():
-    """Вернет все задачи из таблицы, если задач нет, то вернет пустой json"""
-    return Task.get_all_tasks_as_dict()
+    """Вернет страницу задач из таблицы, если задач нет, то вернет пустой json.
+    Параметры запроса: limit - размер страницы, after_id - вернуть задачи с id больше этого,
+    fields - имена колонок через запятую, фильтры status, created_from, created_to (даты создания включительно)
+    и changed_since (дата смены статуса), include_archived=1 - вместе с задачами из архива.
+    Если есть следующая страница, то ее after_id будет в заголовке X-Next-Cursor.
+    Если таблица не менялась с момента получения ETag из If-None-Match, то вернет 304 без чтения задач"""
+    try:
+        query_params = GetTasksQueryParams(**request.args)
+    except ValidationError as e:
+        return Response(status=400, response=e.json())
+    # Счетчик читаем до задач: если таблицу изменят между запросами, то клиент получит устаревший etag
+    # и просто перезапросит задачи, но никогда не получит 304 вместо новых данных
+    etag = f'{Task.get_change_counter()}-{md5(request.query_string).hexdigest()[:16]}'
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    tasks, next_after_id = Task.get_tasks_page(query_params.limit, query_params.after_id, query_params.fields,
+                                               query_params.filters, query_params.include_archived)
+    response = json_response(tasks)
+    response.set_etag(etag)
+    if next_after_id is not None:
+        response.headers['X-Next-Cursor'] = str(next_after_id)
+    return response
+
+
+@app.route('/api/v1/tasks/stats', methods=['GET'])
+def get_tasks_stats():
+    """Вернет количество всех задач и количество задач в каждом статусе: {"total": .., "by_status": {статус: ..}}"""
+    etag = str(Task.get_change_counter())
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    response = json_response(Task.get_status_counts())
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/api/v1/tasks/changes', methods=['GET'])
+def get_tasks_changes():
+    """Вернет страницу журнала изменений задач: {"changes": [..], "next_since": ..}. Каждое изменение содержит seq,
+    task_id, operation (insert, update, delete, archive или truncate), changed_at и текущее состояние задачи task.
+    Параметры запроса: since - next_since предыдущей страницы, limit - размер страницы.
+    Пустой changes значит, что новых изменений пока нет, следующий запрос нужно делать с тем же next_since"""
+    try:
+        query_params = GetChangesQueryParams(**request.args)
+    except ValidationError as e:
+        return Response(status=400, response=e.json())
+    changes, next_since = Task.get_changes(query_params.since, query_params.limit)
+    return json_response({'changes': changes, 'next_since': next_since})
+
+
+@app.route('/api/v1/tasks/search', methods=['GET'])
+def search_tasks():
+    """Полнотекстовый поиск задач по content: {"tasks": [..], "next_offset": .., "truncated": ..}, самые релевантные
+    задачи первыми, у каждой задачи есть rank - ее релевантность. Параметры запроса: q - поисковый запрос (слова,
+    "фразы в кавычках", or, -слово для исключения), limit - размер страницы, offset - next_offset предыдущей страницы.
+    next_offset будет null, если это последняя страница. truncated будет true, если совпадений больше
+    search_max_matches: тогда ранжированы и отданы только search_max_matches самых новых совпадений"""
+    try:
+        query_params = SearchTasksQueryParams(**request.args)
+    except ValidationError as e:
+        return Response(status=400, response=e.json())
+    tasks, next_offset, truncated = Task.search(query_params.q, query_params.limit, query_params.offset)
+    return json_response({'tasks': tasks, 'next_offset': next_offset, 'truncated': truncated})
+
+
+@app.route('/api/v1/tasks/export', methods=['GET'])
+def export_all_tasks():
+    """Потоково выгружает все задачи в формате NDJSON: по одному json объекту задачи на строку, отсортированные по id.
+    С include_archived=1 выгрузит и задачи из архива"""
+    try:
+        include_archived = IncludeArchivedQueryParams(**request.args).include_archived
+    except ValidationError as e:
+        return Response(status=400, response=e.json())
+    return Response(stream_with_context(iter_ndjson(Task.iter_all_tasks(include_archived=include_archived))),
+                    status=200, mimetype=NDJSON_MIMETYPE)
 
 
 @app.route('/api/v1/tasks', methods=['POST'])
@@ -29,58 +137,137 @@ def create_task():
     except ValidationError:
         return Response(status=400, response="The request body should contain only 1 parameter - content")
     else:
-        task = Task()
-        task.content = content
-        return Response(status=201, response=str(task.task_id))
+        task = Task.create(content)
+        return json_response(task.task_id, status=201)
+
+
+@app.route('/api/v1/tasks/bulk', methods=['POST'])
+def create_tasks_bulk():
+    """Создает несколько задач за один запрос. Тело запроса - json список вида [{"content": "..."}, ..],
+    в случае успеха вернет json список task_id созданных задач в том же порядке"""
+    try:
+        contents = CreateTasksBulkRequestBody.parse_obj(request.get_json(silent=True)).contents
+    except ValidationError as e:
+        return Response(status=400, response=e.json())
+    return json_response(Task.create_many(contents), status=201)
 
 
 @app.route('/api/v1/tasks/<int:task_id>', methods=['GET'])
 def get_task(task_id):
-    """Возвращает все атрибуты конкретной задачи с id = task_id"""
+    """Возвращает все атрибуты конкретной задачи с id = task_id, с include_archived=1 ищет задачу и в архиве.
+    Если задача не менялась с момента получения ETag из If-None-Match, то вернет 304"""
     try:
-        task = Task(task_id)
-    except TypeError:
+        include_archived = IncludeArchivedQueryParams(**request.args).include_archived
+    except ValidationError as e:
+        return Response(status=400, response=e.json())
+    if request.if_none_match:
+        # Условный запрос сравнивает ETag по одной версии задачи и не читает всю задачу, если она не менялась
+        etag = Task.get_etag(task_id, include_archived)
+        if etag is None:
+            return Response(status=404, response=f"Task with id {task_id} NOT FOUND")
+        response = not_modified(etag)
+        if response is not None:
+            return response
+    task = Task.get(task_id, include_archived)
+    if task is None:
         return Response(status=404, response=f"Task with id {task_id} NOT FOUND")
-    else:
-        return Response(status=200, response=task.dict())
+    response = json_response(task.dict())
+    response.set_etag(task.etag)
+    return response
 
 
 @app.route('/api/v1/tasks/<int:task_id>', methods=['DELETE'])
 def delete_task(task_id):
     """Удаляет задачу с id = task_id"""
-    try:
-        task = Task(task_id)
-    except ValueError:
+    if not Task.delete_by_id(task_id):
         return Response(status=404, response=f'Task with id {task_id} NOT FOUND')
-    else:
-        task.delete()
-        return Response(status=200, response=f"Task with id {task_id} DELETED")
+    return Response(status=200, response=f"Task with id {task_id} DELETED")
+
+
+def bulk_result(task_ids: list, affected_ids: list) -> dict:
+    """Возвращает словарь с id задач, которые были затронуты массовой операцией, и id задач, которых не нашлось"""
+    affected = set(affected_ids)
+    return {'affected': affected_ids, 'missing': [task_id for task_id in task_ids if task_id not in affected]}
+
+
+@app.route('/api/v1/tasks/bulk', methods=['PATCH'])
+def update_tasks_bulk():
+    """Обновляет контент и/или статус у нескольких задач за одну транзакцию. В теле запроса json с ids - списком id
+    задач или id_range - диапазоном {"from_id": .., "to_id": ..}, и атрибут(ы) со значением, которое необходимо обновить"""
+    try:
+        request_body = BulkUpdateTasksRequestBody.parse_obj(request.get_json(silent=True) or {})
+    except ValidationError as e:
+        return Response(status=400, response=e.json())
+    task_ids = request_body.task_ids
+    affected_ids = Task.update_many(task_ids, content=request_body.content, current_status=request_body.status)
+    return json_response(bulk_result(task_ids, affected_ids))
+
+
+@app.route('/api/v1/tasks/bulk', methods=['DELETE'])
+def delete_tasks_bulk():
+    """Удаляет несколько задач за одну транзакцию. В теле запроса json с ids - списком id задач
+    или id_range - диапазоном {"from_id": .., "to_id": ..}"""
+    try:
+        request_body = BulkTasksRequestBody.parse_obj(request.get_json(silent=True) or {})
+    except ValidationError as e:
+        return Response(status=400, response=e.json())
+    task_ids = request_body.task_ids
+    return json_response(bulk_result(task_ids, Task.delete_many(task_ids)))
+
+
+@app.route('/api/v1/tasks/status-events', methods=['POST'])
+def enqueue_status_events():
+    """Принимает события смены статуса json списком вида [{"task_id": .., "status": ..}, ..] и сразу отвечает 202.
+    События записываются в бд пачками в фоновом потоке, для каждой задачи записывается только последний статус
+    из пачки, события для несуществующих задач пропускаются. Глубина очереди и время записи - в GET /metrics"""
+    try:
+        events = StatusEventsRequestBody.parse_obj(request.get_json(silent=True)).events
+    except ValidationError as e:
+        return Response(status=400, response=e.json())
+    return json_response({'accepted': len(events), 'queue_depth': status_queue.put(events)}, status=202)
+
+
+def if_match_versions(task_id: int) -> Optional[List[int]]:
+    """Версии задачи из заголовка If-Match. None, если заголовка нет или в нем *, тогда версия не проверяется"""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    # If-Match сравнивает ETag'и строго, слабые не подходят
+    return Task.versions_from_etags(task_id, request.if_match.as_set())
 
 
+# Без слеша тоже обработаем сразу, а не перенаправлением 308: лишний запрос, а gunicorn закрывает соединение,
+# не прочитав тело запроса, и клиент может не успеть повторить запрос по новому адресу
+@app.route('/api/v1/tasks', methods=['PUT'])
 @app.route('/api/v1/tasks/', methods=['PUT'])
 def update_task():
     """Обновляет контент и/или статус задачи, необходимо в теле запроса передать task_id
-    и атрибут(ы) со значением, которое необоходимо обновить"""
+    и атрибут(ы) со значением, которое необоходимо обновить. Вернет ETag новой версии задачи.
+    Если в If-Match передан ETag задачи, а задачу с тех пор уже изменили, то вернет 409 и ETag текущей версии"""
     # Провалидируем тело запроса, если что-то не так, то вернем ошибку 400
     try:
         request_body = dict(UpdateTaskRequestBody(**request.form))
     except ValidationError as e:
         return Response(status=400, response=e.json())
-    # Провалидируем id задачи, если такой задачи нет, то вернем ошибку 404
+    # Обновим атрибуты задачи одним запросом, если такой задачи нет, то вернем ошибку 404
     task_id = request_body.get('task_id')
     try:
-        task = Task(task_id)
-    except ValueError:
+        task = Task.update(task_id, content=request_body.get('content'), current_status=request_body.get('status'),
+                           versions=if_match_versions(task_id))
+    except VersionConflict as e:
+        response = Response(status=409, response=f'Task with id {task_id} was modified, current ETag is "{e.etag}"')
+        response.set_etag(e.etag)
+        return response
+    if task is None:
         return Response(status=404, response=f'Task with id {task_id} NOT FOUND')
-    # Обновим атрибуты задачи
-    if request_body.get('content') is not None:
-        task.content = request_body.get('content')
-    if request_body.get('status') is not None:
-        task.current_status = request_body.get('status')
-    return Response(status=200)
+    response = Response(status=200)
+    response.set_etag(task.etag)
+    return response
 
 
 if __name__ == '__main__':
     # Закроем пул соединений после завершения работы программы
     atexit.register(close_connection_pool)
-    app.run()
+    # atexit вызывает функции в обратном порядке, поэтому очередь статусов запишется в бд до закрытия пула
+    atexit.register(status_queue.stop)
+    apply_migrations()
+    app.run(threaded=True)
@@ -0,0 +1,66 @@
+from threading import Lock
+from time import monotonic
+from typing import Iterable, Optional, Tuple
+from app import queries
+from app.connectdb import connect_db
+from app.metrics import timed
+from config import Config
+
+
+class TableSchema:
+    """Реестр колонок таблицы. Имена колонок загружаются один раз через общий пул подключений, кэшируются
+    и перечитываются по вызову refresh() или после истечения ttl секунд"""
+
+    def __init__(self, table_name: str, ttl: float = Config.schema_ttl):
+        self.table_name = table_name
+        self.ttl = ttl
+        self._column_names: Optional[Tuple[str, ...]] = None
+        self._loaded_at = 0.0
+        self._lock = Lock()
+
+    def _is_expired(self) -> bool:
+        return self._column_names is None or monotonic() - self._loaded_at > self.ttl
+
+    @property
+    def column_names(self) -> Tuple[str, ...]:
+        """Возвращает имена колонок таблицы в том порядке, в котором они расположены в таблице"""
+        if self._is_expired():
+            with self._lock:
+                # Пока ждали блокировку, колонки мог уже перечитать другой поток
+                if self._is_expired():
+                    with timed('schema'):
+                        self._column_names = self._load_column_names()
+                    self._loaded_at = monotonic()
+        return self._column_names
+
+    def refresh(self) -> None:
+        """Сбрасывает кэш, имена колонок будут перечитаны из бд при следующем обращении"""
+        with self._lock:
+            self._column_names = None
+
+    def set_column_names(self, column_names: Iterable[str]) -> None:
+        """Запоминает имена колонок, загруженные не через общий пул, например через asyncpg в app.asgi.
+        Отсчет ttl начинается заново"""
+        with self._lock:
+            self._column_names = tuple(column_names)
+            self._loaded_at = monotonic()
+
+    @connect_db
+    def _load_column_names(self, cursor) -> Tuple[str, ...]:
+        queries.SELECT_COLUMN_NAMES.execute(cursor, table_name=self.table_name)
+        return tuple(row[0] for row in cursor.fetchall())
+
+    def columns_of(self, cursor) -> Tuple[str, ...]:
+        """Возвращает имена колонок результата последнего запроса курсора.
+        Если cursor.description недоступен, то вернет закэшированные имена колонок таблицы"""
+        if cursor is not None and cursor.description is not None:
+            return tuple(column.name for column in cursor.description)
+        return self.column_names
+
+    def row_to_dict(self, row, cursor=None) -> dict:
+        """Соединяет имена колонок и значения строки в словарь {колонка: значение}"""
+        return dict(zip(self.columns_of(cursor), row))
+
+
+# Схема таблицы с задачами, общая для всего приложения
+tasks_schema = TableSchema(Config.tasks_table_name)
@@ -0,0 +1,46 @@
+import json
+from datetime import date, datetime
+from enum import Enum
+from typing import Any, Iterable, Iterator
+from flask import Response
+from app.metrics import timed
+
+# orjson - необязательная зависимость. Если она установлена, то json собирается ей, иначе стандартным модулем json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def _default(value: Any) -> Any:
+    """Приводит к json-совместимому виду значения, которые не умеет сериализовать стандартный модуль json"""
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(obj: Any) -> bytes:
+    """Сериализует объект в json. Даты и время - в ISO 8601, Enum (например Statuses) - в их значения,
+    нестроковые ключи словарей (например id задач) - в строки"""
+    if orjson is not None:
+        # date, datetime и Enum orjson сериализует сам, без вызова _default
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def iter_ndjson(objects: Iterable[Any]) -> Iterator[bytes]:
+    """Построчно сериализует объекты в NDJSON, не собирая весь ответ в памяти"""
+    for obj in objects:
+        yield dumps(obj) + b'\n'
+
+
+def json_response(obj: Any, status: int = 200) -> Response:
+    """Возвращает ответ с сериализованным в json объектом"""
+    with timed('serialize'):
+        body = dumps(obj)
+    return Response(body, status=status, mimetype=JSON_MIMETYPE)
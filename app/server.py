@@ -0,0 +1,70 @@
+"""Боевой запуск app.sca в нескольких процессах через gunicorn: web_workers воркеров по web_threads потоков.
+Пул подключений каждого воркера создается лениво уже после fork (app.connectdb.get_pool), а его размер считается так,
+чтобы все воркеры вместе открыли не больше db_connection_budget подключений к бд.
+Миграции применяются один раз в главном процессе до запуска воркеров. При остановке (SIGTERM) воркеры дорабатывают
+запросы, записывают очередь статусов и закрывают свои подключения.
+Запуск из корня репозитория: python -m app.server, настройки - переменные окружения из config.py"""
+from gunicorn.app.base import BaseApplication
+from app.connectdb import close_connection_pool
+from app.migrations import apply_migrations
+from app.status_queue import status_queue
+from app.task import tasks_cache
+from config import Config
+
+
+def pool_size_per_worker(workers: int, threads: int, budget: int) -> int:
+    """Размер пула одного воркера: по подключению на каждый поток запросов и одно на поток очереди статусов,
+    но не больше доли воркера в бюджете подключений"""
+    if budget < workers:
+        raise ValueError(f'db_connection_budget {budget} is less than web_workers {workers}, '
+                         f'every worker needs at least one connection')
+    return min(threads + 1, budget // workers)
+
+
+def on_starting(server) -> None:
+    """Главный процесс: применяет миграции и закрывает свои подключения, чтобы воркеры не унаследовали их при fork"""
+    apply_migrations()
+    close_connection_pool()
+    server.log.info('%d workers x %d threads, %d database connections per worker, %d of %d in total',
+                    Config.web_workers, Config.web_threads, Config.db_pool_maxconn,
+                    Config.web_workers * Config.db_pool_maxconn, Config.db_connection_budget)
+
+
+def worker_exit(server, worker) -> None:
+    """Воркер после остановки: записывает очередь статусов, пока пул еще открыт, и закрывает подключения"""
+    status_queue.stop(Config.web_graceful_timeout)
+    close_connection_pool()
+
+
+class TasksApplication(BaseApplication):
+    """gunicorn приложение с настройками из Config вместо командной строки"""
+
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app.sca import app
+        return app
+
+
+def main() -> None:
+    Config.db_pool_maxconn = pool_size_per_worker(Config.web_workers, Config.web_threads, Config.db_connection_budget)
+    tasks_cache.maxsize = Config.web_task_cache_size
+    TasksApplication({'bind': Config.web_bind,
+                      'workers': Config.web_workers,
+                      'threads': Config.web_threads,
+                      'worker_class': 'gthread',
+                      'graceful_timeout': Config.web_graceful_timeout,
+                      # Приложение импортируется один раз в главном процессе, воркеры получают его через fork
+                      'preload_app': True,
+                      'on_starting': on_starting,
+                      'worker_exit': worker_exit}).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Проверка и починка счетчиков задач по статусам, которые поддерживают триггеры миграции status counters.
+Запуск из корня репозитория: python -m app.status_counts [--repair]"""
+import argparse
+import sys
+from typing import Dict, Tuple
+from app.connectdb import connect_db_in_transaction, close_connection_pool
+from config import Config
+
+table = Config.tasks_table_name
+
+
+@connect_db_in_transaction
+def check_status_counts(repair: bool = False, cursor=None) -> Dict[str, Tuple[int, int]]:
+    """Пересчитывает задачи по статусам в самой таблице и сравнивает со счетчиками.
+    Возвращает расхождения {статус: (значение счетчика, реальное количество задач)}, задачи без статуса под ключом ''.
+    Если repair=True, то дописывает дельты, которые исправляют счетчики, и сворачивает все дельты"""
+    if repair:
+        # Пока идет пересчет и починка, никто не должен менять задачи, иначе счетчики снова разойдутся
+        cursor.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE;")
+    # Счетчики и задачи читаются одним запросом, то есть из одного снимка данных
+    cursor.execute(f"""SELECT status, coalesce(counts.count, 0), coalesce(actual.count, 0)
+                       FROM (SELECT status, sum(count)::bigint AS count FROM {table}_status_counts GROUP BY status)
+                           AS counts
+                       FULL JOIN (SELECT coalesce(current_status, '') AS status, count(*) FROM {table} GROUP BY 1)
+                           AS actual USING (status)
+                       WHERE coalesce(counts.count, 0) <> coalesce(actual.count, 0);""")
+    mismatches = {status: (counted, actual) for status, counted, actual in cursor.fetchall()}
+    if repair and mismatches:
+        cursor.execute(f"INSERT INTO {table}_status_counts (status, count) "
+                       f"SELECT * FROM unnest(%s::varchar[], %s::bigint[]);",
+                       (list(mismatches), [actual - counted for counted, actual in mismatches.values()]))
+        cursor.execute(f"SELECT {table}_compact_status_counts();")
+    return mismatches
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Check task status counters against the tasks table')
+    parser.add_argument('--repair', action='store_true', help='correct wrong counters with recomputed values')
+    args = parser.parse_args()
+    try:
+        mismatches = check_status_counts(repair=args.repair)
+    finally:
+        close_connection_pool()
+    if not mismatches:
+        print(f'Status counters of {table} are consistent')
+        return 0
+    for status, (counted, actual) in sorted(mismatches.items()):
+        print(f'{status or "<no status>"}: counter {counted}, actual {actual}')
+    if args.repair:
+        print(f'Repaired {len(mismatches)} counters')
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
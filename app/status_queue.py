@@ -0,0 +1,152 @@
+import logging
+from datetime import date
+from threading import Condition, Thread
+from time import monotonic, perf_counter
+from typing import Dict, Iterable, List, Optional, Tuple
+from app import queries
+from app.connectdb import connect_db_in_transaction
+from app.task import tasks_cache
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class StatusQueue:
+    """Очередь событий смены статуса задач. События копятся в памяти, для каждой задачи остается только последний
+    статус, а фоновый поток записывает их пачками: одним UPDATE на пачку через interval секунд после первого
+    события или сразу, как только накопится batch_size задач"""
+
+    def __init__(self, interval: float = Config.status_queue_interval,
+                 batch_size: int = Config.status_queue_batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        # {task_id: последний статус}, словарь сохраняет порядок поступления задач
+        self._pending: Dict[int, str] = {}
+        self._changed = Condition()
+        self._thread: Optional[Thread] = None
+        self._stopping = False
+        self.received = 0
+        self.coalesced = 0
+        self.written = 0
+        self.missing = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.total_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.last_flush_time = 0.0
+
+    def put(self, events: Iterable[Tuple[int, str]]) -> int:
+        """Добавляет события (task_id, статус) в очередь и возвращает глубину очереди.
+        Фоновый поток запускается при первом событии"""
+        with self._changed:
+            if self._stopping:
+                raise RuntimeError('Status queue is stopped')
+            was_empty = not self._pending
+            for task_id, status in events:
+                self.received += 1
+                if task_id in self._pending:
+                    self.coalesced += 1
+                self._pending[task_id] = status
+            if self._thread is None:
+                self._start()
+            if was_empty or len(self._pending) >= self.batch_size:
+                self._changed.notify()
+            return len(self._pending)
+
+    def _start(self) -> None:
+        self._thread = Thread(target=self._run, name='status-queue', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._changed:
+                while not self._pending and not self._stopping:
+                    self._changed.wait()
+                # Подождем еще немного, чтобы собрать пачку побольше
+                deadline = monotonic() + self.interval
+                while len(self._pending) < self.batch_size and not self._stopping:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+                stopping = self._stopping
+            self.flush()
+            if stopping:
+                return
+
+    def flush(self) -> int:
+        """Записывает все накопленные события в бд в одной транзакции, возвращает количество обновленных задач.
+        Если запись не удалась, то события возвращаются в очередь, но не перетирают более новые статусы"""
+        batch = self._take()
+        if not batch:
+            return 0
+        started_at = perf_counter()
+        try:
+            updated = self._write(list(batch), list(batch.values()))
+        except Exception:
+            self._requeue(batch)
+            return 0
+        self._record(batch, updated, perf_counter() - started_at)
+        return updated
+
+    def _take(self) -> Dict[int, str]:
+        with self._changed:
+            batch, self._pending = self._pending, {}
+        return batch
+
+    def _requeue(self, batch: Dict[int, str]) -> None:
+        logger.exception('Failed to write %d status events', len(batch))
+        with self._changed:
+            self.failed_flushes += 1
+            for task_id, status in batch.items():
+                self._pending.setdefault(task_id, status)
+
+    def _record(self, batch: Dict[int, str], updated: int, flush_time: float) -> None:
+        # Инвалидируем кэш после коммита, как и при обычном массовом обновлении
+        tasks_cache.invalidate_many(list(batch))
+        with self._changed:
+            self.flushes += 1
+            self.written += updated
+            self.missing += len(batch) - updated
+            self.last_flush_time = flush_time
+            self.total_flush_time += flush_time
+            self.max_flush_time = max(self.max_flush_time, flush_time)
+
+    @connect_db_in_transaction
+    def _write(self, task_ids: List[int], statuses: List[str], cursor=None) -> int:
+        """Одним UPDATE на каждые batch_size задач записывает статусы, возвращает количество обновленных задач"""
+        updated = 0
+        today = date.today()
+        for task_ids_chunk, statuses_chunk in zip(queries.chunks(task_ids, self.batch_size),
+                                                  queries.chunks(statuses, self.batch_size)):
+            queries.UPDATE_STATUSES.execute(cursor, task_ids=task_ids_chunk, statuses=statuses_chunk, today=today)
+            updated += cursor.rowcount
+        return updated
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Останавливает фоновый поток и записывает в бд все, что осталось в очереди"""
+        with self._changed:
+            self._stopping = True
+            self._changed.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        self.flush()
+
+    def stats(self) -> dict:
+        """Возвращает статистику очереди, время записи пачек в секундах"""
+        with self._changed:
+            return {'queue_depth': len(self._pending),
+                    'received': self.received,
+                    'coalesced': self.coalesced,
+                    'written': self.written,
+                    'missing': self.missing,
+                    'flushes': self.flushes,
+                    'failed_flushes': self.failed_flushes,
+                    'last_flush_time': self.last_flush_time,
+                    'avg_flush_time': self.total_flush_time / self.flushes if self.flushes else 0.0,
+                    'max_flush_time': self.max_flush_time}
+
+
+# Очередь событий смены статуса, общая для всего приложения
+status_queue = StatusQueue()
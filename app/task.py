@@ -1,8 +1,12 @@
 from datetime import date
 from enum import Enum
-from app.connectdb import connect_db
-from pydantic import BaseModel, root_validator
-from typing import Optional
+from app.connectdb import connect_db, connect_db_in_transaction, get_connection
+from app.schema import tasks_schema
+from app.cache import LRUCache
+from app import queries
+from pydantic import BaseModel, root_validator, validator, conint, conlist, constr
+from typing import Iterable, List, Optional, Sequence, Tuple
+from operator import attrgetter
 from config import Config
 from datetime import datetime
 
@@ -45,7 +49,196 @@ class CreateTaskRequestBody(BaseModel):
         extra = 'forbid'
 
 
+class CreateTasksBulkRequestBody(BaseModel):
+    """Валидирует тело запроса на создание нескольких задач: json список из тел запроса на создание одной задачи"""
+    __root__: conlist(CreateTaskRequestBody, min_items=1, max_items=Config.bulk_max_items)
+
+    @property
+    def contents(self) -> List[str]:
+        return [task.content for task in self.__root__]
+
+
+class StatusEvent(BaseModel):
+    """Событие смены статуса задачи"""
+    task_id: conint(ge=1)
+    status: Statuses
+
+    class Config:
+        extra = 'forbid'
+        use_enum_values = True
+
+
+class StatusEventsRequestBody(BaseModel):
+    """Валидирует тело запроса с событиями смены статуса: json список вида [{"task_id": .., "status": ..}, ..]"""
+    __root__: conlist(StatusEvent, min_items=1, max_items=Config.bulk_max_items)
+
+    @property
+    def events(self) -> List[Tuple[int, str]]:
+        return [(event.task_id, event.status) for event in self.__root__]
+
+
+class IdRange(BaseModel):
+    """Диапазон id задач, обе границы включительно"""
+    from_id: conint(ge=1)
+    to_id: conint(ge=1)
+
+    @root_validator(skip_on_failure=True)
+    def validate_range(cls, values):
+        if values['to_id'] < values['from_id']:
+            raise ValueError('to_id must be greater than or equal to from_id')
+        if values['to_id'] - values['from_id'] + 1 > Config.bulk_max_items:
+            raise ValueError(f'id_range must contain at most {Config.bulk_max_items} ids')
+        return values
+
+    class Config:
+        extra = 'forbid'
+
+
+class BulkTasksRequestBody(BaseModel):
+    """Валидирует тело запроса на массовое удаление задач. Нужно передать либо список ids, либо диапазон id_range"""
+    ids: Optional[conlist(conint(ge=1), min_items=1, max_items=Config.bulk_max_items)]
+    id_range: Optional[IdRange]
+
+    @root_validator
+    def validate_ids(cls, values):
+        if (values.get('ids') is None) == (values.get('id_range') is None):
+            raise ValueError('The request body should contain either ids or id_range')
+        return values
+
+    @property
+    def task_ids(self) -> List[int]:
+        """Возвращает отсортированный список уникальных id задач из ids или id_range"""
+        if self.ids is not None:
+            return sorted(set(self.ids))
+        return list(range(self.id_range.from_id, self.id_range.to_id + 1))
+
+    class Config:
+        extra = 'forbid'
+
+
+class BulkUpdateTasksRequestBody(BulkTasksRequestBody):
+    """Валидирует тело запроса на массовое обновление задач: ids или id_range и новые status и / или content"""
+    status: Optional[Statuses]
+    content: Optional[str]
+
+    @root_validator
+    def validate_changes(cls, values):
+        if values.get('status') is None and values.get('content') is None:
+            raise ValueError('PATCH request required also status and / or content')
+        return values
+
+    class Config:
+        extra = 'forbid'
+        use_enum_values = True
+
+
+class IncludeArchivedQueryParams(BaseModel):
+    """Валидирует параметры запроса на чтение задач: include_archived=1 - искать задачи и в архиве"""
+    include_archived: bool = False
+
+    class Config:
+        extra = 'forbid'
+
+
+class GetTasksQueryParams(IncludeArchivedQueryParams):
+    """Валидирует параметры запроса на получение страницы задач"""
+    # Сколько задач вернуть и после какого id начинать страницу
+    limit: conint(ge=1, le=Config.max_page_size) = Config.default_page_size
+    after_id: conint(ge=0) = 0
+    # Имена колонок через запятую, которые нужно вернуть. Если не переданы, то вернутся все колонки
+    fields: Optional[Tuple[str, ...]]
+    # Фильтры: статус, диапазон дат создания и дата, начиная с которой менялся статус
+    status: Optional[Statuses]
+    created_from: Optional[date]
+    created_to: Optional[date]
+    changed_since: Optional[date]
+
+    @validator('fields', pre=True)
+    def split_fields(cls, fields):
+        if isinstance(fields, str):
+            fields = tuple(field.strip() for field in fields.split(',') if field.strip())
+        return fields
+
+    # Оставляет только существующие колонки в порядке их расположения в таблице
+    @validator('fields')
+    def validate_fields(cls, fields):
+        if fields is None:
+            return fields
+        unknown_fields = set(fields) - set(tasks_schema.column_names)
+        if unknown_fields:
+            raise ValueError(f'Unknown fields: {", ".join(sorted(unknown_fields))}')
+        # id нужен всегда, по нему строится словарь с задачами и курсор следующей страницы
+        return tuple(column for column in tasks_schema.column_names if column == 'id' or column in fields)
+
+    @validator('created_to')
+    def validate_created_range(cls, created_to, values):
+        created_from = values.get('created_from')
+        if created_to is not None and created_from is not None and created_to < created_from:
+            raise ValueError('created_to must be greater than or equal to created_from')
+        return created_to
+
+    @property
+    def filters(self) -> dict:
+        """Переданные фильтры {имя фильтра: значение} для Task.get_tasks_page"""
+        return {name: getattr(self, name) for name in queries.TASK_FILTERS if getattr(self, name) is not None}
+
+    class Config:
+        extra = 'forbid'
+        use_enum_values = True
+
+
+class GetChangesQueryParams(BaseModel):
+    """Валидирует параметры запроса на получение страницы журнала изменений"""
+    # Позиция в журнале вида <xid>-<seq> из next_since предыдущей страницы, по умолчанию - с начала журнала
+    since: constr(regex=r'^\d+-\d+$') = '0-0'
+    limit: conint(ge=1, le=Config.max_page_size) = Config.default_page_size
+
+    class Config:
+        extra = 'forbid'
+
+
+class SearchTasksQueryParams(BaseModel):
+    """Валидирует параметры запроса на полнотекстовый поиск задач"""
+    q: constr(strip_whitespace=True, min_length=1, max_length=1000)
+    limit: conint(ge=1, le=Config.max_page_size) = Config.default_page_size
+    offset: conint(ge=0) = 0
+
+    class Config:
+        extra = 'forbid'
+
+
+class VersionConflict(Exception):
+    """Задачу уже изменили: ее версия в бд не совпала ни с одной из версий, которые прислал клиент"""
+
+    def __init__(self, task_id: int, version: int):
+        super().__init__(f'Task with id {task_id} has version {version}')
+        self.task_id = task_id
+        self.version = version
+
+    @property
+    def etag(self) -> str:
+        """ETag текущей версии задачи, такой же, как Task.etag"""
+        return f'{self.task_id}-{self.version}'
+
+
+# Кэш задач {task_id: словарь со строкой задачи из таблицы} для чтения отдельных задач
+tasks_cache = LRUCache(maxsize=Config.task_cache_size, ttl=Config.task_cache_ttl)
+
+
 class Task:
+    # Соответствие атрибутов инстанса и ключей словаря, который возвращает dict()
+    _fields = (('task_id', 'task_id'),
+               ('_content', 'content'),
+               ('date_of_creation', 'date_of_creation'),
+               ('last_change_status_date', 'last_change_status_date'),
+               ('_current_status', 'current_status'),
+               ('previous_status', 'previous_status'),
+               ('version', 'version'))
+    # Атрибуты хранятся в слотах, а не в __dict__ инстанса: так задача занимает меньше памяти
+    __slots__ = tuple(attribute for attribute, _ in _fields)
+    _dict_keys = tuple(key for _, key in _fields)
+    _get_attributes = attrgetter(*__slots__)
+
     @connect_db
     def __init__(self, **kwargs):
         """Если был передан task_id, то будет создан инстанс класса с заполнеными атрибутами из таблички с задачами.
@@ -54,56 +247,209 @@ class Task:
         cursor = kwargs.get('cursor')
         self.task_id = kwargs.get('task_id')
 
-        # Если не был передан task_id, то создадим новую задачу
+        # Если не был передан task_id, то создадим новую задачу без контента
         if self.task_id is None:
-            self.date_of_creation = datetime.now()
-            self._current_status = Statuses.new.value
-            # В таблице с задачами создаем новую запись с текущей датой и статусом для новой задачи
-            cursor.execute(f"INSERT INTO {Config.tasks_table_name} (date_of_creation, current_status) "
-                           f"VALUES ('{datetime.now()}', '{Statuses.new.value}');")
-            # Этот запрос вычисляет последний созданный id'шник в таблице с последовательностью id, он и будет task_id
-            cursor.execute(f"SELECT CURRVAL ('{Config.tasks_table_name + '_id_seq'}');")
-            self.task_id = cursor.fetchone()[0]
+            task_values = self._insert(cursor, content=None)
         # Если был передан task_id, то попытаемся найти такую задачу и установить атрибуты инстанса из бд
         else:
-            cursor.execute(f"SELECT * FROM {Config.tasks_table_name} WHERE id = {self.task_id};")
+            queries.SELECT_TASK.execute(cursor, task_id=self.task_id)
             # Если не нашлось, задачи с таким task_id, то в task_values будет None
             task_values = cursor.fetchone()
             # Если в task_values None, то задачи с таким task_id нет, вызовем исключение по этому поводу
             if task_values is None:
-                raise ValueError(f'Task with task_id = {task_id} not exist')
-            # Соеденим атрибуты задачи и имена колонок в словарь
-            column_names = Config.get_column_names()
-            task_dict = dict()
-            for key, value in zip(column_names, task_values):
-                task_dict.update({key[0]: value})
-
-            # Присвоим атрибутам инстанса значения из соответствующих ячейках в таблице с задачами,
-            # c именами колонок и содержимым ячеек
-            self._content = task_dict['content']
-            self.date_of_creation = task_dict['date_of_creation']
-            self.last_change_status_date = task_dict['last_change_status_date']
-            self._current_status = task_dict['current_status']
-            self.previous_status = task_dict['previous_status']
+                raise ValueError(f'Task with task_id = {self.task_id} not exist')
+        # Соеденим атрибуты задачи и имена колонок в словарь и присвоим их атрибутам инстанса
+        self._set_attributes(tasks_schema.row_to_dict(task_values, cursor))
+
+    @staticmethod
+    def _insert(cursor, content: Optional[str]) -> tuple:
+        """Одним запросом создает в таблице с задачами новую задачу со статусом Новая и текущей датой создания,
+        возвращает строку созданной задачи"""
+        queries.INSERT_TASK.execute(cursor, content=content, date_of_creation=datetime.now(),
+                                    current_status=Statuses.new.value)
+        return cursor.fetchone()
+
+    def _set_attributes(self, task_dict: dict) -> None:
+        """Присваивает атрибутам инстанса значения из словаря {имя колонки: значение} строки таблицы с задачами"""
+        self.task_id = task_dict['id']
+        self._content = task_dict['content']
+        self.date_of_creation = task_dict['date_of_creation']
+        self.last_change_status_date = task_dict['last_change_status_date']
+        self._current_status = task_dict['current_status']
+        self.previous_status = task_dict['previous_status']
+        self.version = task_dict.get('version')
+
+    @classmethod
+    @connect_db
+    def create(cls, content: str, cursor=None) -> 'Task':
+        """Создает в бд новую задачу с переданным контентом за один запрос и возвращает ее инстанс"""
+        task_dict = tasks_schema.row_to_dict(cls._insert(cursor, content), cursor)
+        tasks_cache.set(task_dict['id'], task_dict)
+        return cls._from_dict(task_dict)
+
+    @classmethod
+    def _from_dict(cls, task_dict: dict) -> 'Task':
+        """Создает инстанс задачи из словаря со строкой таблицы без запроса в бд"""
+        task = cls.__new__(cls)
+        task._set_attributes(task_dict)
+        return task
+
+    @staticmethod
+    @connect_db
+    def _load(task_id: int, cursor=None) -> Optional[dict]:
+        """Читает задачу из бд, возвращает словарь {имя колонки: значение} или None, если задачи нет"""
+        queries.SELECT_TASK.execute(cursor, task_id=task_id)
+        task_values = cursor.fetchone()
+        return None if task_values is None else tasks_schema.row_to_dict(task_values, cursor)
+
+    @classmethod
+    def get(cls, task_id: int, include_archived: bool = False) -> Optional['Task']:
+        """Возвращает задачу с id = task_id или None, если такой задачи нет.
+        Задача читается из кэша, в бд запрос идет только если задачи в кэше нет или запись в кэше устарела.
+        С include_archived задача ищется и в архиве, причем мимо кэша: задачи переносит в архив app.archive
+        из другого процесса, и закэшированная задача уже может быть в архиве"""
+        if include_archived:
+            task_dict = cls._load(task_id)
+            return cls.get_archived(task_id) if task_dict is None else cls._from_dict(task_dict)
+        task_dict = tasks_cache.get(task_id)
+        if task_dict is None:
+            generation = tasks_cache.generation
+            task_dict = cls._load(task_id)
+            if task_dict is None:
+                return None
+            tasks_cache.fill(task_id, task_dict, generation, task_dict['version'])
+        return cls._from_dict(task_dict)
+
+    @classmethod
+    def get_etag(cls, task_id: int, include_archived: bool = False) -> Optional[str]:
+        """Возвращает ETag задачи с id = task_id или None, если такой задачи нет, не читая саму задачу: версия берется
+        из кэша задач, а если ее там нет - из бд одним запросом версии по id. Так на If-None-Match можно ответить 304
+        без SELECT * и сериализации задачи. С include_archived, как и Task.get, идет мимо кэша и ищет и в архиве"""
+        task_dict = None if include_archived else tasks_cache.get(task_id)
+        version = cls._load_version(task_id, include_archived) if task_dict is None else task_dict['version']
+        return None if version is None else f'{task_id}-{version}'
+
+    @staticmethod
+    @connect_db
+    def _load_version(task_id: int, include_archived: bool = False, cursor=None) -> Optional[int]:
+        statement = queries.SELECT_ANY_TASK_VERSION if include_archived else queries.SELECT_TASK_VERSION
+        statement.execute(cursor, task_id=task_id)
+        version = cursor.fetchone()
+        return None if version is None else version[0]
+
+    @classmethod
+    @connect_db
+    def get_archived(cls, task_id: int, cursor=None) -> Optional['Task']:
+        """Возвращает задачу с id = task_id из архива или None, если ее там нет"""
+        queries.SELECT_ARCHIVED_TASK.execute(cursor, task_id=task_id)
+        task_values = cursor.fetchone()
+        return None if task_values is None else cls._from_dict(tasks_schema.row_to_dict(task_values, cursor))
 
     def dict(self):
         """Возвращает атрибуты задачи в виде словаря {атрибут: значение}"""
+        # Ключи заранее посчитаны без _ в начале имени, а значения всех атрибутов достаются одним вызовом attrgetter
+        return dict(zip(self._dict_keys, self._get_attributes(self)))
+
+    @staticmethod
+    def rows_to_dict(column_names: Sequence[str], rows: Sequence[tuple]) -> dict:
+        """Соединяет имена колонок и строки таблицы в словарь {task_id1: {колонка1: значение1, ..}, task_id2:..}"""
+        id_index = column_names.index('id')
+        return {row[id_index]: dict(zip(column_names, row)) for row in rows}
+
+    def delete(self) -> None:
+        """Удаляет задачу из таблицы с задачами"""
+        self.delete_by_id(self.task_id)
+
+    @staticmethod
+    @connect_db
+    def delete_by_id(task_id: int, cursor=None) -> bool:
+        """Удаляет задачу с id = task_id без предварительного чтения, вернет False, если такой задачи не было"""
+        queries.DELETE_TASK.execute(cursor, task_id=task_id)
+        tasks_cache.invalidate(task_id)
+        return cursor.fetchone() is not None
 
-        task_attributes = self.__dict__
-        # В силу особенностей реализации модели задачи, некоторые атрибуты имеют _ в начале имени атрибута
-        # В цикле пройдемся по всем ключам словаря с атрибутами и заменим ключи с _ на такие же, но без _
-        updated_task_attributes = task_attributes.copy()
-        for key in task_attributes:
-            if str(key)[0] == '_':
-                updated_task_attributes[str(key)[1:]] = updated_task_attributes.pop(key)
-        return updated_task_attributes
+    @classmethod
+    def delete_many(cls, task_ids: List[int]) -> List[int]:
+        """Удаляет в одной транзакции задачи с переданными id, возвращает отсортированный список id удаленных задач"""
+        deleted_ids = cls._delete_many(task_ids)
+        # Инвалидируем кэш после коммита, чтобы параллельное чтение не положило в кэш еще не удаленные задачи
+        tasks_cache.invalidate_many(task_ids)
+        return deleted_ids
 
+    @staticmethod
+    @connect_db_in_transaction
+    def _delete_many(task_ids: List[int], cursor=None) -> List[int]:
+        queries.DELETE_TASKS.execute(cursor, task_ids=task_ids)
+        return sorted(row[0] for row in cursor.fetchall())
+
+    @staticmethod
+    def _collect_changes(content: Optional[str], current_status: Optional[str]) -> dict:
+        """Возвращает словарь {атрибут: значение} только из тех атрибутов, которые нужно обновить (не None)"""
+        changes = {key: value for key, value in (('content', content), ('current_status', current_status))
+                   if value is not None}
+        if not changes:
+            raise ValueError('Nothing to update, content and / or current_status required')
+        return changes
+
+    @staticmethod
+    def versions_from_etags(task_id: int, etags: Iterable[str]) -> List[int]:
+        """Достает версии задачи из ее ETag'ов (например из If-Match). ETag'и других задач и в другом формате пропускает"""
+        prefix = f'{task_id}-'
+        return [int(etag[len(prefix):]) for etag in etags if etag.startswith(prefix) and etag[len(prefix):].isdigit()]
 
+    @classmethod
+    def _update(cls, cursor, task_id: int, changes: dict, versions: Optional[List[int]] = None) -> Optional[tuple]:
+        """Одним запросом UPDATE ... RETURNING * записывает в бд измененные атрибуты задачи {атрибут: значение}.
+        Возвращает обновленную строку таблицы или None, если задачи с таким task_id нет. Если значения атрибутов
+        те же, что и в бд, то строка не меняется (ни версия, ни журнал изменений) и возвращается как есть.
+        Если переданы versions, то задача обновится, только если ее текущая версия одна из них,
+        иначе будет выброшен VersionConflict. Блокировки между чтением и записью задачи не нужны"""
+        queries.update_task(changes, versions is not None).execute(cursor, task_id=task_id, today=date.today(),
+                                                                   versions=versions, **changes)
+        task_values = cursor.fetchone()
+        if task_values is None:
+            # Не обновилась: задачи нет, у нее другая версия или значения не изменились, лишний запрос только тут
+            queries.SELECT_TASK.execute(cursor, task_id=task_id)
+            task_values = cursor.fetchone()
+            if task_values is None:
+                tasks_cache.invalidate(task_id)
+                return None
+            task_dict = tasks_schema.row_to_dict(task_values, cursor)
+            if versions is not None and task_dict['version'] not in versions:
+                raise VersionConflict(task_id, task_dict['version'])
+        else:
+            task_dict = tasks_schema.row_to_dict(task_values, cursor)
+        tasks_cache.set_if_newer(task_id, task_dict, task_dict['version'])
+        return task_values
 
+    @classmethod
     @connect_db
-    def delete(self, cursor) -> None:
-        """Удаляет задачу из таблицы с задачами"""
-        cursor.execute(f"DELETE FROM {Config.tasks_table_name} WHERE id = {self.task_id};")
+    def update(cls, task_id: int, content: Optional[str] = None, current_status: Optional[str] = None,
+               versions: Optional[List[int]] = None, cursor=None) -> Optional['Task']:
+        """Обновляет переданные (не None) атрибуты задачи одним запросом и возвращает инстанс обновленной задачи.
+        Если статус отличается от текущего, то текущий станет previous_status и обновится last_change_status_date.
+        Если задачи с таким task_id нет, то вернет None. Если переданы versions (версии из If-Match),
+        а версия задачи в бд уже другая, то выбросит VersionConflict"""
+        task_values = cls._update(cursor, task_id, cls._collect_changes(content, current_status), versions)
+        if task_values is None:
+            return None
+        return cls._from_dict(tasks_schema.row_to_dict(task_values, cursor))
+
+    @classmethod
+    def update_many(cls, task_ids: List[int], content: Optional[str] = None,
+                    current_status: Optional[str] = None) -> List[int]:
+        """Обновляет в одной транзакции переданные атрибуты у задач с переданными id по тем же правилам, что и update.
+        Возвращает отсортированный список id обновленных задач"""
+        updated_ids = cls._update_many(task_ids, cls._collect_changes(content, current_status))
+        # Инвалидируем кэш после коммита, чтобы параллельное чтение не положило в кэш старые версии задач
+        tasks_cache.invalidate_many(task_ids)
+        return updated_ids
+
+    @classmethod
+    @connect_db_in_transaction
+    def _update_many(cls, task_ids: List[int], changes: dict, cursor=None) -> List[int]:
+        queries.update_tasks(changes).execute(cursor, task_ids=task_ids, today=date.today(), **changes)
+        return sorted(row[0] for row in cursor.fetchall())
 
     @property
     def content(self):
@@ -114,7 +460,9 @@ class Task:
     def content(self, content, cursor):
         """После обновления атрибута сразу же обновит его в таблице с задачами"""
         self._content = content
-        cursor.execute(f"UPDATE {Config.tasks_table_name} SET content = '{self._content}' WHERE id = '{self.task_id}';")
+        task_values = self._update(cursor, self.task_id, {'content': content})
+        if task_values is not None:
+            self._set_attributes(tasks_schema.row_to_dict(task_values, cursor))
 
     @property
     def current_status(self):
@@ -124,37 +472,140 @@ class Task:
     @connect_db
     def current_status(self, new_status, cursor):
         """
-        Заменяет текущий статус на новый, если они отличаются. Текущий становится становится previous_status и в бд тоже
+        Заменяет текущий статус на новый, если они отличаются. Текущий становится становится previous_status
+        и в бд тоже, а если статус тот же, то задача в бд не меняется
         """
-        if self._current_status != new_status:
-            self.previous_status = self._current_status
-            self._current_status = new_status
-            cursor.execute(f"UPDATE {Config.tasks_table_name} "
-                           f"SET "
-                           f"current_status = '{self._current_status}', "
-                           f"previous_status = '{self.previous_status}', "
-                           f"last_change_status_date = '{date.today()}' "
-                           f"WHERE id = '{self.task_id}';")
+        self._current_status = new_status
+        task_values = self._update(cursor, self.task_id, {'current_status': new_status})
+        if task_values is not None:
+            self._set_attributes(tasks_schema.row_to_dict(task_values, cursor))
+
+    @property
+    def etag(self) -> str:
+        """Строгий ETag задачи, меняется при каждом обновлении строки в бд"""
+        return f'{self.task_id}-{self.version}'
 
     @staticmethod
     @connect_db
-    def get_all_tasks_as_dict(cursor):
-        """Возвращает словарь {task_id1: {attr1: value1, attr2: value2,..}, task_id2:..}"""
+    def get_change_counter(cursor=None) -> int:
+        """Возвращает счетчик изменений таблицы с задачами, который увеличивается при каждой записи в таблицу"""
+        queries.SELECT_CHANGE_COUNTER.execute(cursor)
+        return cursor.fetchone()[0]
 
-        # Получим все задачи из таблицы, отсортированные по id
-        cursor.execute(f"SELECT * FROM {Config.tasks_table_name} ORDER BY id;")
+    @staticmethod
+    @connect_db
+    def get_tasks_page(limit: int, after_id: int = 0, fields: Optional[Tuple[str, ...]] = None,
+                       filters: Optional[dict] = None, include_archived: bool = False, cursor=None):
+        """Возвращает страницу задач с id > after_id в виде словаря {task_id1: {attr1: value1, ..}, task_id2:..}
+        и id последней задачи на странице, если за ней есть еще задачи, иначе None.
+        fields - имена колонок, которые нужно выбрать, должны быть провалидированы через GetTasksQueryParams,
+        filters - значения фильтров {имя фильтра из queries.TASK_FILTERS: значение},
+        include_archived - добавить к активным задачам задачи из архива"""
+        filters = filters or {}
+        # Получим на одну задачу больше, чем нужно, чтобы узнать, есть ли следующая страница
+        queries.select_tasks_page(fields, filters, include_archived).execute(cursor, after_id=after_id,
+                                                                             limit=limit + 1, **filters)
         raw_tasks = cursor.fetchall()
+        has_next_page = len(raw_tasks) > limit
+        raw_tasks = raw_tasks[:limit]
+
+        column_names = tasks_schema.columns_of(cursor)
+        next_after_id = raw_tasks[-1][column_names.index('id')] if has_next_page else None
+        return Task.rows_to_dict(column_names, raw_tasks), next_after_id
 
-        column_names = Config.get_column_names()
-        tasks_dict = dict()
+    @staticmethod
+    @connect_db
+    def get_changes(since: str = '0-0', limit: int = Config.default_page_size, cursor=None) -> Tuple[List[dict], str]:
+        """Возвращает страницу журнала изменений после позиции since и позицию, с которой читать следующую страницу.
+        since - позиция вида <xid>-<seq>, должна быть провалидирована через GetChangesQueryParams"""
+        since_xid, since_seq = since.split('-')
+        queries.SELECT_CHANGES.execute(cursor, since_xid=since_xid, since_seq=int(since_seq), limit=limit)
+        return Task.changes_page(tasks_schema.columns_of(cursor), cursor.fetchall(), since)
+
+    @staticmethod
+    @connect_db
+    def search(q: str, limit: int = Config.default_page_size, offset: int = 0,
+               cursor=None) -> Tuple[List[dict], Optional[int], bool]:
+        """Возвращает страницу задач, найденных полнотекстовым поиском по content, в порядке убывания релевантности
+        (ключ rank в словаре задачи), offset следующей страницы, если за ней есть еще задачи, иначе None,
+        и truncated: True, если совпадений больше Config.search_max_matches и ранжированы только самые новые из них"""
+        queries.SEARCH_TASKS.execute(cursor, q=q, limit=limit + 1, offset=offset,
+                                     max_matches=Config.search_max_matches)
+        return Task.search_page(tasks_schema.columns_of(cursor), cursor.fetchall(), limit, offset)
+
+    @staticmethod
+    def search_page(column_names: Sequence[str], rows: Sequence[tuple], limit: int,
+                    offset: int) -> Tuple[List[dict], Optional[int], bool]:
+        """Собирает из limit + 1 строк queries.SEARCH_TASKS страницу задач, offset следующей страницы и truncated.
+        truncated - последняя колонка, одинаковая во всех строках"""
+        next_offset = offset + limit if len(rows) > limit else None
+        truncated = bool(rows) and rows[0][-1]
+        return [dict(zip(column_names[:-1], row[:-1])) for row in rows[:limit]], next_offset, truncated
+
+    @staticmethod
+    def changes_page(column_names: Sequence[str], rows: Sequence[tuple], since: str) -> Tuple[List[dict], str]:
+        """Собирает из строк queries.SELECT_CHANGES список изменений с текущим состоянием задачи (None, если задачи
+        уже нет) и позицию последнего изменения. Если изменений нет, то позиция остается since"""
+        task_columns = column_names[5:]
+        changes = [{'seq': seq, 'task_id': task_id, 'operation': operation, 'changed_at': changed_at,
+                    'task': dict(zip(task_columns, task)) if task[0] is not None else None}
+                   for seq, _, task_id, operation, changed_at, *task in rows]
+        if rows:
+            since = f'{rows[-1][1]}-{rows[-1][0]}'
+        return changes, since
+
+    @staticmethod
+    @connect_db
+    def get_status_counts(cursor=None) -> dict:
+        """Возвращает количество всех задач и количество задач в каждом статусе из таблицы счетчиков,
+        не считая задачи в самой таблице. Запрос суммирует несколько строк дельт на статус, а не всю таблицу задач"""
+        queries.SELECT_STATUS_COUNTS.execute(cursor)
+        return Task.status_counts_to_dict(cursor.fetchall())
 
-        # Для каждой задачи соединим названия колонок и атрибуты задачи в словарь
-        for i in range(len(raw_tasks)):
-            current_task = raw_tasks[i]
-            current_task_dict = dict()
-            for col_name, value in zip(column_names, current_task):
-                current_task_dict.update({col_name[0]: value})
-            # Добавим словарь текущей задачи к общему словарю со всеми задачами
-            tasks_dict.update({current_task_dict.get('id'): current_task_dict})
+    @staticmethod
+    def status_counts_to_dict(rows: Sequence[tuple]) -> dict:
+        """Собирает из строк (статус, количество) словарь {"total": .., "by_status": {статус: ..}}.
+        Задачи без статуса (ключ '') учитываются только в total"""
+        by_status = {status.value: 0 for status in Statuses}
+        total = 0
+        for status, count in rows:
+            total += count
+            if status:
+                by_status[status] = count
+        return {'total': total, 'by_status': by_status}
+
+    @staticmethod
+    @connect_db_in_transaction
+    def create_many(contents: List[str], cursor=None) -> List[int]:
+        """Создает в одной транзакции по новой задаче на каждый content, возвращает id созданных задач в том же порядке.
+        Задачи вставляются одним запросом на каждые Config.bulk_page_size штук"""
+        date_of_creation = datetime.now()
+        created_ids = []
+        for contents_chunk in queries.chunks(contents, Config.bulk_page_size):
+            queries.INSERT_TASKS.execute(cursor, contents=contents_chunk, date_of_creation=date_of_creation,
+                                         current_status=Statuses.new.value)
+            created_ids += [row[0] for row in cursor.fetchall()]
+        return created_ids
 
-        return tasks_dict
+    @staticmethod
+    def iter_all_tasks(itersize: int = Config.export_itersize, include_archived: bool = False):
+        """Генератор, который по одной отдает все задачи из таблицы в виде словарей {attr1: value1, ..}, отсортированные по id.
+        Задачи читаются через серверный курсор пачками по itersize штук, поэтому в памяти не держится вся таблица.
+        include_archived - отдать вместе с активными задачами задачи из архива"""
+        with get_connection() as conn:
+            # Именованный (серверный) курсор работает только внутри транзакции
+            conn.autocommit = False
+            try:
+                with conn.cursor(name='export_tasks') as cursor:
+                    cursor.itersize = itersize
+                    # Серверный курсор объявляется через DECLARE, который не умеет выполнять подготовленные запросы
+                    cursor.execute(f"SELECT * FROM {queries.tasks_source(include_archived)} ORDER BY id;")
+                    column_names = None
+                    for task_values in cursor:
+                        # У серверного курсора description появляется только после получения первой пачки строк
+                        if column_names is None:
+                            column_names = tasks_schema.columns_of(cursor)
+                        yield dict(zip(column_names, task_values))
+            finally:
+                # Транзакция только читала данные, поэтому просто закроем ее
+                conn.rollback()
@@ -0,0 +1,54 @@
+"""Бенчмарк накладных расходов app.metrics: один и тот же запрос к Flask приложению без метрик и с метриками.
+Чтобы мерить только инструментирование, обработчик не ходит в бд, а записывает столько же этапов,
+сколько типичный GET /api/v1/tasks/<id>: ожидание пула, SQL и сериализацию.
+Запуск из корня репозитория: python -m benchmarks.bench_metrics [количество запросов]"""
+import sys
+from time import perf_counter
+from flask import Flask
+from app import metrics
+from app.serializers import json_response
+
+
+def make_app(with_metrics: bool) -> Flask:
+    app = Flask(__name__)
+    if with_metrics:
+        metrics.init_app(app)
+
+    @app.route('/api/v1/tasks/<int:task_id>')
+    def get_task(task_id):
+        metrics.record_timing('pool', 0.0001)
+        metrics.record_timing('sql', 0.001)
+        return json_response({'task_id': task_id})
+    return app
+
+
+def measure(app: Flask, count: int) -> float:
+    """Возвращает время одного запроса в секундах"""
+    client = app.test_client()
+    started_at = perf_counter()
+    for task_id in range(count):
+        client.get(f'/api/v1/tasks/{task_id}')
+    return (perf_counter() - started_at) / count
+
+
+def main(count: int, rounds: int = 5) -> None:
+    apps = {'metrics disabled': make_app(False), 'metrics enabled': make_app(True)}
+    for app in apps.values():
+        measure(app, 100)
+    # Приложения меряются по очереди несколько раундов, чтобы шум машины одинаково влиял на оба, берется лучший раунд
+    results = dict.fromkeys(apps, float('inf'))
+    for _ in range(rounds):
+        for name, app in apps.items():
+            results[name] = min(results[name], measure(app, count))
+    print(f'{count} requests x {rounds} rounds through flask test client')
+    for name, per_request in results.items():
+        print(f'{name:<30} {per_request * 1e6:>10.1f} us/request')
+    overhead = results['metrics enabled'] - results['metrics disabled']
+    print(f'{"overhead":<30} {overhead * 1e6:>10.1f} us/request')
+    started_at = perf_counter()
+    metrics.render()
+    print(f'{"render /metrics":<30} {(perf_counter() - started_at) * 1000:>10.2f} ms')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
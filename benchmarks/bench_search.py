@@ -0,0 +1,51 @@
+"""Бенчмарк полнотекстового поиска Task.search на большой таблице: редкие, частые и встречающиеся во всех задачах слова.
+Таблица заполняется один раз, поэтому лучше запускать на отдельной схеме, например:
+db_schema=bench_search python -m benchmarks.bench_search [количество задач]"""
+import sys
+from time import perf_counter
+from app.connectdb import get_cursor
+from app.migrations import apply_migrations
+from app.task import Statuses, Task
+from config import Config
+
+# Поисковые запросы и сколько примерно задач из миллиона им соответствует
+QUERIES = (('word123', 20), ('word123 common3', 20), ('common3', 100000), ('"task"', 1000000))
+
+
+def fill_table(count: int) -> None:
+    """Если таблица пустая, то заполняет ее count задачами: word<n> встречается в каждой 50000-й задаче,
+    common<n> - в каждой 10-й, task - во всех"""
+    with get_cursor() as cursor:
+        if Config.db_schema:
+            cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {Config.db_schema};")
+    apply_migrations()
+    with get_cursor() as cursor:
+        cursor.execute(f"SELECT EXISTS (SELECT FROM {Config.tasks_table_name});")
+        if not cursor.fetchone()[0]:
+            started_at = perf_counter()
+            cursor.execute(f"""INSERT INTO {Config.tasks_table_name} (content, date_of_creation, current_status)
+                               SELECT 'task ' || md5(i::text) || ' word' || (i %% 50000) || ' common' || (i %% 10),
+                                      now(), %s
+                               FROM generate_series(1, %s) AS i;""", (Statuses.new.value, count))
+            print(f'inserted {count} tasks in {perf_counter() - started_at:.1f} s')
+        cursor.execute(f"ANALYZE {Config.tasks_table_name}; ANALYZE {Config.tasks_table_name}_search;")
+
+
+def measure(q: str, repeat: int = 5) -> float:
+    """Возвращает лучшее время одного поиска в секундах"""
+    best = float('inf')
+    for _ in range(repeat):
+        started_at = perf_counter()
+        Task.search(q)
+        best = min(best, perf_counter() - started_at)
+    return best
+
+
+def main(count: int) -> None:
+    fill_table(count)
+    for q, matches in QUERIES:
+        print(f'{q:<20} ~{matches * count // 1000000:>8} matches {measure(q) * 1000:>8.1f} ms')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
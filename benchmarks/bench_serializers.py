@@ -0,0 +1,33 @@
+"""Бенчмарк сериализации ответов со списком задач: app.serializers против прежнего пути через flask.jsonify.
+Запуск из корня репозитория: python -m benchmarks.bench_serializers [количество задач]"""
+import sys
+from timeit import timeit
+from flask import Flask, jsonify, json
+from app import serializers
+from benchmarks.bench_task_rows import COLUMN_NAMES, make_rows
+from app.task import Task
+
+
+def measure(name: str, func, repeat: int = 3) -> None:
+    seconds = min(timeit(func, number=1) for _ in range(repeat))
+    print(f'{name:<45} {seconds * 1000:>10.1f} ms')
+
+
+def main(count: int) -> None:
+    tasks = Task.rows_to_dict(COLUMN_NAMES, make_rows(count))
+    task_dicts = list(tasks.values())
+    backend = 'orjson' if serializers.orjson is not None else 'json'
+    print(f'{count} tasks, serializers backend: {backend}')
+    with Flask(__name__).app_context():
+        measure('tasks page (flask.jsonify)', lambda: jsonify(tasks).get_data())
+        measure('tasks page (json_response)', lambda: serializers.json_response(tasks).get_data())
+        measure('ndjson export (flask.json.dumps)', lambda: [json.dumps(task) + '\n' for task in task_dicts])
+        measure('ndjson export (iter_ndjson)', lambda: list(serializers.iter_ndjson(task_dicts)))
+    # Стандартный json без orjson, чтобы было видно, сколько дает сам orjson
+    orjson, serializers.orjson = serializers.orjson, None
+    measure('tasks page (dumps, stdlib fallback)', lambda: serializers.dumps(tasks))
+    serializers.orjson = orjson
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,75 @@
+"""Микробенчмарк сборки задач из строк таблицы: текущая реализация против прежней.
+Запуск из корня репозитория: python -m benchmarks.bench_task_rows [количество строк]"""
+import sys
+import tracemalloc
+from datetime import date
+from timeit import timeit
+from app.task import Task, Statuses
+
+COLUMN_NAMES = ('id', 'content', 'date_of_creation', 'current_status', 'previous_status', 'last_change_status_date',
+                'version')
+
+
+def make_rows(count: int) -> list:
+    return [(task_id, f'task content {task_id}', date(2021, 4, 1), Statuses.in_progress.value, Statuses.new.value,
+             date(2021, 4, 2), 1) for task_id in range(1, count + 1)]
+
+
+def legacy_rows_to_dict(column_names, raw_tasks) -> dict:
+    """Прежняя сборка словаря задач: словарь на каждую пару колонка-значение и update в цикле по индексам"""
+    tasks_dict = dict()
+    for i in range(len(raw_tasks)):
+        current_task = raw_tasks[i]
+        current_task_dict = dict()
+        for col_name, value in zip(column_names, current_task):
+            current_task_dict.update({col_name: value})
+        tasks_dict.update({current_task_dict.get('id'): current_task_dict})
+    return tasks_dict
+
+
+class LegacyTask:
+    """Прежнее представление задачи: атрибуты в __dict__, dict() переименовывает ключи в цикле"""
+
+    def __init__(self, task_dict: dict):
+        self.task_id = task_dict['id']
+        self._content = task_dict['content']
+        self.date_of_creation = task_dict['date_of_creation']
+        self.last_change_status_date = task_dict['last_change_status_date']
+        self._current_status = task_dict['current_status']
+        self.previous_status = task_dict['previous_status']
+        self.version = task_dict['version']
+
+    def dict(self):
+        task_attributes = self.__dict__
+        updated_task_attributes = task_attributes.copy()
+        for key in task_attributes:
+            if str(key)[0] == '_':
+                updated_task_attributes[str(key)[1:]] = updated_task_attributes.pop(key)
+        return updated_task_attributes
+
+
+def measure(name: str, func, repeat: int = 3) -> None:
+    tracemalloc.start()
+    func()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    seconds = min(timeit(func, number=1) for _ in range(repeat))
+    print(f'{name:<40} {seconds * 1000:>10.1f} ms {peak_memory / 2 ** 20:>10.1f} MiB')
+
+
+def main(count: int) -> None:
+    rows = make_rows(count)
+    task_dicts = [dict(zip(COLUMN_NAMES, row)) for row in rows]
+    print(f'{count} rows')
+    measure('rows -> tasks dict (legacy)', lambda: legacy_rows_to_dict(COLUMN_NAMES, rows))
+    measure('rows -> tasks dict (Task.rows_to_dict)', lambda: Task.rows_to_dict(COLUMN_NAMES, rows))
+    measure('instances (legacy)', lambda: [LegacyTask(task_dict) for task_dict in task_dicts])
+    measure('instances (slotted Task)', lambda: [Task._from_dict(task_dict) for task_dict in task_dicts])
+    legacy_tasks = [LegacyTask(task_dict) for task_dict in task_dicts]
+    tasks = [Task._from_dict(task_dict) for task_dict in task_dicts]
+    measure('instance.dict() (legacy)', lambda: [task.dict() for task in legacy_tasks])
+    measure('instance.dict() (slotted Task)', lambda: [task.dict() for task in tasks])
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,253 @@
+"""Нагрузочный тест API задач: запускает Flask приложение на отдельной таблице, создает в ней задачи через
+POST /api/v1/tasks/bulk и гоняет смешанную нагрузку чтения и записи в несколько потоков.
+Печатает RPS и p50/p95/p99 по каждой операции и сохраняет результаты в json, чтобы сравнивать коммиты.
+Запуск из корня репозитория: python -m benchmarks.load_test --tasks 10000 --concurrency 16 --duration 30
+Сравнение с прошлым прогоном: python -m benchmarks.load_test --baseline benchmarks/results/<commit>.json"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+# Таблица нагрузочного теста задается до импорта config, чтобы тесты и их таблица test_tasks не пострадали
+os.environ.setdefault('tasks_table_name', 'load_test_tasks')
+
+import requests
+from config import Config
+from app.task import Statuses
+
+ROOT = Path(__file__).resolve().parent.parent
+# Вес каждой операции в смешанной нагрузке по умолчанию
+DEFAULT_MIX = {'get_all': 20, 'get_one': 50, 'create': 10, 'update': 15, 'delete': 5}
+STATUSES = [status.value for status in Statuses]
+
+
+class TaskIds:
+    """Потокобезопасный набор id существующих задач, из которого операции берут случайные id"""
+
+    def __init__(self, task_ids: List[int]):
+        self._task_ids = list(task_ids)
+        self._lock = Lock()
+
+    def add(self, task_id: int) -> None:
+        with self._lock:
+            self._task_ids.append(task_id)
+
+    def random(self) -> Optional[int]:
+        with self._lock:
+            return random.choice(self._task_ids) if self._task_ids else None
+
+    def pop_random(self) -> Optional[int]:
+        with self._lock:
+            if not self._task_ids:
+                return None
+            index = random.randrange(len(self._task_ids))
+            # Меняем местами с последним, чтобы удаление из списка было O(1)
+            self._task_ids[index], self._task_ids[-1] = self._task_ids[-1], self._task_ids[index]
+            return self._task_ids.pop()
+
+
+def get_all(session: requests.Session, url: str, task_ids: TaskIds) -> requests.Response:
+    return session.get(url, params={'limit': Config.default_page_size,
+                                    'after_id': max((task_ids.random() or 1) - 1, 0)})
+
+
+def get_one(session: requests.Session, url: str, task_ids: TaskIds) -> requests.Response:
+    return session.get(f'{url}/{task_ids.random() or 1}')
+
+
+def create(session: requests.Session, url: str, task_ids: TaskIds) -> requests.Response:
+    response = session.post(url, {'content': f'load test task {random.random()}'})
+    if response.status_code == 201:
+        task_ids.add(response.json())
+    return response
+
+
+def update(session: requests.Session, url: str, task_ids: TaskIds) -> requests.Response:
+    return session.put(url + '/', {'task_id': task_ids.random() or 1, 'status': random.choice(STATUSES)})
+
+
+def delete(session: requests.Session, url: str, task_ids: TaskIds) -> requests.Response:
+    return session.delete(f'{url}/{task_ids.pop_random() or 1}')
+
+
+OPERATIONS = {'get_all': get_all, 'get_one': get_one, 'create': create, 'update': update, 'delete': delete}
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    """Разбирает смесь операций вида get_one=50,update=15, операции, которых нет в строке, не выполняются"""
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f'Unknown operation {name}, expected one of {", ".join(OPERATIONS)}')
+        weights[name] = int(weight)
+    return weights
+
+
+def start_server(port: int) -> subprocess.Popen:
+    """Запускает Flask приложение в отдельном процессе и ждет, пока оно начнет отвечать"""
+    server = subprocess.Popen([sys.executable, '-m', 'flask', '--app', 'app.sca', 'run', '--port', str(port),
+                               '--with-threads', '--no-reload'],
+                              cwd=ROOT, env=dict(os.environ, metrics_enabled=os.environ.get('metrics_enabled', '1')),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f'http://127.0.0.1:{port}/metrics', timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f'Server did not start on port {port}')
+
+
+def prepare_table() -> None:
+    """Создает таблицу нагрузочного теста, если ее нет, и очищает ее"""
+    from app.connectdb import get_cursor
+    from app.migrations import apply_migrations
+    apply_migrations()
+    with get_cursor() as cursor:
+        cursor.execute(f'TRUNCATE {Config.tasks_table_name} RESTART IDENTITY;')
+
+
+def seed(url: str, count: int) -> List[int]:
+    """Создает count задач массовыми запросами и возвращает их id"""
+    task_ids = []
+    with requests.Session() as session:
+        for start in range(0, count, Config.bulk_max_items):
+            batch = [{'content': f'seed task {number}'} for number in range(start, min(start + Config.bulk_max_items,
+                                                                                      count))]
+            response = session.post(url + '/bulk', json=batch)
+            response.raise_for_status()
+            task_ids += response.json()
+    return task_ids
+
+
+def worker(url: str, task_ids: TaskIds, mix: Dict[str, int], deadline: float) -> List[Tuple[str, float, int]]:
+    """Выполняет случайные операции до deadline, возвращает список (операция, секунды, код ответа или 0 при ошибке)"""
+    names, weights = list(mix), list(mix.values())
+    samples = []
+    with requests.Session() as session:
+        while time.perf_counter() < deadline:
+            name = random.choices(names, weights)[0]
+            started_at = time.perf_counter()
+            try:
+                status = OPERATIONS[name](session, url, task_ids).status_code
+            except requests.RequestException:
+                status = 0
+            samples.append((name, time.perf_counter() - started_at, status))
+    return samples
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    """Перцентиль методом ближайшего ранга"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(samples: List[Tuple[str, float, int]], duration: float) -> Dict[str, dict]:
+    """Считает RPS, перцентили времени ответа в миллисекундах и ошибки по каждой операции и по всем вместе"""
+    groups = {'total': samples}
+    for sample in samples:
+        groups.setdefault(sample[0], []).append(sample)
+    summary = {}
+    for name, group in groups.items():
+        latencies = sorted(seconds for _, seconds, _ in group)
+        summary[name] = {'requests': len(group),
+                         'rps': len(group) / duration,
+                         'p50_ms': percentile(latencies, 50) * 1000,
+                         'p95_ms': percentile(latencies, 95) * 1000,
+                         'p99_ms': percentile(latencies, 99) * 1000,
+                         'errors': sum(1 for _, _, status in group if status == 0 or status >= 500)}
+    return summary
+
+
+def current_commit() -> str:
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True)
+    return result.stdout.strip() or 'unknown'
+
+
+def print_summary(summary: Dict[str, dict], baseline: Optional[Dict[str, dict]] = None) -> None:
+    print(f'{"operation":<10} {"requests":>9} {"rps":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for name, stats in summary.items():
+        line = (f'{name:<10} {stats["requests"]:>9} {stats["rps"]:>9.1f} {stats["p50_ms"]:>8.2f} '
+                f'{stats["p95_ms"]:>8.2f} {stats["p99_ms"]:>8.2f} {stats["errors"]:>7}')
+        if baseline and name in baseline:
+            before = baseline[name]
+            line += (f'   rps {change(before["rps"], stats["rps"]):>+7.1%}'
+                     f'   p95 {change(before["p95_ms"], stats["p95_ms"]):>+7.1%}')
+        print(line)
+
+
+def change(before: float, after: float) -> float:
+    return (after - before) / before if before else 0.0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=10000, help='how many tasks to seed before the run')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of client threads')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='operation weights, e.g. get_all=20,get_one=50,create=10,update=15,delete=5')
+    parser.add_argument('--port', type=int, default=5050, help='port for the started server')
+    parser.add_argument('--base-url', help='test an already running server instead of starting one')
+    parser.add_argument('--output', type=Path, help='json file for results, by default benchmarks/results/<commit>.json')
+    parser.add_argument('--baseline', type=Path, help='json results of a previous run to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='exit with code 1 if total rps drops or p95 grows more than this share vs baseline')
+    args = parser.parse_args()
+
+    server = None
+    if args.base_url is None:
+        prepare_table()
+        server = start_server(args.port)
+    base_url = args.base_url or f'http://127.0.0.1:{args.port}'
+    url = base_url + Config.endpoint
+    try:
+        task_ids = TaskIds(seed(url, args.tasks))
+        deadline = time.perf_counter() + args.duration
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = [executor.submit(worker, url, task_ids, args.mix, deadline) for _ in range(args.concurrency)]
+            samples = [sample for future in futures for sample in future.result()]
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    summary = summarize(samples, args.duration)
+    baseline = json.loads(args.baseline.read_text())['summary'] if args.baseline else None
+    print(f'{args.tasks} tasks, {args.concurrency} threads, {args.duration:g} s')
+    print_summary(summary, baseline)
+
+    commit = current_commit()
+    output = args.output or ROOT / 'benchmarks' / 'results' / f'{commit}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({'commit': commit,
+                                  'started_at': datetime.now().isoformat(timespec='seconds'),
+                                  'params': {'tasks': args.tasks, 'concurrency': args.concurrency,
+                                             'duration': args.duration, 'mix': args.mix},
+                                  'summary': summary}, indent=2))
+    print(f'Results saved to {output}')
+
+    if baseline and 'total' in baseline:
+        before, after = baseline['total'], summary['total']
+        if (change(before['rps'], after['rps']) < -args.max_regression
+                or change(before['p95_ms'], after['p95_ms']) > args.max_regression):
+            print(f'Regression over {args.max_regression:.0%} against {args.baseline}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
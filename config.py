@@ -1,7 +1,10 @@
-from typing import Union
-from os import environ
-from contextlib import closing
-from psycopg2 import connect
+from typing import Optional, Union
+from os import cpu_count, environ
+
+
+def default_web_workers(cpus: Optional[int], budget: int) -> int:
+    """Воркеров app.server по умолчанию: 2 * cpu + 1, но не больше budget, чтобы каждому досталось подключение к бд"""
+    return min(2 * (cpus or 1) + 1, budget)
 
 
 class Config:
@@ -9,19 +12,65 @@ class Config:
     user: str = environ['dbuser']
     password: Union[str, int] = environ['dbpass']
     host: str = 'localhost'
-    tasks_table_name: str = 'test_tasks'
-    base_url: str = 'http://127.0.0.1:5000'
+    # Схема, в которой приложение ищет и создает таблицы (search_path). None - схема по умолчанию, обычно public
+    db_schema: Optional[str] = environ.get('db_schema')
+    # Размер пула подключений и сколько секунд ждать свободное подключение, если все заняты.
+    # Под app.server размер пула каждого воркера считается из web_threads и db_connection_budget
+    db_pool_minconn: int = 1
+    db_pool_maxconn: int = int(environ.get('db_pool_maxconn', 20))
+    db_pool_timeout: float = float(environ.get('db_pool_timeout', 30))
+    # Сколько подключений к бд всего могут открыть все воркеры app.server вместе. Стоит оставить запас до
+    # max_connections сервера бд для миграций, app.archive и других утилит
+    db_connection_budget: int = int(environ.get('db_connection_budget', 80))
+    # Боевой запуск через python -m app.server: адрес, количество процессов-воркеров, потоков в каждом воркере
+    # и сколько секунд при остановке ждать, пока воркеры доработают запросы и запишут очередь статусов
+    web_bind: str = environ.get('web_bind', '127.0.0.1:5000')
+    web_workers: int = int(environ.get('web_workers', default_web_workers(cpu_count(), db_connection_budget)))
+    web_threads: int = int(environ.get('web_threads', 4))
+    web_graceful_timeout: int = int(environ.get('web_graceful_timeout', 30))
+    # Кэш задач у каждого воркера свой и не узнает о записях через другие воркеры, поэтому под app.server он
+    # по умолчанию выключен: иначе GET /api/v1/tasks/<id> мог бы до task_cache_ttl секунд отдавать старую версию задачи
+    web_task_cache_size: int = int(environ.get('web_task_cache_size', 0))
+    # Таблицу можно переопределить, например чтобы нагрузочный тест не трогал таблицу тестов
+    tasks_table_name: str = environ.get('tasks_table_name', 'test_tasks')
+    # Адрес сервера, на котором тесты проверяют API: app.sca (Flask) или app.asgi (ASGI)
+    base_url: str = environ.get('base_url', 'http://127.0.0.1:5000')
     endpoint: str = '/api/v1/tasks'
     complex_url: str = base_url + endpoint
+    # Размер страницы в GET /api/v1/tasks по умолчанию и максимальный
+    default_page_size: int = 100
+    max_page_size: int = 1000
+    # Сколько строк за раз забирать из серверного курсора при выгрузке всех задач
+    export_itersize: int = 2000
+    # Максимум задач в одном запросе на массовое создание и сколько строк вставлять одним INSERT
+    bulk_max_items: int = 10000
+    bulk_page_size: int = 1000
+    # Размер кэша задач для GET /api/v1/tasks/<id> и сколько секунд живет запись в кэше. 0 - кэш выключен
+    task_cache_size: int = int(environ.get('task_cache_size', 10000))
+    task_cache_ttl: float = float(environ.get('task_cache_ttl', 30))
+    # Конфигурация полнотекстового поиска PostgreSQL для GET /api/v1/tasks/search. simple не выкидывает стоп-слова
+    # и не приводит слова к основе, зато одинаково работает для любого языка. Уже проиндексированные задачи
+    # при смене конфигурации не переиндексируются
+    search_config: str = 'simple'
+    # Сколько совпадений поиска ранжировать. Ранжирование читает tsvector каждого совпадения, поэтому время поиска
+    # частого слова растет вместе с этим числом. Если совпадений больше, то ранжируются только search_max_matches
+    # самых новых из них, а ответ поиска содержит truncated: true. Более старые задачи с частым словом можно найти,
+    # уточнив запрос
+    search_max_matches: int = int(environ.get('search_max_matches', 1000))
+    # Выполненные задачи, статус которых не менялся столько дней, python -m app.archive переносит в архив.
+    # Перенос идет пачками по archive_batch_size задач, каждая пачка в своей транзакции
+    archive_after_days: int = int(environ.get('archive_after_days', 30))
+    archive_batch_size: int = int(environ.get('archive_batch_size', 1000))
+    # Через сколько секунд закэшированные имена колонок таблицы с задачами будут перечитаны из бд
+    schema_ttl: int = 300
+    # Очередь событий смены статуса POST /api/v1/tasks/status-events: через сколько секунд после первого события
+    # записывать пачку и сколько событий записывать одним запросом, если они накопились раньше
+    status_queue_interval: float = float(environ.get('status_queue_interval', 0.5))
+    status_queue_batch_size: int = int(environ.get('status_queue_batch_size', 1000))
+    # Измерять время запросов: гистограммы в GET /metrics и заголовок Server-Timing. 0 - выключено
+    metrics_enabled: bool = environ.get('metrics_enabled', '1') == '1'
 
     @classmethod
-    def get_column_names(cls) -> list:
-        """Возвращает все имена колонок таблицы Config.tasks_table_name"""
-        # Запрос достает имена колонок таблицы Config.tasks_table_name в порядке, в котором они расположены в таблице
-        with closing(connect(dbname=cls.dbname, user=cls.user, password=cls.password, host=cls.host)) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    f"SELECT attname FROM pg_attribute WHERE attrelid = '{cls.tasks_table_name}'"
-                    f"::regclass AND attnum > 0 ORDER BY attnum;")
-                column_names = cursor.fetchall()
-        return column_names
+    def db_options(cls) -> Optional[str]:
+        """Параметры сессии для libpq подключений: search_path, если задана схема"""
+        return f'-c search_path={cls.db_schema}' if cls.db_schema else None
@@ -1,18 +1,37 @@
 import random
 import pytest
 from contextlib import contextmanager
+from os import environ
+from threading import Thread
 from psycopg2 import pool
+from werkzeug.serving import make_server
 from config import Config
+
+# Режим изоляции тестов:
+# none - тесты ходят в уже запущенный сервер по Config.base_url и в общую таблицу, поэтому только последовательно;
+# schema - у каждого воркера pytest-xdist своя схема в бд и свой сервер в потоке, поэтому тесты можно запускать
+# параллельно: pytest -n auto. Под pytest-xdist по умолчанию schema.
+# Схему нужно выбрать до первого обращения к пулам подключений: пул приложения (app.connectdb.get_pool) и пул
+# тестов ниже берут search_path из Config.db_schema, когда создаются
+xdist_worker = environ.get('PYTEST_XDIST_WORKER')
+isolation = environ.get('test_isolation', 'schema' if xdist_worker else 'none')
+if isolation == 'schema':
+    Config.db_schema = f'test_{xdist_worker or "main"}'
+
+from app.archive import archive_tasks
+from app.migrations import apply_migrations
+from app.task import Statuses, tasks_cache
 from string import ascii_letters
 from random import choice, randint
-from datetime import date
+from datetime import date, timedelta
 from collections import OrderedDict
 import atexit
 
 
-connection_pool = pool.SimpleConnectionPool(minconn=1, maxconn=20,
-                                            dbname=Config.dbname, host=Config.host,
-                                            user=Config.user, password=Config.password, port=5432)
+connection_pool = pool.ThreadedConnectionPool(minconn=1, maxconn=20,
+                                              dbname=Config.dbname, host=Config.host,
+                                              user=Config.user, password=Config.password, port=5432,
+                                              options=Config.db_options())
 
 
 def close_connection_pool():
@@ -36,8 +55,8 @@ def connect_db_for_tests(func):
     def wrapper(*args, **kwargs):
         with get_connection() as conn:
             conn.autocommit = True
-            cursor = conn.cursor()
-        return func(*args, **kwargs, cursor=cursor)
+            with conn.cursor() as cursor:
+                return func(*args, **kwargs, cursor=cursor)
     return wrapper
 
 
@@ -52,21 +71,43 @@ def get_all_tasks_as_dict_from_test_db(cursor) -> dict:
     cursor.execute(f"SELECT * FROM {Config.tasks_table_name} ORDER BY id;")
     raw_tasks = cursor.fetchall()
 
-    column_names = Config.get_column_names()
+    # Имена колонок берем из описания результата запроса, без отдельного запроса к pg_attribute
+    column_names = [column.name for column in cursor.description]
     dict_tasks = dict()
 
     # Для каждой задачи соединим названия колонок и атрибуты задачи в словарь
-    for i in range(len(raw_tasks)):
-        current_task = raw_tasks[i]
-        current_task_dict = dict()
-        for col_name, value in zip(column_names, current_task):
-            current_task_dict.update({col_name[0]: value})
+    for current_task in raw_tasks:
+        current_task_dict = dict(zip(column_names, current_task))
         # Добавим словарь текущей задачи к общему словарю со всеми задачами
         dict_tasks.update({current_task_dict.get('id'): current_task_dict})
 
     return dict_tasks
 
 
+@pytest.fixture(scope='session', autouse=True)
+@connect_db_for_tests
+def migrate_test_db(cursor) -> None:
+    """Создает схему воркера, если тесты изолированы по схемам, и применяет миграции к тестовой бд перед запуском тестов"""
+    if Config.db_schema:
+        cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {Config.db_schema};")
+    apply_migrations()
+
+
+@pytest.fixture(scope='session', autouse=True)
+def app_server(migrate_test_db):
+    """В режиме изоляции schema запускает приложение в потоке на свободном порту и направляет на него тесты"""
+    if isolation != 'schema':
+        yield
+        return
+    from app.sca import app
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    Config.base_url = f'http://127.0.0.1:{server.server_port}'
+    Config.complex_url = Config.base_url + Config.endpoint
+    yield
+    server.shutdown()
+
+
 def generate_random_text(length: int = 30) -> str:
     """Генерирует и возвращает рандомную последовательность англ. букв разного регистра и пробела"""
     letters_with_space = ascii_letters + ' '
@@ -77,8 +118,23 @@ def generate_random_text(length: int = 30) -> str:
 @pytest.fixture()
 @connect_db_for_tests
 def truncate_tasks_table(cursor) -> None:
-    """Очищает таблицу с задачами, сбрасывает счетчик id"""
-    cursor.execute(f"TRUNCATE {Config.tasks_table_name} RESTART IDENTITY;")
+    """Очищает таблицу с задачами, архив и журнал изменений, сбрасывает счетчик id и кэш задач.
+    На таблице из нескольких строк DELETE и setval в разы быстрее, чем TRUNCATE ... RESTART IDENTITY"""
+    cursor.execute(f"DELETE FROM {Config.tasks_table_name}; DELETE FROM {Config.tasks_table_name}_archive; "
+                   f"DELETE FROM {Config.tasks_table_name}_changes; "
+                   f"SELECT setval(pg_get_serial_sequence(%s, 'id'), 1, false);", (Config.tasks_table_name,))
+    tasks_cache.clear()
+
+
+@pytest.fixture()
+def archive_done_tasks():
+    """Возвращает функцию, которая переводит задачи в статус Done 100 дней назад и переносит их в архив"""
+    @connect_db_for_tests
+    def archive(task_ids, cursor):
+        cursor.execute(f"UPDATE {Config.tasks_table_name} SET current_status = %s, last_change_status_date = %s "
+                       f"WHERE id = ANY(%s);", (Statuses.final.value, date.today() - timedelta(days=100), task_ids))
+        return archive_tasks(older_than_days=30)
+    return archive
 
 
 @pytest.fixture()
@@ -86,8 +142,7 @@ def truncate_tasks_table(cursor) -> None:
 def create_task(cursor):
     """Создает задачу с непустым content, возвращает content"""
     content = generate_random_text()
-    cursor.execute(f"INSERT INTO {Config.tasks_table_name} (date_of_creation) "
-                   f"VALUES ('{date.today()}');")
+    cursor.execute(f"INSERT INTO {Config.tasks_table_name} (date_of_creation) VALUES (%s);", (date.today(),))
     return content
 
 
@@ -96,11 +151,9 @@ def create_task(cursor):
 def create_many_tasks(cursor):
     """Создает несколько задач, возвращает количество созданных задач"""
     count_of_tasks = random.randint(1, 10)
-    for _ in range(count_of_tasks):
-        # Просто чтобы не создавать полностью пустые задачи
-        content = generate_random_text()
-        cursor.execute(f"INSERT INTO {Config.tasks_table_name} (content) "
-                       f"VALUES ('{content}');")
+    # Просто чтобы не создавать полностью пустые задачи. Все задачи вставляются одним запросом
+    contents = [generate_random_text() for _ in range(count_of_tasks)]
+    cursor.execute(f"INSERT INTO {Config.tasks_table_name} (content) SELECT unnest(%s::text[]);", (contents,))
     return count_of_tasks
 
 
@@ -108,12 +161,13 @@ def create_many_tasks(cursor):
 @connect_db_for_tests
 def create_task_with_attributes(cursor) -> dict:
     """Создает задачу и возвращает словарь с атрибутами этой задачи"""
-    # OrderDict нужен потому что важен порядок атрибутов при составлении SQL запроса в exec_str
+    # OrderDict нужен потому что важен порядок атрибутов при составлении SQL запроса
     task_attributes = OrderedDict(content=generate_random_text(40),
                                   date_of_creation=date(randint(1900, 2030), randint(1, 12), randint(1, 28)),
                                   current_status=generate_random_text(),
                                   previous_status=generate_random_text(),
                                   last_change_status_date=date(randint(1900, 2030), randint(1, 12), randint(1, 28)))
-    exec_str = f"""INSERT INTO {Config.tasks_table_name} ({', '.join([key for key in task_attributes])}) VALUES ({', '.join([f"'{task_attributes[key]}'" for key in task_attributes])}); """
-    cursor.execute(exec_str)
+    cursor.execute(f"INSERT INTO {Config.tasks_table_name} ({', '.join(task_attributes)}) "
+                   f"VALUES ({', '.join(['%s'] * len(task_attributes))});",
+                   list(task_attributes.values()))
     return dict(task_attributes)
@@ -1,4 +1,7 @@
+import json
 import pytest
+import time
+from datetime import timedelta
 import requests
 from config import Config
 from tests.conftest import generate_random_text, get_all_tasks_as_dict_from_test_db
@@ -31,6 +34,31 @@ class TestCreateTask:
         assert req.status_code == 400
 
 
+class TestCreateTasksBulk:
+    """Тесты на POST запрос. Массовое создание задач."""
+    @staticmethod
+    def test_create_tasks_bulk(truncate_tasks_table):
+        # Arrange
+        data = [{'content': generate_random_text()} for _ in range(3)]
+        # Act
+        req = requests.post(Config.complex_url + '/bulk', json=data)
+        tasks = get_all_tasks_as_dict_from_test_db()
+        # Assert
+        assert req.status_code == 201
+        assert req.json() == [1, 2, 3]
+        assert [tasks[task_id].get('content') for task_id in req.json()] == [task['content'] for task in data]
+        assert all(task.get('current_status') == Statuses.new.value for task in tasks.values())
+
+    @staticmethod
+    @pytest.mark.parametrize('data', [[], [{'invalid_key': 'invalid_value'}], {'content': 'not a list'}])
+    def test_create_tasks_bulk_with_invalid_req_body(truncate_tasks_table, data):
+        # Act
+        req = requests.post(Config.complex_url + '/bulk', json=data)
+        # Assert
+        assert req.status_code == 400
+        assert len(get_all_tasks_as_dict_from_test_db()) == 0
+
+
 class TestGetAllTasks:
     """Тесты на GET запрос. Чтение всех записей из таблички."""
     @staticmethod
@@ -50,6 +78,354 @@ class TestGetAllTasks:
         # Assert
         assert len(req.json()) == 0
 
+    @staticmethod
+    def test_get_tasks_page(truncate_tasks_table, create_many_tasks):
+        # Arrange
+        count_of_created_tasks = create_many_tasks
+        # Act
+        req = requests.get(Config.complex_url, params={'limit': 1, 'after_id': 0})
+        # Assert
+        assert list(req.json()) == ['1']
+        if count_of_created_tasks > 1:
+            assert req.headers['X-Next-Cursor'] == '1'
+        else:
+            assert 'X-Next-Cursor' not in req.headers
+
+    @staticmethod
+    def test_get_last_tasks_page(truncate_tasks_table, create_many_tasks):
+        # Arrange
+        count_of_created_tasks = create_many_tasks
+        # Act
+        req = requests.get(Config.complex_url, params={'after_id': count_of_created_tasks - 1})
+        # Assert
+        assert list(req.json()) == [str(count_of_created_tasks)]
+        assert 'X-Next-Cursor' not in req.headers
+
+    @staticmethod
+    def test_get_tasks_with_fields(truncate_tasks_table, create_many_tasks):
+        # Act
+        req = requests.get(Config.complex_url, params={'fields': 'content'})
+        # Assert
+        for task in req.json().values():
+            assert set(task) == {'id', 'content'}
+
+    @staticmethod
+    def test_get_tasks_filtered_by_status(truncate_tasks_table):
+        # Arrange
+        for _ in range(3):
+            requests.post(Config.complex_url, {'content': generate_random_text()})
+        requests.put(Config.complex_url + '/', {'task_id': 2, 'status': Statuses.in_progress.value})
+        # Act
+        req = requests.get(Config.complex_url, params={'status': Statuses.in_progress.value})
+        # Assert
+        assert req.status_code == 200
+        assert list(req.json()) == ['2']
+
+    @staticmethod
+    def test_get_tasks_filtered_by_dates(truncate_tasks_table, create_task_with_attributes):
+        # Arrange
+        created = create_task_with_attributes['date_of_creation']
+        changed = create_task_with_attributes['last_change_status_date']
+        next_day = timedelta(days=1)
+        # Act
+        matching = requests.get(Config.complex_url, params={'created_from': created.isoformat(),
+                                                            'created_to': created.isoformat(),
+                                                            'changed_since': changed.isoformat()})
+        created_later = requests.get(Config.complex_url, params={'created_from': (created + next_day).isoformat()})
+        changed_later = requests.get(Config.complex_url, params={'changed_since': (changed + next_day).isoformat()})
+        # Assert
+        assert list(matching.json()) == ['1']
+        assert created_later.json() == {}
+        assert changed_later.json() == {}
+
+    @staticmethod
+    @pytest.mark.parametrize('params', [{'fields': 'not_existing_column'}, {'limit': 0}, {'after_id': -1},
+                                        {'status': 'Random status'}, {'created_from': 'not a date'},
+                                        {'created_from': '2021-04-02', 'created_to': '2021-04-01'}])
+    def test_get_tasks_with_invalid_params(truncate_tasks_table, params):
+        # Act
+        req = requests.get(Config.complex_url, params=params)
+        # Assert
+        assert req.status_code == 400
+
+    @staticmethod
+    def test_get_all_tasks_not_modified(truncate_tasks_table, create_many_tasks):
+        # Arrange
+        etag = requests.get(Config.complex_url).headers['ETag']
+        # Act
+        req = requests.get(Config.complex_url, headers={'If-None-Match': etag})
+        # Assert
+        assert req.status_code == 304
+        assert req.headers['ETag'] == etag
+
+    @staticmethod
+    def test_get_all_tasks_modified_after_write(truncate_tasks_table, create_many_tasks):
+        # Arrange
+        etag = requests.get(Config.complex_url).headers['ETag']
+        requests.post(Config.complex_url, {'content': generate_random_text()})
+        # Act
+        req = requests.get(Config.complex_url, headers={'If-None-Match': etag})
+        # Assert
+        assert req.status_code == 200
+        assert req.headers['ETag'] != etag
+        assert len(req.json()) == create_many_tasks + 1
+
+
+class TestGetTask:
+    """Тесты на GET запрос. Чтение одной задачи."""
+    @staticmethod
+    def test_get_task(truncate_tasks_table):
+        # Arrange
+        content = generate_random_text()
+        task_id = requests.post(Config.complex_url, {'content': content}).json()
+        # Act
+        req = requests.get(f'{Config.complex_url}/{task_id}')
+        # Assert
+        assert req.status_code == 200
+        assert req.json()['task_id'] == task_id
+        assert req.json()['content'] == content
+        assert req.json()['current_status'] == Statuses.new.value
+
+    @staticmethod
+    def test_get_task_not_modified(truncate_tasks_table):
+        # Arrange
+        task_id = requests.post(Config.complex_url, {'content': generate_random_text()}).text
+        etag = requests.get(f'{Config.complex_url}/{task_id}').headers['ETag']
+        # Act
+        req = requests.get(f'{Config.complex_url}/{task_id}', headers={'If-None-Match': etag})
+        # Assert
+        assert req.status_code == 304
+
+    @staticmethod
+    def test_get_task_modified_after_update(truncate_tasks_table):
+        # Arrange
+        task_id = requests.post(Config.complex_url, {'content': generate_random_text()}).text
+        etag = requests.get(f'{Config.complex_url}/{task_id}').headers['ETag']
+        requests.put(Config.complex_url + '/', {'task_id': task_id, 'status': Statuses.in_progress.value})
+        # Act
+        req = requests.get(f'{Config.complex_url}/{task_id}', headers={'If-None-Match': etag})
+        # Assert
+        assert req.status_code == 200
+        assert req.headers['ETag'] != etag
+
+    @staticmethod
+    def test_get_not_existing_task(truncate_tasks_table):
+        # Act
+        req = requests.get(Config.complex_url + '/1000000')
+        # Assert
+        assert req.status_code == 404
+
+    @staticmethod
+    def test_get_not_existing_task_with_if_none_match(truncate_tasks_table):
+        # Act
+        req = requests.get(Config.complex_url + '/1000000', headers={'If-None-Match': '"1000000-1"'})
+        # Assert
+        assert req.status_code == 404
+
+
+class TestGetTasksStats:
+    """Тесты на GET запрос. Количество задач по статусам."""
+    @staticmethod
+    def test_get_tasks_stats(truncate_tasks_table):
+        # Arrange
+        for _ in range(3):
+            requests.post(Config.complex_url, {'content': generate_random_text()})
+        requests.put(Config.complex_url + '/', {'task_id': 1, 'status': Statuses.final.value})
+        # Act
+        req = requests.get(Config.complex_url + '/stats')
+        # Assert
+        assert req.status_code == 200
+        assert req.json() == {'total': 3, 'by_status': {Statuses.new.value: 2, Statuses.in_progress.value: 0,
+                                                        Statuses.final.value: 1}}
+
+    @staticmethod
+    def test_get_tasks_stats_not_modified(truncate_tasks_table, create_many_tasks):
+        # Arrange
+        etag = requests.get(Config.complex_url + '/stats').headers['ETag']
+        # Act
+        req = requests.get(Config.complex_url + '/stats', headers={'If-None-Match': etag})
+        # Assert
+        assert req.status_code == 304
+
+
+class TestGetTasksChanges:
+    """Тесты на GET запрос. Журнал изменений задач."""
+    @staticmethod
+    def test_get_changes(truncate_tasks_table):
+        # Arrange
+        task_id = requests.post(Config.complex_url, {'content': generate_random_text()}).json()
+        requests.put(Config.complex_url + '/', {'task_id': task_id, 'status': Statuses.final.value})
+        deleted_id = requests.post(Config.complex_url, {'content': generate_random_text()}).json()
+        requests.delete(f'{Config.complex_url}/{deleted_id}')
+        # Act
+        req = requests.get(Config.complex_url + '/changes')
+        # Assert
+        changes = req.json()['changes']
+        assert req.status_code == 200
+        assert [(change['task_id'], change['operation']) for change in changes] == \
+            [(task_id, 'insert'), (task_id, 'update'), (deleted_id, 'insert'), (deleted_id, 'delete')]
+        assert changes[1]['task']['current_status'] == Statuses.final.value
+        assert changes[3]['task'] is None
+
+    @staticmethod
+    def test_get_changes_since(truncate_tasks_table, create_many_tasks):
+        # Arrange
+        first_page = requests.get(Config.complex_url + '/changes', params={'limit': 1}).json()
+        # Act
+        rest = requests.get(Config.complex_url + '/changes', params={'since': first_page['next_since']}).json()
+        last = requests.get(Config.complex_url + '/changes', params={'since': rest['next_since']}).json()
+        # Assert
+        seqs = [change['seq'] for change in first_page['changes'] + rest['changes']]
+        assert len(seqs) == create_many_tasks
+        assert seqs == sorted(set(seqs))
+        assert last == {'changes': [], 'next_since': rest['next_since']}
+
+    @staticmethod
+    @pytest.mark.parametrize('params', [{'since': '12'}, {'since': 'abc-1'}, {'limit': 0}])
+    def test_get_changes_with_invalid_params(params):
+        # Act
+        req = requests.get(Config.complex_url + '/changes', params=params)
+        # Assert
+        assert req.status_code == 400
+
+
+class TestStatusEvents:
+    """Тесты на POST запрос. События смены статуса задач."""
+    @staticmethod
+    def test_enqueue_status_events(truncate_tasks_table):
+        # Arrange
+        task_id = requests.post(Config.complex_url, {'content': generate_random_text()}).json()
+        events = [{'task_id': task_id, 'status': Statuses.in_progress.value},
+                  {'task_id': task_id, 'status': Statuses.final.value}]
+        # Act
+        req = requests.post(Config.complex_url + '/status-events', json=events)
+        # Assert
+        assert req.status_code == 202
+        assert req.json()['accepted'] == 2
+        for _ in range(50):
+            task = requests.get(f'{Config.complex_url}/{task_id}').json()
+            if task['current_status'] == Statuses.final.value:
+                break
+            time.sleep(0.1)
+        assert task['current_status'] == Statuses.final.value
+        assert task['previous_status'] == Statuses.new.value
+
+    @staticmethod
+    @pytest.mark.parametrize('events', [[], [{'task_id': 1, 'status': 'Unknown'}], [{'task_id': 0, 'status': 'Done'}],
+                                        [{'task_id': 1, 'status': 'Done', 'content': 'abc'}], {'task_id': 1}])
+    def test_enqueue_invalid_status_events(events):
+        # Act
+        req = requests.post(Config.complex_url + '/status-events', json=events)
+        # Assert
+        assert req.status_code == 400
+
+
+class TestSearchTasks:
+    """Тесты на GET запрос. Полнотекстовый поиск задач."""
+    @staticmethod
+    def test_search_tasks(truncate_tasks_table):
+        # Arrange
+        contents = ['fix the login page', 'fix the search page', 'update the docs']
+        task_ids = requests.post(Config.complex_url + '/bulk', json=[{'content': c} for c in contents]).json()
+        # Act
+        req = requests.get(Config.complex_url + '/search', params={'q': 'fix -login', 'limit': 1})
+        # Assert
+        assert req.status_code == 200
+        assert [task['id'] for task in req.json()['tasks']] == [task_ids[1]]
+        assert req.json()['tasks'][0]['content'] == contents[1]
+        assert req.json()['next_offset'] is None
+        assert req.json()['truncated'] is False
+
+    @staticmethod
+    def test_search_tasks_pages(truncate_tasks_table, create_many_tasks):
+        # Arrange
+        requests.post(Config.complex_url + '/bulk', json=[{'content': 'needle'}] * 3)
+        # Act
+        first_page = requests.get(Config.complex_url + '/search', params={'q': 'needle', 'limit': 2}).json()
+        last_page = requests.get(Config.complex_url + '/search',
+                                 params={'q': 'needle', 'limit': 2, 'offset': first_page['next_offset']}).json()
+        # Assert
+        assert len(first_page['tasks']) == 2
+        assert len(last_page['tasks']) == 1
+        assert last_page['next_offset'] is None
+
+    @staticmethod
+    @pytest.mark.parametrize('params', [{}, {'q': ' '}, {'q': 'abc', 'offset': -1}, {'q': 'abc', 'order': 'id'}])
+    def test_search_tasks_with_invalid_params(params):
+        # Act
+        req = requests.get(Config.complex_url + '/search', params=params)
+        # Assert
+        assert req.status_code == 400
+
+
+class TestArchivedTasks:
+    """Тесты на GET запросы с include_archived. Задачи из архива."""
+    @staticmethod
+    def test_get_all_tasks_include_archived(truncate_tasks_table, archive_done_tasks):
+        # Arrange
+        task_ids = requests.post(Config.complex_url + '/bulk', json=[{'content': 'a'}, {'content': 'b'}]).json()
+        archive_done_tasks(task_ids[:1])
+        # Act
+        active = requests.get(Config.complex_url).json()
+        everything = requests.get(Config.complex_url, params={'include_archived': 1}).json()
+        # Assert
+        assert list(active) == [str(task_ids[1])]
+        assert list(everything) == [str(task_id) for task_id in task_ids]
+        assert everything[str(task_ids[0])]['current_status'] == Statuses.final.value
+
+    @staticmethod
+    def test_get_archived_task(truncate_tasks_table, archive_done_tasks):
+        # Arrange
+        task_id = requests.post(Config.complex_url, {'content': generate_random_text()}).json()
+        archive_done_tasks([task_id])
+        # Act
+        req = requests.get(f'{Config.complex_url}/{task_id}', params={'include_archived': 'true'})
+        # Assert
+        assert req.status_code == 200
+        assert req.json()['task_id'] == task_id
+        assert req.json()['current_status'] == Statuses.final.value
+
+    @staticmethod
+    def test_export_include_archived(truncate_tasks_table, archive_done_tasks):
+        # Arrange
+        task_ids = requests.post(Config.complex_url + '/bulk', json=[{'content': 'a'}, {'content': 'b'}]).json()
+        archive_done_tasks(task_ids[1:])
+        # Act
+        req = requests.get(Config.complex_url + '/export', params={'include_archived': 1})
+        # Assert
+        assert [json.loads(line)['id'] for line in req.text.splitlines()] == task_ids
+
+    @staticmethod
+    @pytest.mark.parametrize('url', ['', '/1', '/export'])
+    def test_include_archived_invalid(url):
+        # Act
+        req = requests.get(Config.complex_url + url, params={'include_archived': 'maybe'})
+        # Assert
+        assert req.status_code == 400
+
+
+class TestExportTasks:
+    """Тесты на GET запрос. Потоковая выгрузка всех задач в NDJSON."""
+    @staticmethod
+    def test_export_all_tasks(truncate_tasks_table, create_many_tasks):
+        # Arrange
+        count_of_created_tasks = create_many_tasks
+        # Act
+        req = requests.get(Config.complex_url + '/export', stream=True)
+        tasks = [json.loads(line) for line in req.iter_lines() if line]
+        # Assert
+        assert req.status_code == 200
+        assert req.headers['Content-Type'].startswith('application/x-ndjson')
+        assert [task['id'] for task in tasks] == list(range(1, count_of_created_tasks + 1))
+
+    @staticmethod
+    def test_export_from_empty_table(truncate_tasks_table):
+        # Act
+        req = requests.get(Config.complex_url + '/export')
+        # Assert
+        assert req.status_code == 200
+        assert req.text == ''
+
 
 class TestDeleteTask:
     """Тесты на DELETE запрос. Удаление задачи."""
@@ -69,6 +445,50 @@ class TestDeleteTask:
         assert req.status_code == 404
 
 
+class TestBulkTasks:
+    """Тесты для PATCH и DELETE запросов. Массовое изменение и удаление задач."""
+    @staticmethod
+    def test_update_tasks_bulk_by_ids(truncate_tasks_table, create_many_tasks):
+        # Arrange
+        data = {'ids': [1, 100], 'status': Statuses.final.value}
+        # Act
+        req = requests.patch(Config.complex_url + '/bulk', json=data)
+        tasks = get_all_tasks_as_dict_from_test_db()
+        # Assert
+        assert req.status_code == 200
+        assert req.json() == {'affected': [1], 'missing': [100]}
+        assert tasks[1].get('current_status') == Statuses.final.value
+
+    @staticmethod
+    def test_delete_tasks_bulk_by_range(truncate_tasks_table, create_many_tasks):
+        # Arrange
+        count_of_created_tasks = create_many_tasks
+        data = {'id_range': {'from_id': 1, 'to_id': count_of_created_tasks + 1}}
+        # Act
+        req = requests.delete(Config.complex_url + '/bulk', json=data)
+        # Assert
+        assert req.status_code == 200
+        assert req.json() == {'affected': list(range(1, count_of_created_tasks + 1)),
+                              'missing': [count_of_created_tasks + 1]}
+        assert len(get_all_tasks_as_dict_from_test_db()) == 0
+
+    @staticmethod
+    @pytest.mark.parametrize('data', [{}, {'ids': []}, {'ids': [1], 'id_range': {'from_id': 1, 'to_id': 2}},
+                                      {'id_range': {'from_id': 2, 'to_id': 1}}])
+    def test_delete_tasks_bulk_with_invalid_req_body(truncate_tasks_table, data):
+        # Act
+        req = requests.delete(Config.complex_url + '/bulk', json=data)
+        # Assert
+        assert req.status_code == 400
+
+    @staticmethod
+    def test_update_tasks_bulk_without_changes(truncate_tasks_table):
+        # Act
+        req = requests.patch(Config.complex_url + '/bulk', json={'ids': [1]})
+        # Assert
+        assert req.status_code == 400
+
+
 class TestUpdateTask:
     """Тесты для PUT запроса. Изменение задачи."""
     @staticmethod
@@ -146,6 +566,83 @@ class TestUpdateTask:
         # Assert
         assert req.status_code == 400
 
+    @staticmethod
+    def test_update_with_if_match(truncate_tasks_table):
+        # Arrange
+        task_id = requests.post(Config.complex_url, {'content': generate_random_text()}).json()
+        etag = requests.get(f'{Config.complex_url}/{task_id}').headers['ETag']
+        # Act
+        req = requests.put(Config.complex_url + '/', {'task_id': task_id, 'status': Statuses.in_progress.value},
+                           headers={'If-Match': etag})
+        # Assert
+        assert req.status_code == 200
+        assert req.headers['ETag'] != etag
+        assert req.headers['ETag'] == requests.get(f'{Config.complex_url}/{task_id}').headers['ETag']
+
+    @staticmethod
+    def test_update_with_same_data(truncate_tasks_table):
+        # Arrange
+        content = generate_random_text()
+        task_id = requests.post(Config.complex_url, {'content': content}).json()
+        etag = requests.get(f'{Config.complex_url}/{task_id}').headers['ETag']
+        # Act
+        req = requests.put(Config.complex_url + '/', {'task_id': task_id, 'content': content,
+                                                      'status': Statuses.new.value}, headers={'If-Match': etag})
+        # Assert
+        assert req.status_code == 200
+        assert req.headers['ETag'] == etag
+
+    @staticmethod
+    def test_update_with_stale_if_match(truncate_tasks_table):
+        # Arrange
+        task_id = requests.post(Config.complex_url, {'content': generate_random_text()}).json()
+        etag = requests.get(f'{Config.complex_url}/{task_id}').headers['ETag']
+        current_etag = requests.put(Config.complex_url + '/', {'task_id': task_id,
+                                                               'status': Statuses.in_progress.value}).headers['ETag']
+        # Act
+        req = requests.put(Config.complex_url + '/', {'task_id': task_id, 'status': Statuses.final.value},
+                           headers={'If-Match': etag})
+        # Assert
+        assert req.status_code == 409
+        assert req.headers['ETag'] == current_etag
+        assert get_all_tasks_as_dict_from_test_db()[task_id]['current_status'] == Statuses.in_progress.value
+
+    @staticmethod
+    @pytest.mark.parametrize('if_match', ['*', '"1000000-1"'])
+    def test_update_not_existing_task_with_if_match(truncate_tasks_table, if_match):
+        # Act
+        req = requests.put(Config.complex_url + '/', {'task_id': 1000000, 'status': Statuses.final.value},
+                           headers={'If-Match': if_match})
+        # Assert
+        assert req.status_code == 404
+
+
+class TestMetrics:
+    """Тесты на GET /metrics и заголовок Server-Timing"""
+    @staticmethod
+    def test_server_timing_header(truncate_tasks_table):
+        # Arrange
+        task_id = requests.post(Config.complex_url, {'content': generate_random_text()}).text
+        # Act
+        req = requests.get(f'{Config.complex_url}/{task_id}')
+        # Assert
+        assert req.status_code == 200
+        assert 'total;dur=' in req.headers['Server-Timing']
+
+    @staticmethod
+    def test_get_metrics(truncate_tasks_table):
+        # Arrange
+        requests.get(Config.complex_url)
+        # Act
+        req = requests.get(Config.base_url + '/metrics')
+        # Assert
+        assert req.status_code == 200
+        assert req.headers['Content-Type'].startswith('text/plain')
+        assert 'tasks_http_request_duration_seconds_count{method="GET",route="/api/v1/tasks",status="200"}' in req.text
+        assert 'tasks_db_pool_checkouts' in req.text
+        assert 'tasks_cache_hit_ratio' in req.text
+        assert 'tasks_sql_statement_calls{statement="select_change_counter_' in req.text
+
 
 if __name__ == '__main__':
     pytest.main()
@@ -1,6 +1,22 @@
+import asyncio
+import json
+import os
+import psycopg2
 import pytest
-from app.task import UpdateTaskRequestBody, CreateTaskRequestBody, Task, Statuses
+from threading import Thread
+from app.task import UpdateTaskRequestBody, CreateTaskRequestBody, Task, Statuses, VersionConflict, tasks_cache
+from app.cache import LRUCache
+from app import serializers, queries, metrics, async_task
+from app.status_counts import check_status_counts
+from app.status_queue import StatusQueue
+from app.archive import archive_tasks
+from app import migrations
+from datetime import date, datetime
+from app.schema import tasks_schema
+from app.connectdb import connect_db, get_connection, get_cursor, get_pool_stats, close_connection_pool
+from app.server import pool_size_per_worker
 from pydantic import ValidationError
+from config import Config, default_web_workers
 from tests.conftest import generate_random_text, get_all_tasks_as_dict_from_test_db
 
 
@@ -86,6 +102,29 @@ class TestTask:
         # Assert
         assert len(all_tasks_from_db) == 1
 
+    @staticmethod
+    def test_create_task_with_content(truncate_tasks_table):
+        """Task.create(content) должен создать задачу с контентом и вернуть ее инстанс с атрибутами из бд"""
+        # Arrange
+        content = generate_random_text()
+        # Act
+        task = Task.create(content)
+        task_from_db = get_all_tasks_as_dict_from_test_db().get(task.task_id)
+        # Assert
+        assert task.task_id == 1
+        assert task.content == task_from_db.get('content') == content
+        assert task.current_status == task_from_db.get('current_status') == Statuses.new.value
+        assert task.date_of_creation == task_from_db.get('date_of_creation')
+
+    @staticmethod
+    def test_create_task_with_quote_in_content(truncate_tasks_table):
+        # Arrange
+        content = "it's a task"
+        # Act
+        task = Task.create(content)
+        # Assert
+        assert get_all_tasks_as_dict_from_test_db().get(task.task_id).get('content') == content
+
     @staticmethod
     def test_get_existing_task(truncate_tasks_table, create_task_with_attributes):
         """
@@ -139,6 +178,730 @@ class TestTask:
         assert task_from_db.get('current_status') == new_status
         assert task_from_db.get('previous_status') == create_task_with_attributes['current_status']
 
+    @staticmethod
+    def test_update_content_and_status(truncate_tasks_table, create_task_with_attributes):
+        # Arrange
+        new_content = generate_random_text()
+        # Act
+        task = Task.update(1, content=new_content, current_status=Statuses.in_progress.value)
+        task_from_db = get_all_tasks_as_dict_from_test_db().get(1)
+        # Assert
+        assert task.content == task_from_db.get('content') == new_content
+        assert task.current_status == task_from_db.get('current_status') == Statuses.in_progress.value
+        assert task.previous_status == task_from_db.get('previous_status') == create_task_with_attributes['current_status']
+
+    @staticmethod
+    def test_update_with_same_status(truncate_tasks_table, create_task_with_attributes):
+        """Если статус не изменился, то previous_status и last_change_status_date не должны поменяться"""
+        # Act
+        task = Task.update(1, current_status=create_task_with_attributes['current_status'])
+        # Assert
+        assert task.previous_status == create_task_with_attributes['previous_status']
+        assert task.last_change_status_date == create_task_with_attributes['last_change_status_date']
+
+    @staticmethod
+    def test_update_not_existing_task(truncate_tasks_table):
+        # Act & Assert
+        assert Task.update(1, content=generate_random_text()) is None
+
+    @staticmethod
+    def test_same_status_does_not_change_task(truncate_tasks_table, create_task_with_attributes):
+        # Arrange
+        task = Task(task_id=1)
+        change_counter = Task.get_change_counter()
+        # Act
+        task.current_status = create_task_with_attributes['current_status']
+        # Assert
+        assert task.version == 1
+        assert Task.get_change_counter() == change_counter
+        assert Task.update(1, current_status=task.current_status, versions=[1]).version == 1
+        with pytest.raises(VersionConflict):
+            Task.update(1, current_status=task.current_status, versions=[2])
+
+    @staticmethod
+    def test_task_dict(truncate_tasks_table, create_task_with_attributes):
+        # Arrange
+        task_attributes = create_task_with_attributes
+        # Act
+        task_dict = Task(task_id=1).dict()
+        # Assert
+        assert task_dict == dict(task_attributes, task_id=1, version=1)
+
+    @staticmethod
+    def test_rows_to_dict():
+        # Arrange
+        column_names = ('id', 'content')
+        rows = [(1, 'first'), (2, 'second')]
+        # Act
+        tasks = Task.rows_to_dict(column_names, rows)
+        # Assert
+        assert tasks == {1: {'id': 1, 'content': 'first'}, 2: {'id': 2, 'content': 'second'}}
+
+    @staticmethod
+    def test_get_task_through_cache(truncate_tasks_table, create_task_with_attributes):
+        # Arrange
+        tasks_cache.clear()
+        hits_before = tasks_cache.hits
+        # Act
+        first_read = Task.get(1)
+        second_read = Task.get(1)
+        # Assert
+        assert first_read.content == second_read.content == create_task_with_attributes['content']
+        assert tasks_cache.hits == hits_before + 1
+
+    @staticmethod
+    def test_cache_is_updated_after_write(truncate_tasks_table, create_task):
+        # Arrange
+        tasks_cache.clear()
+        new_content = generate_random_text()
+        Task.get(1)
+        # Act
+        Task.update(1, content=new_content)
+        # Assert
+        assert Task.get(1).content == new_content
+
+    @staticmethod
+    def test_cache_is_invalidated_after_delete(truncate_tasks_table, create_task):
+        # Arrange
+        tasks_cache.clear()
+        Task.get(1)
+        # Act
+        Task.delete_by_id(1)
+        # Assert
+        assert Task.get(1) is None
+
+    @staticmethod
+    def test_get_etag_without_loading_task(truncate_tasks_table, create_task):
+        # Arrange
+        Task.update(1, content=generate_random_text())
+        tasks_cache.clear()
+        select_task_calls = queries.SELECT_TASK.stats()['calls']
+        # Act
+        etag = Task.get_etag(1)
+        # Assert
+        assert queries.SELECT_TASK.stats()['calls'] == select_task_calls
+        assert etag == Task.get(1).etag == '1-2'
+        assert Task.get_etag(2) is None
+
+    @staticmethod
+    def test_get_etag_of_archived_task(truncate_tasks_table, create_task, archive_done_tasks):
+        # Arrange
+        archive_done_tasks([1])
+        # Act, Assert
+        assert Task.get_etag(1, include_archived=True) == Task.get(1, include_archived=True).etag
+        assert Task.get_etag(1) is None
+
+
+class TestLRUCache:
+    """Тесты для LRU кэша"""
+    @staticmethod
+    def test_least_recently_used_item_is_evicted():
+        # Arrange
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set(1, 'first')
+        cache.set(2, 'second')
+        cache.get(1)
+        # Act
+        cache.set(3, 'third')
+        # Assert
+        assert cache.get(2) is None
+        assert cache.get(1) == 'first'
+        assert cache.get(3) == 'third'
+
+    @staticmethod
+    def test_expired_item_is_not_returned():
+        # Arrange
+        cache = LRUCache(maxsize=2, ttl=0)
+        cache.set(1, 'first')
+        # Act & Assert
+        assert cache.get(1) is None
+        assert cache.stats()['misses'] == 1
+
+    @staticmethod
+    def test_fill_after_invalidation_is_ignored():
+        # Arrange
+        cache = LRUCache(maxsize=2, ttl=60)
+        generation = cache.generation
+        # Act
+        cache.invalidate(1)
+        cache.fill(1, 'stale value', generation)
+        # Assert
+        assert cache.get(1) is None
+
+    @staticmethod
+    def test_older_version_does_not_replace_newer():
+        # Arrange
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set_if_newer(1, {'version': 3}, 3)
+        # Act
+        cache.set_if_newer(1, {'version': 2}, 2)
+        cache.set_if_newer(2, {'version': 1}, 1)
+        cache.set_if_newer(2, {'version': 2}, 2)
+        # Assert
+        assert cache.get(1) == {'version': 3}
+        assert cache.get(2) == {'version': 2}
+
+
+class TestSerializers:
+    """Тесты для сериализации ответов в json"""
+    @staticmethod
+    def test_dumps():
+        # Arrange
+        obj = {1: {'date_of_creation': date(2021, 4, 1), 'changed_at': datetime(2021, 4, 1, 12, 30),
+                   'current_status': Statuses.final, 'content': 'задача'}}
+        # Act
+        result = serializers.dumps(obj)
+        # Assert
+        assert json.loads(result) == {'1': {'date_of_creation': '2021-04-01', 'changed_at': '2021-04-01T12:30:00',
+                                            'current_status': 'Done', 'content': 'задача'}}
+
+    @staticmethod
+    def test_dumps_without_orjson(monkeypatch):
+        # Arrange
+        monkeypatch.setattr(serializers, 'orjson', None)
+        obj = {1: {'date_of_creation': date(2021, 4, 1), 'current_status': Statuses.new}}
+        # Act
+        result = serializers.dumps(obj)
+        # Assert
+        assert json.loads(result) == {'1': {'date_of_creation': '2021-04-01', 'current_status': 'Waiting'}}
+
+    @staticmethod
+    def test_iter_ndjson():
+        # Act
+        lines = list(serializers.iter_ndjson([{'id': 1}, {'id': 2}]))
+        # Assert
+        assert [json.loads(line) for line in lines] == [{'id': 1}, {'id': 2}]
+        assert all(line.endswith(b'\n') for line in lines)
+
+
+class TestQueries:
+    """Тесты для подготовленных запросов"""
+    @staticmethod
+    def test_statement_is_prepared_once_per_connection():
+        # Arrange
+        statement = queries.statement('test_select', 'SELECT %(value)s::int + 1;')
+
+        @connect_db
+        def execute_twice(cursor):
+            results = []
+            for value in (1, 2):
+                statement.execute(cursor, value=value)
+                results.append(cursor.fetchone()[0])
+            cursor.execute('SELECT count(*) FROM pg_prepared_statements WHERE name = %s;', (statement.name,))
+            return results, cursor.fetchone()[0]
+        # Act
+        results, count_of_prepared = execute_twice()
+        # Assert
+        assert results == [2, 3]
+        assert count_of_prepared == 1
+        assert statement.stats()['calls'] >= 2
+
+    @staticmethod
+    def test_statement_is_prepared_again_after_alter_table():
+        # Arrange
+        statement = queries.statement('test_select_after_alter', 'SELECT * FROM test_alter_table;')
+
+        @connect_db
+        def execute_around_alter(cursor):
+            cursor.execute('CREATE TEMP TABLE test_alter_table (id int); INSERT INTO test_alter_table VALUES (1);')
+            rows = []
+            for alter in ("ALTER TABLE test_alter_table ADD COLUMN note text DEFAULT 'note';",
+                          'ALTER TABLE test_alter_table DROP COLUMN id;', 'DROP TABLE test_alter_table;'):
+                statement.execute(cursor)
+                rows.append(cursor.fetchone())
+                cursor.execute(alter)
+            return rows
+        # Act
+        rows = execute_around_alter()
+        # Assert
+        assert rows == [(1,), (1, 'note'), ('note',)]
+
+    @staticmethod
+    def test_statement_is_prepared_again_after_alter_table_in_transaction():
+        # Arrange
+        statement = queries.statement('test_select_after_alter_in_transaction', 'SELECT * FROM test_alter_table;')
+        with get_connection() as connection:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute('CREATE TEMP TABLE test_alter_table (id int); INSERT INTO test_alter_table VALUES (1);')
+                statement.execute(cursor)
+                cursor.execute('ALTER TABLE test_alter_table ADD COLUMN note text;')
+            connection.autocommit = False
+            # Act
+            with pytest.raises(psycopg2.errors.FeatureNotSupported):
+                with connection, connection.cursor() as cursor:
+                    statement.execute(cursor)
+            with connection, connection.cursor() as cursor:
+                statement.execute(cursor)
+                row = cursor.fetchone()
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute('DROP TABLE test_alter_table;')
+        # Assert
+        assert row == (1, None)
+
+    @staticmethod
+    def test_select_tasks_page_filters_order():
+        # Act
+        statement = queries.select_tasks_page(None, {'changed_since': None, 'status': None})
+        # Assert
+        assert statement is queries.select_tasks_page(None, ['status', 'changed_since'])
+        assert 'current_status = $2 AND last_change_status_date >= $3' in statement.query
+
+    @staticmethod
+    def test_to_positional():
+        # Act
+        query, param_names = queries.to_positional('SELECT %(a)s, %(b)s, %(a)s;')
+        # Assert
+        assert query == 'SELECT $1, $2, $1;'
+        assert param_names == ('a', 'b')
+
+
+class TestStatusCounts:
+    """Тесты для счетчиков задач по статусам"""
+    @staticmethod
+    def test_counts_follow_writes(truncate_tasks_table):
+        # Arrange
+        Task.create_many([generate_random_text() for _ in range(3)])
+        Task.create(generate_random_text())
+        # Act
+        Task.update(1, current_status=Statuses.in_progress.value)
+        Task.update(2, content=generate_random_text())
+        Task.update_many([3, 4], current_status=Statuses.final.value)
+        Task.delete_by_id(4)
+        # Assert
+        assert Task.get_status_counts() == {'total': 3, 'by_status': {Statuses.new.value: 1,
+                                                                      Statuses.in_progress.value: 1,
+                                                                      Statuses.final.value: 1}}
+
+    @staticmethod
+    def test_check_and_repair_status_counts(truncate_tasks_table, create_many_tasks):
+        # Arrange
+        @connect_db
+        def corrupt_counts(cursor):
+            cursor.execute(f"INSERT INTO {Config.tasks_table_name}_status_counts (status, count) VALUES ('', 5);")
+        corrupt_counts()
+        # Act
+        mismatches = check_status_counts(repair=True)
+        # Assert
+        assert mismatches == {'': (create_many_tasks + 5, create_many_tasks)}
+        assert check_status_counts() == {}
+
+    @staticmethod
+    def test_truncate_resets_counts(create_many_tasks):
+        # Arrange
+        @connect_db
+        def truncate(cursor):
+            cursor.execute(f"TRUNCATE {Config.tasks_table_name} RESTART IDENTITY;")
+        # Act
+        truncate()
+        # Assert
+        assert Task.get_status_counts()['total'] == 0
+        assert check_status_counts() == {}
+
+
+class TestVersionConflict:
+    """Тесты для обновления задачи с проверкой версии"""
+    @staticmethod
+    def test_update_with_stale_version(truncate_tasks_table):
+        # Arrange
+        task = Task.create(generate_random_text())
+        Task.update(task.task_id, current_status=Statuses.in_progress.value)
+        # Act
+        with pytest.raises(VersionConflict) as conflict:
+            Task.update(task.task_id, current_status=Statuses.final.value, versions=[task.version])
+        # Assert
+        assert conflict.value.version == task.version + 1
+        assert Task.get(task.task_id).current_status == Statuses.in_progress.value
+
+    @staticmethod
+    def test_versions_from_etags():
+        # Act
+        versions = Task.versions_from_etags(7, ['7-3', '8-4', '7-x', 'abc'])
+        # Assert
+        assert versions == [3]
+
+
+class TestStatusQueue:
+    """Тесты для очереди событий смены статуса"""
+    @staticmethod
+    def test_flush_writes_last_status(truncate_tasks_table):
+        # Arrange
+        task = Task.create(generate_random_text())
+        queue = StatusQueue(interval=60)
+        # Act
+        depth = queue.put([(task.task_id, Statuses.in_progress.value), (task.task_id, Statuses.final.value),
+                           (task.task_id + 1, Statuses.final.value)])
+        updated = queue.flush()
+        queue.stop()
+        # Assert
+        updated_task = Task.get(task.task_id)
+        assert depth == 2
+        assert updated == 1
+        assert updated_task.current_status == Statuses.final.value
+        assert updated_task.previous_status == Statuses.new.value
+        assert {key: queue.stats()[key] for key in ('queue_depth', 'received', 'coalesced', 'written', 'missing')} \
+            == {'queue_depth': 0, 'received': 3, 'coalesced': 1, 'written': 1, 'missing': 1}
+
+    @staticmethod
+    def test_flush_by_batch_size(truncate_tasks_table):
+        # Arrange
+        task = Task.create(generate_random_text())
+        queue = StatusQueue(interval=60, batch_size=1)
+        # Act
+        queue.put([(task.task_id, Statuses.final.value)])
+        queue.stop(timeout=5)
+        # Assert
+        assert Task.get(task.task_id).current_status == Statuses.final.value
+        assert queue.stats()['flushes'] == 1
+        with pytest.raises(RuntimeError):
+            queue.put([(task.task_id, Statuses.new.value)])
+
+    @staticmethod
+    def test_async_queue_retries_failed_flush(truncate_tasks_table, monkeypatch):
+        # Arrange
+        task = Task.create(generate_random_text())
+        monkeypatch.setattr(async_task, 'pool', None)
+
+        async def put_before_pool_is_ready():
+            queue = async_task.AsyncStatusQueue(interval=0.05)
+            # Пула еще нет, поэтому первая запись не удастся
+            queue.put([(task.task_id, Statuses.final.value)])
+            await asyncio.sleep(0.2)
+            await async_task.init_pool()
+            try:
+                await asyncio.sleep(0.3)
+                return queue.stats()
+            finally:
+                queue._thread.cancel()
+                await async_task.close_pool()
+        # Act
+        stats = asyncio.run(put_before_pool_is_ready())
+        # Assert
+        assert stats['failed_flushes'] >= 1
+        assert stats['flushes'] == 1
+        assert stats['queue_depth'] == 0
+        assert Task.get(task.task_id).current_status == Statuses.final.value
+
+
+class TestChanges:
+    """Тесты для журнала изменений"""
+    @staticmethod
+    def test_changes_wait_for_older_transaction(truncate_tasks_table):
+        # Arrange
+        with get_cursor(autocommit=False) as cursor:
+            Task._insert(cursor, generate_random_text())
+            # Задача создана в более поздней транзакции, но закоммичена раньше
+            later_task = Task.create(generate_random_text())
+            # Act
+            changes_before_commit, since = Task.get_changes()
+        changes_after_commit, _ = Task.get_changes(since)
+        # Assert
+        assert changes_before_commit == []
+        assert since == '0-0'
+        assert [change['task_id'] for change in changes_after_commit] == [1, later_task.task_id]
+
+
+class TestSearch:
+    """Тесты для полнотекстового поиска задач"""
+    @staticmethod
+    def test_search_ranks_tasks(truncate_tasks_table):
+        # Arrange
+        once = Task.create('buy milk and bread')
+        twice = Task.create('milk, milk and more milk')
+        Task.create('walk the dog')
+        # Act
+        tasks, next_offset, truncated = Task.search('milk')
+        # Assert
+        assert [task['id'] for task in tasks] == [twice.task_id, once.task_id]
+        assert tasks[0]['rank'] > tasks[1]['rank']
+        assert tasks[1]['content'] == once.content
+        assert 'truncated' not in tasks[0]
+        assert next_offset is None
+        assert truncated is False
+
+    @staticmethod
+    def test_search_follows_content_changes(truncate_tasks_table):
+        # Arrange
+        task = Task.create('write the report')
+        deleted = Task.create('write tests')
+        # Act
+        task.content = 'read the report'
+        Task.update(task.task_id, current_status=Statuses.final.value)
+        Task.delete_by_id(deleted.task_id)
+        # Assert
+        assert Task.search('write') == ([], None, False)
+        assert [found['id'] for found in Task.search('read')[0]] == [task.task_id]
+
+    @staticmethod
+    def test_search_pages(truncate_tasks_table):
+        # Arrange
+        task_ids = Task.create_many(['same words'] * 3)
+        # Act
+        first_page, next_offset, _ = Task.search('words', limit=2)
+        last_page, last_offset, _ = Task.search('words', limit=2, offset=next_offset)
+        # Assert
+        assert [task['id'] for task in first_page + last_page] == task_ids
+        assert next_offset == 2
+        assert last_offset is None
+
+    @staticmethod
+    def test_search_ranks_newest_matches(truncate_tasks_table, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(Config, 'search_max_matches', 2)
+        _, second_id, third_id = Task.create_many(['milk', 'bread', 'milk milk milk'])
+        # Act
+        tasks, next_offset, truncated = Task.search('milk or bread')
+        # Assert
+        assert [task['id'] for task in tasks] == [third_id, second_id]
+        assert next_offset is None
+        assert truncated is True
+
+
+class TestArchive:
+    """Тесты для переноса выполненных задач в архив"""
+    @staticmethod
+    def test_archive_tasks(truncate_tasks_table, archive_done_tasks):
+        # Arrange
+        task_ids = Task.create_many([generate_random_text() for _ in range(5)])
+        recent = Task.get(task_ids[4])
+        recent.current_status = Statuses.final.value
+        # Act
+        archived = archive_done_tasks(task_ids[:3])
+        # Assert
+        assert archived == 3
+        assert list(Task.get_tasks_page(10)[0]) == task_ids[3:]
+        assert list(Task.get_tasks_page(10, include_archived=True)[0]) == task_ids
+        assert [task['id'] for task in Task.iter_all_tasks(include_archived=True)] == task_ids
+        assert Task.get(task_ids[0]) is None
+        assert Task.get(task_ids[0], include_archived=True).current_status == Statuses.final.value
+        assert Task.get(task_ids[3], include_archived=True).task_id == task_ids[3]
+        assert check_status_counts() == {}
+
+    @staticmethod
+    def test_archive_in_batches(truncate_tasks_table):
+        # Arrange
+        task_ids = Task.create_many([generate_random_text() for _ in range(5)])
+        with get_cursor() as cursor:
+            cursor.execute(f"UPDATE {Config.tasks_table_name} SET current_status = %s, last_change_status_date = %s;",
+                           (Statuses.final.value, date(2000, 1, 1)))
+        progress = []
+        # Act
+        archived = archive_tasks(older_than_days=30, batch_size=2,
+                                 progress=lambda count, seconds: progress.append(count))
+        # Assert
+        assert archived == 5
+        assert progress == [2, 4, 5]
+        assert Task.get_tasks_page(10) == ({}, None)
+        assert list(Task.get_tasks_page(10, include_archived=True)[0]) == task_ids
+
+    @staticmethod
+    def test_archive_logged_as_archive(truncate_tasks_table, archive_done_tasks):
+        # Arrange
+        task = Task.create(generate_random_text())
+        # Act
+        archive_done_tasks([task.task_id])
+        # Assert
+        changes, _ = Task.get_changes()
+        assert [change['operation'] for change in changes] == ['insert', 'update', 'archive']
+
+
+class TestMetrics:
+    """Тесты для гистограмм и времени этапов запроса"""
+    @staticmethod
+    def test_histogram_render():
+        # Arrange
+        histogram = metrics.Histogram('test_seconds', 'Test histogram', ('route',), buckets=(0.1, 1.0))
+        # Act
+        histogram.observe(0.05, '/a')
+        histogram.observe(0.5, '/a')
+        histogram.observe(5, '/a')
+        lines = histogram.render()
+        # Assert
+        assert 'test_seconds_bucket{route="/a",le="0.1"} 1' in lines
+        assert 'test_seconds_bucket{route="/a",le="1.0"} 2' in lines
+        assert 'test_seconds_bucket{route="/a",le="+Inf"} 3' in lines
+        assert 'test_seconds_count{route="/a"} 3' in lines
+        assert 'test_seconds_sum{route="/a"} 5.55' in lines
+
+    @staticmethod
+    def test_request_timings():
+        # Arrange
+        metrics.start_request()
+        # Act
+        metrics.record_timing('sql', 0.002)
+        metrics.record_timing('sql', 0.003)
+        server_timing = metrics.finish_request('GET', '/test', 200, 0.01)
+        # Assert
+        assert server_timing == 'sql;dur=5.00, total;dur=10.00'
+
+    @staticmethod
+    def test_record_timing_outside_request():
+        # Act
+        metrics.record_timing('sql', 0.002)
+        # Assert
+        assert metrics.finish_request('GET', '/test', 200, 0.01) == 'total;dur=10.00'
+
+
+class TestMigrations:
+    """Тесты для применения миграций"""
+    @staticmethod
+    def test_current_schema_has_no_pending_migrations():
+        # Act
+        pending = migrations.get_pending_migrations()
+        applied = migrations.apply_migrations()
+        # Assert
+        assert pending == []
+        assert applied == 0
+
+    @staticmethod
+    def test_current_schema_does_not_wait_for_table_locks():
+        # Arrange: открытая транзакция читает задачи, как выгрузка GET /api/v1/tasks/export
+        with get_cursor(autocommit=False) as cursor:
+            cursor.execute(f"SELECT FROM {Config.tasks_table_name} LIMIT 1;")
+            migrate = Thread(target=migrations.apply_migrations, daemon=True)
+            # Act
+            migrate.start()
+            migrate.join(timeout=5)
+            # Assert
+            assert not migrate.is_alive()
+
+    @staticmethod
+    def test_new_migration_is_applied_once(monkeypatch):
+        # Arrange
+        monkeypatch.setattr(migrations, 'MIGRATIONS', migrations.MIGRATIONS + [
+            ('test migration', [f"CREATE TABLE {Config.tasks_table_name}_test_migration (id integer);"])])
+        try:
+            # Act
+            first_run = migrations.apply_migrations()
+            second_run = migrations.apply_migrations()
+            # Assert
+            assert (first_run, second_run) == (1, 0)
+        finally:
+            with get_cursor() as cursor:
+                cursor.execute(f"DROP TABLE IF EXISTS {Config.tasks_table_name}_test_migration; "
+                               f"DELETE FROM {Config.tasks_table_name}_migrations WHERE name = 'test migration';")
+
+
+class TestTableSchema:
+    """Тесты для реестра колонок таблицы с задачами"""
+    @staticmethod
+    def test_column_names():
+        # Act
+        column_names = tasks_schema.column_names
+        # Assert
+        assert column_names[0] == 'id'
+        assert {'content', 'date_of_creation', 'current_status'} <= set(column_names)
+
+    @staticmethod
+    def test_column_names_are_cached():
+        # Act
+        first_call = tasks_schema.column_names
+        second_call = tasks_schema.column_names
+        # Assert
+        assert first_call is second_call
+
+    @staticmethod
+    def test_refresh():
+        # Arrange
+        column_names = tasks_schema.column_names
+        # Act
+        tasks_schema.refresh()
+        # Assert
+        assert tasks_schema.column_names == column_names
+        assert tasks_schema.column_names is not column_names
+
+    @staticmethod
+    def test_set_column_names():
+        # Arrange
+        column_names = tasks_schema.column_names
+        try:
+            # Act
+            tasks_schema.set_column_names(['id', 'content'])
+            # Assert
+            assert tasks_schema.column_names == ('id', 'content')
+        finally:
+            tasks_schema.set_column_names(column_names)
+
+
+class TestConnectDb:
+    """Тесты для декоратора connect_db и пула подключений"""
+    @staticmethod
+    def test_connection_is_checked_out_while_query_runs():
+        # Arrange
+        @connect_db
+        def get_checked_out(cursor):
+            cursor.execute('SELECT 1;')
+            return get_pool_stats()['checked_out']
+        checked_out_before = get_pool_stats()['checked_out']
+        # Act
+        checked_out_during_query = get_checked_out()
+        # Assert
+        assert checked_out_during_query == checked_out_before + 1
+        assert get_pool_stats()['checked_out'] == checked_out_before
+
+    @staticmethod
+    def test_cursor_is_closed_after_call():
+        # Arrange
+        @connect_db
+        def get_cursor(cursor):
+            return cursor
+        # Act
+        cursor = get_cursor()
+        # Assert
+        assert cursor.closed
+
+    @staticmethod
+    def test_pool_is_created_again_after_fork():
+        # Arrange
+        @connect_db
+        def get_backend_pid(cursor):
+            cursor.execute('SELECT pg_backend_pid();')
+            return cursor.fetchone()[0]
+        parent_backend_pid = get_backend_pid()
+        read_fd, write_fd = os.pipe()
+        # Act
+        child_pid = os.fork()
+        if child_pid == 0:
+            try:
+                # Унаследованный пул закрывать нельзя, это оборвало бы подключения родителя
+                close_connection_pool()
+                os.write(write_fd, str(get_backend_pid()).encode())
+            finally:
+                os._exit(0)
+        os.waitpid(child_pid, 0)
+        child_backend_pid = int(os.read(read_fd, 32))
+        # Assert
+        assert child_backend_pid != parent_backend_pid
+        assert get_backend_pid() == parent_backend_pid
+
+
+class TestServer:
+    """Тесты для запуска через app.server"""
+    @staticmethod
+    @pytest.mark.parametrize('workers, threads, budget, pool_size', [(4, 4, 80, 5), (10, 8, 40, 4), (3, 2, 3, 1)])
+    def test_pool_size_per_worker(workers, threads, budget, pool_size):
+        # Act
+        size = pool_size_per_worker(workers, threads, budget)
+        # Assert
+        assert size == pool_size
+        assert size * workers <= budget
+
+    @staticmethod
+    def test_pool_size_over_budget():
+        # Act, Assert
+        with pytest.raises(ValueError):
+            pool_size_per_worker(10, 4, 5)
+
+    @staticmethod
+    @pytest.mark.parametrize('cpus, workers', [(None, 3), (4, 9), (39, 79), (40, 80), (128, 80)])
+    def test_default_web_workers_fit_budget(cpus, workers):
+        # Act
+        default_workers = default_web_workers(cpus, budget=80)
+        # Assert
+        assert default_workers == workers
+        assert pool_size_per_worker(default_workers, threads=4, budget=80) >= 1
+
 
 if __name__ == '__main__':
     pytest.main()